@@ -0,0 +1,366 @@
+import asyncio, logging, math, time
+import numpy as np
+from EnumClasses import CurrentRange, InjectionType, FrequencyScale, FeMode, FeChannel, TimeStamp
+from HelperFunctions import GetFloatFromBytes, WallClock
+from FrameReader import FrameReader
+from ImpedanceAnalyser import AnalyserProtocol, ResultDecoder
+from ProtocolTrace import CaptureFile, logger
+
+class AsyncImpedanceAnalyser(AnalyserProtocol):
+    """asyncio variant of ImpedanceAnalyser working on a stream transport
+
+    Settings, command encoders, the device state cache and result decoding are shared with ImpedanceAnalyser
+    through AnalyserProtocol. Only the commands listed in this class are available, all of them are coroutines;
+    other commands can be sent with SendAndReceive and the matching Encode function or raw command bytes.
+    """
+
+    #region Constructor
+    def __init__(self, streamReader:asyncio.StreamReader, streamWriter:asyncio.StreamWriter):
+        """Constructor for already opened streams, see OpenSerial and OpenTcp
+
+        Args:
+            streamReader (asyncio.StreamReader): stream receiving from the device
+            streamWriter (asyncio.StreamWriter): stream sending to the device
+        """
+
+        super().__init__(FrameReader(None))
+        self.streamReader = streamReader
+        self.streamWriter = streamWriter
+
+
+    @classmethod
+    async def OpenSerial(cls, comPort:str, baudrate:int = 115200) -> "AsyncImpedanceAnalyser":
+        """Opens a serial port, requires the pyserial-asyncio package
+
+        Args:
+            comPort (str): serial port of the device
+            baudrate (int, optional): baud rate of the port. Defaults to 115200.
+
+        Raises:
+            ImportError: Thrown if pyserial-asyncio is not installed
+
+        Returns:
+            AsyncImpedanceAnalyser: connected device
+        """
+
+        try:
+            import serial_asyncio
+        except ImportError as e:
+            raise ImportError("AsyncImpedanceAnalyser.OpenSerial requires the pyserial-asyncio package.") from e
+
+        streamReader, streamWriter = await serial_asyncio.open_serial_connection(url=comPort, baudrate=baudrate)
+        return cls(streamReader, streamWriter)
+
+
+    @classmethod
+    async def OpenTcp(cls, host:str, port:int) -> "AsyncImpedanceAnalyser":
+        """Opens a TCP connection to the Ethernet interface of the device
+
+        Args:
+            host (str): IP address or host name of the device
+            port (int): TCP port of the device
+
+        Returns:
+            AsyncImpedanceAnalyser: connected device
+        """
+
+        streamReader, streamWriter = await asyncio.open_connection(host, port)
+        return cls(streamReader, streamWriter)
+
+
+    async def Close(self):
+        """Closes the stream transport
+        """
+
+        self.streamWriter.close()
+        await self.streamWriter.wait_closed()
+
+
+    async def DoInitialSetup(self, fmin:float, fmax:float, fnum:int, fscale:FrequencyScale, channel:FeChannel, mode:FeMode, currRange:CurrentRange, precision:float, excitationType:InjectionType, excitationAmplitude:float, timestamp:TimeStamp):
+        self.SetFrequency(fmin, fmax, fnum, fscale)
+        self.SetFeChannel(channel)
+        self.SetFeMode(mode)
+        self.SetRange(currRange)
+        self.SetPrecision(precision)
+        self.SetExcitationType(excitationType)
+        self.SetExcitationAmplitude(excitationAmplitude)
+        self.SetTimeStamp(timestamp)
+
+        logger.info("Precision: %s, amplitude: %s", precision, excitationAmplitude)
+        await self.SetSetup()
+        await self.SetFeSettings()
+        await self.SetOptions()
+    #endregion
+
+    #region Stream Communication
+    async def Write(self, command:bytes):
+        """Writes raw command bytes to the device
+
+        Args:
+            command (bytes): one or more complete command frames
+        """
+
+        if self.capture is not None:
+            self.capture.Write(CaptureFile.TX, command)
+        if self.metrics is not None:
+            self.metrics.Increment("bytesOut", len(command))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("TX %s", command.hex(" "))
+
+        self.streamWriter.write(command)
+        await self.streamWriter.drain()
+
+
+    async def RequireFrame(self):
+        """Waits until the next frame is completely buffered, so the FrameReader does not block afterwards
+
+        Raises:
+            ConnectionError: Thrown if the stream was closed
+        """
+
+        for part in ("header", "frame"):
+            numBytes = 2 if part == "header" else self.reader.NextFrameLength()
+            while self.reader.Available() < numBytes:
+                data = await self.streamReader.read(self.reader.Reserve(numBytes - self.reader.Available()))
+                if not data:
+                    raise ConnectionError("Connection to the device was closed.")
+                self.reader.Feed(data)
+
+
+    async def ReadFrame(self) -> memoryview:
+        """Reads the next frame from the device
+
+        Returns:
+            memoryview: frame including CT, LE and closing CT, valid until the next read
+        """
+
+        await self.RequireFrame()
+        return self.reader.NextFrame()
+
+
+    async def SendAndReceive(self, command:bytes) -> bytes:
+
+        if self.metrics is not None:
+            sendTime = time.perf_counter()
+
+        await self.Write(command)
+
+        msg = bytes()
+        while True:
+            frame = await self.ReadFrame()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("RX %s", frame.hex(" "))
+            if self.IsAck(frame):
+                ack = frame[2]
+                if self.metrics is not None:
+                    self.metrics.Observe(f"roundTrip.0x{command[0]:02X}", time.perf_counter() - sendTime)
+                    self.metrics.Increment("commands")
+                self.WarningACK(ack)
+                break
+
+            msg += frame
+
+        return msg
+
+
+    async def SendAndReceiveMany(self, commands:list[bytes], names:list[str] | None = None) -> list[bytes]:
+        """Writes several commands back to back and collects their answers in the same order, see ImpedanceAnalyser.SendAndReceiveMany
+        """
+
+        if names is None:
+            names = [f"command {index}" for index in range(len(commands))]
+
+        if self.metrics is not None:
+            sendTime = time.perf_counter()
+
+        await self.Write(b"".join(commands))
+
+        msgs = []
+        error = None
+        for command, name in zip(commands, names):
+            msg = bytes()
+            while True:
+                frame = await self.ReadFrame()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("RX %s", frame.hex(" "))
+                if self.IsAck(frame):
+                    # pipelined commands: time from the common write to the acknowledge of this command
+                    if self.metrics is not None:
+                        self.metrics.Observe(f"roundTrip.0x{command[0]:02X}", time.perf_counter() - sendTime)
+                        self.metrics.Increment("commands")
+                    try:
+                        self.WarningACK(frame[2])
+                    except Exception as e:
+                        if error is None:
+                            error = Exception(f"{name}: {e}")
+                    break
+
+                msg += frame
+            msgs.append(msg)
+
+        if error is not None:
+            raise error
+
+        return msgs
+
+
+    async def SendConfiguration(self, key:str, commands:list[bytes], force:bool = False) -> bool:
+        """Sends configuration commands unless the device already acknowledged the same ones, see ImpedanceAnalyser.SendConfiguration
+        """
+
+        if not force and self.deviceState.get(key) == commands:
+            return False
+
+        self.deviceState.pop(key, None)
+        for command in commands:
+            await self.SendAndReceive(command)
+        self.deviceState[key] = commands
+
+        return True
+
+
+    async def ReadResults(self, numPoints:int, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]):
+        """Reads numPoints result frames and decodes them block wise as they arrive, see ImpedanceAnalyser.ReadResults
+        """
+
+        decoder = ResultDecoder(self, numPoints, out)
+        while decoder.Remaining() > 0:
+            await self.RequireFrame()
+            decoder.Decode(*self.reader.NextResultBlock(decoder.Remaining(), decoder.frameLength))
+    #endregion
+
+    #region ScioSpec commands
+    async def SetOptions(self, force:bool = False):
+        """0x97 - Set Options
+        """
+
+        await self.SendConfiguration("options", self.EncodeOptions(), force)
+
+
+    async def ResetSystem(self):
+        """0xA1 - Reset System
+        """
+
+        await self.SendAndReceive(bytes([0xA1, 0x00, 0xA1]))
+        self.InvalidateDeviceState()
+
+
+    async def SetFeSettings(self, force:bool = False):
+        """0xB0 - Set FE Settings
+        """
+
+        commands = self.EncodeFeSettings()
+        if not force and self.deviceState.get("feSettings") == commands:
+            return
+
+        # The reset frame also clears the channel list of the device
+        self.deviceState.pop("mux", None)
+        await self.SendConfiguration("feSettings", commands, True)
+        self.deviceState["mux"] = ()
+
+
+    async def SetExtensionPortChannels(self, offsets:range | list[int]):
+        """0xB2 - Set ExtenstionPort Channel for several configurations with a single write
+        """
+
+        commands = self.EncodeExtensionPortChannels(offsets)
+
+        channels = self.deviceState.pop("mux", None)
+        await self.SendAndReceiveMany(commands, [f"Channel {offset} {list(self.muxElConfig[offset])}" for offset in offsets])
+        if channels is not None:
+            self.deviceState["mux"] = channels + tuple(tuple(self.muxElConfig[offset]) for offset in offsets)
+
+
+    async def ConfigureChannels(self, offsets:range | list[int]):
+        """0xB0/0xB2 - Sets the FE settings and a fresh channel list, see ImpedanceAnalyser.ConfigureChannels
+        """
+
+        channels = tuple(tuple(self.muxElConfig[offset]) for offset in offsets)
+        current = self.deviceState.get("mux")
+
+        if self.deviceState.get("feSettings") == self.EncodeFeSettings() and current is not None and channels[:len(current)] == current:
+            if len(current) < len(channels):
+                await self.SetExtensionPortChannels(offsets[len(current):])
+            return
+
+        await self.SetFeSettings(force=True)
+        await self.SetExtensionPortChannels(offsets)
+
+
+    async def GetExtensionPortChannel(self) -> list[int]:
+        """0xB3 - Get ExtensionPort Channel
+        """
+
+        msg = await self.SendAndReceive(bytes([0xB3, 0x00, 0xB3]))
+
+        return [list(payload[x:x+4]) for payload in self.FramePayloads(msg) for x in range(0, len(payload), 4)]
+
+
+    async def SetSetup(self, force:bool = False):
+        """0xB6 - Set Setup
+        """
+
+        await self.SendConfiguration("setup", self.EncodeSetup(), force)
+
+
+    async def GetFrequencyList(self) -> list[float]:
+        """0xB7 - Get Setup - Get Frequency List
+        """
+
+        msg = await self.SendAndReceive(bytes([0xB7, 0x01, 0x04, 0xB7]))
+
+        return [GetFloatFromBytes(payload[i:i+4]) for payload in self.FramePayloads(msg) for i in range(1, len(payload), 4)]
+
+
+    async def StartMeasure(self, repetitions:int = 1):
+        """0xB8 - Start Measure
+        """
+
+        await self.SendAndReceive(self.EncodeStartMeasure(repetitions))
+
+
+    async def StopMeasure(self):
+        """0xB8 - Stop Measure, result frames still in flight are discarded
+        """
+
+        await self.Write(bytes([0xB8, 0x01, 0x00, 0xB8]))
+
+        while True:
+            frame = await self.ReadFrame()
+            if self.IsAck(frame) and frame[2] not in (0x90, 0x91):
+                self.WarningACK(frame[2])
+                break
+    #endregion
+
+    #region Result processing
+    async def GetMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]:
+        """Runs one sweep over all configured electrode combinations and frequencies, see ImpedanceAnalyser.GetMeasurements
+        """
+
+        self.CheckSettings()
+
+        muxConfigLen = len(self.muxElConfig)
+        if out is None:
+            out = self.AllocateResultBuffers()
+        resImpedance, resRange, resTime, resWarning = out
+        flatResults = self.GetFlatResultBuffers(out)
+        if len(self.channelStarts) != muxConfigLen:
+            self.channelStarts = np.zeros(muxConfigLen)
+
+        startTime = WallClock()
+
+        for idxElChunks in range(math.ceil(muxConfigLen / 128)):
+
+            numMeas = min(128, muxConfigLen - 128 * idxElChunks)
+
+            await self.ConfigureChannels(range(128 * idxElChunks, 128 * idxElChunks + numMeas))
+            self.channelStarts[128 * idxElChunks:128 * idxElChunks + numMeas] = WallClock()
+            await self.StartMeasure()
+
+            points = slice(128 * idxElChunks * self.fnum, (128 * idxElChunks + numMeas) * self.fnum)
+            await self.ReadResults(numMeas * self.fnum, tuple(result[points] for result in flatResults))
+
+        finishTime = WallClock()
+
+        return resImpedance.real, resImpedance.imag, resWarning, resRange, resTime, startTime, finishTime
+    #endregion
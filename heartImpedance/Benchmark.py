@@ -0,0 +1,209 @@
+"""
+Benchmark.py
+End-to-end acquisition benchmark against the DeviceEmulator: GetMeasurements -> EISData -> SaveToDataframe -> MeasurementStore and tabs.
+
+    python Benchmark.py --channels 1 16 128 --frequencies 1 64 2047 --timestamps off us --output bench.json
+    python Benchmark.py --output new.json --compare bench.json
+"""
+import argparse, datetime, itertools, json, multiprocessing, os, platform, subprocess, sys, threading, time
+import numpy as np
+from DataManager import EISData
+from DeviceEmulator import DeviceEmulator
+from EnumClasses import CurrentRange, InjectionType, FrequencyScale, FeMode, FeChannel, TimeStamp
+from ImpedanceAnalyser import ImpedanceAnalyser
+
+STAGES = ["measure", "eisdata", "dataframe", "tabs"]
+
+def RunEmulator(portQueue:multiprocessing.Queue, pointLatency:float):
+    """Entry point of the emulator process, reports its TCP port through the queue
+    """
+
+    emulator = DeviceEmulator(pointLatency=pointLatency)
+    ready = threading.Event()
+    threading.Thread(target=emulator.ServeTcp, kwargs={"ready": ready}, daemon=True).start()
+    ready.wait()
+    portQueue.put(emulator.port)
+    threading.Event().wait()
+
+
+def PeakRss() -> int | None:
+    """Peak resident set size of this process in bytes, None if it can not be determined
+    """
+
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def CreateTabs():
+    """Creates the measurement store and the plot tabs on an offscreen QApplication
+
+    Raises:
+        ImportError: Thrown if PySide6 or pyqtgraph are missing
+
+    Returns:
+        MeasurementStore: store updating the tabs
+    """
+
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtWidgets import QApplication
+    from MeasurementStore import MeasurementStore
+    from tabClasses import BodeDiagramTab, TimeSeriesTab, DerivedValueTab
+
+    global qtApplication, qtTabs
+    qtApplication = QApplication.instance() or QApplication([])
+    store = MeasurementStore()
+    qtTabs = [BodeDiagramTab(store), TimeSeriesTab(store), DerivedValueTab(store)]
+
+    return store
+
+
+def Percentiles(durations:list[float]) -> dict:
+    values = np.asarray(durations) * 1e3
+
+    return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)), "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)), "max": float(values.max())}
+
+
+def BenchmarkConfiguration(analyser:ImpedanceAnalyser, numChannels:int, numFrequencies:int, timeStamp:TimeStamp, sweeps:int, withTabs:bool) -> dict:
+    """Runs one warm up sweep and the timed sweeps for one configuration
+
+    Args:
+        analyser (ImpedanceAnalyser): analyser connected to the emulator
+        numChannels (int): number of electrode combinations
+        numFrequencies (int): number of frequency points
+        timeStamp (TimeStamp): time stamp option
+        sweeps (int): number of timed sweeps
+        withTabs (bool): also measure the stage of appending to the store and updating the tabs
+
+    Returns:
+        dict: configuration, throughput, stage latency percentiles in ms (or "skipped: <reason>") and peak RSS
+    """
+
+    analyser.DoInitialSetup(1e3, 1e6, numFrequencies, FrequencyScale.logarithmic, FeChannel.ExtensionPort, FeMode.mode4pt, CurrentRange.range10mA, 1, InjectionType.voltage, 0.1, timeStamp)
+    analyser.muxElConfig = [list(combination) for combination in itertools.islice(itertools.combinations(range(1, 33), 4), numChannels)]
+    frequencies = analyser.GetFrequencyList()
+    electrodes = [list(combination) for combination in analyser.muxElConfig]
+    buffers = analyser.AllocateResultBuffers()
+    store = None
+    skipped = {}
+    if not withTabs:
+        skipped["tabs"] = "skipped: --no-tabs"
+    else:
+        try:
+            store = CreateTabs()
+        except ImportError as e:
+            skipped["tabs"] = f"skipped: {e}"
+
+    durations = {stage: [] for stage in STAGES}
+    for sweep in range(sweeps + 1):
+        stageTimes = [time.perf_counter()]
+
+        resReal, resImag, _, _, resTime, startTime, finishTime = analyser.GetMeasurements(buffers)
+        stageTimes.append(time.perf_counter())
+
+        data = EISData(timeStamp=analyser.PointTimes(resTime, startTime), frequencies=frequencies, electrodes=electrodes, realParts=resReal, imagParts=resImag, startTime=startTime, finishTime=finishTime, singlePrecision=True)
+        stageTimes.append(time.perf_counter())
+
+        data.SaveToDataframe()
+        stageTimes.append(time.perf_counter())
+
+        if store is not None:
+            store.Append(data)
+        stageTimes.append(time.perf_counter())
+
+        # the first sweep configures the device and is not counted
+        if sweep > 0:
+            for stage, start, finish in zip(STAGES, stageTimes, stageTimes[1:]):
+                durations[stage].append(finish - start)
+
+    for stage in skipped:
+        del durations[stage]
+
+    numPoints = numChannels * numFrequencies
+    measureTime = float(np.median(durations["measure"]))
+    totalTime = float(np.median(np.sum([durations[stage] for stage in durations], axis=0)))
+
+    return {"channels": numChannels, "frequencies": numFrequencies, "timeStamp": timeStamp.name, "sweeps": sweeps,
+            "pointsPerSecond": numPoints / measureTime, "endToEndPointsPerSecond": numPoints / totalTime,
+            "stagesMs": {stage: Percentiles(durations[stage]) if stage in durations else skipped[stage] for stage in STAGES}, "peakRssBytes": PeakRss()}
+
+
+def Metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {"commit": commit, "date": datetime.datetime.now().isoformat(" ", "seconds"), "python": platform.python_version(),
+            "numpy": np.__version__, "platform": platform.platform()}
+
+
+def Compare(results:dict, baseline:dict):
+    """Prints the throughput change of every configuration present in both result files, configurations that skipped different stages are not compared
+    """
+
+    def Key(result:dict) -> tuple:
+        return result["channels"], result["frequencies"], result["timeStamp"]
+
+    def Skipped(result:dict) -> set:
+        # result files written before skipped stages were recorded just leave the stage out
+        return {stage for stage in STAGES if not isinstance(result["stagesMs"].get(stage, "skipped"), dict)}
+
+    baselineResults = {Key(result): result for result in baseline["results"]}
+    print(f"{'channels':>8} {'freqs':>6} {'stamp':>5} {'points/s':>12} {'baseline':>12} {'change':>8}")
+    for result in results["results"]:
+        old = baselineResults.get(Key(result))
+        if old is None:
+            continue
+        if Skipped(result) != Skipped(old):
+            stages = ", ".join(sorted(Skipped(result) ^ Skipped(old)))
+            print(f"{result['channels']:>8} {result['frequencies']:>6} {result['timeStamp']:>5} {'not comparable, skipped in one run: ' + stages}")
+            continue
+        change = result["endToEndPointsPerSecond"] / old["endToEndPointsPerSecond"] - 1
+        print(f"{result['channels']:>8} {result['frequencies']:>6} {result['timeStamp']:>5} {result['endToEndPointsPerSecond']:>12.0f} {old['endToEndPointsPerSecond']:>12.0f} {change:>+8.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end acquisition benchmark against the device emulator")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 16, 128, 256], help="numbers of electrode combinations (1 - 256)")
+    parser.add_argument("--frequencies", type=int, nargs="+", default=[1, 64, 512, 2047], help="numbers of frequency points (1 - 2047)")
+    parser.add_argument("--timestamps", nargs="+", default=["off", "ms", "us"], choices=[timeStamp.name for timeStamp in TimeStamp], help="time stamp options")
+    parser.add_argument("--sweeps", type=int, default=3, help="timed sweeps per configuration")
+    parser.add_argument("--latency", type=float, default=0.0, help="emulated seconds per frequency point")
+    parser.add_argument("--no-tabs", action="store_true", help="skip the store and tab update stage")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file for the results")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    if any(numChannels < 1 or numChannels > 256 for numChannels in args.channels) or any(numFrequencies < 1 or numFrequencies > 2047 for numFrequencies in args.frequencies):
+        parser.error("channels must be between 1 and 256, frequencies between 1 and 2047")
+
+    portQueue = multiprocessing.Queue()
+    emulatorProcess = multiprocessing.Process(target=RunEmulator, args=(portQueue, args.latency), daemon=True)
+    emulatorProcess.start()
+    analyser = ImpedanceAnalyser(f"tcp://127.0.0.1:{portQueue.get(timeout=30)}")
+
+    results = {"meta": Metadata(), "results": []}
+    for numChannels, numFrequencies, timeStampName in itertools.product(args.channels, args.frequencies, args.timestamps):
+        result = BenchmarkConfiguration(analyser, numChannels, numFrequencies, TimeStamp[timeStampName], args.sweeps, not args.no_tabs)
+        results["results"].append(result)
+        print(f"{numChannels:>4} channels {numFrequencies:>5} frequencies {timeStampName:>3}: {result['pointsPerSecond']:>12.0f} points/s measured, {result['endToEndPointsPerSecond']:>12.0f} points/s end to end", flush=True)
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            Compare(results, json.load(file))
+
+    emulatorProcess.terminate()
@@ -1,3 +1,4 @@
+import logging
 from EnumClasses import CurrentRange, InjectionType
 
 def CalculateValidImpedanceRange(injectionType:InjectionType, injectionValue, injectionCurrentRange:CurrentRange) -> tuple[float, float, float]:
@@ -36,6 +37,6 @@ def CalculateValidImpedanceRange(injectionType:InjectionType, injectionValue, in
     else:
         raise TypeError("No other injection types are possible.")
     
-    print(f"Impedance range: [{zMin}, {zMax}]")
+    logging.getLogger(__name__).info("Impedance range: [%s, %s]", zMin, zMax)
     
     return zMin, zMax
\ No newline at end of file
@@ -1,14 +1,86 @@
 from __future__ import annotations
 import numpy as np
 import pandas as pd
-import ast
+import ast, collections, datetime, functools, math, threading
+from collections.abc import Iterable
+
+def ParseTime(time:str | float | None) -> float:
+    """Epoch seconds of a local wall clock time given as ISO text or number, NaN if unknown
+    """
+    if time is None or (isinstance(time, str) and time == ""):
+        return math.nan
+    if isinstance(time, str):
+        return datetime.datetime.fromisoformat(time).timestamp()
+    return float(time)
+
+def FormatTime(epoch:float, short:bool = False, timespec:str = "seconds") -> str:
+    """Local wall clock time "YYYY-MM-DD hh:mm:ss" (short: "hh:mm:ss") of epoch seconds, empty if unknown
+
+    Args:
+        timespec (str, optional): precision as for datetime.isoformat, files use "milliseconds" or "microseconds". Defaults to "seconds".
+    """
+    if math.isnan(epoch):
+        return ""
+    time = datetime.datetime.fromtimestamp(epoch)
+    return time.time().isoformat(timespec) if short else time.isoformat(" ", timespec)
+
+class SweepAxes:
+    """Frequencies and electrode combinations, one object is shared by all sweeps measured with the same settings
+    """
+    __slots__ = ("frequencies", "electrodes")
+    # recently used axes by content, so sweeps of a run do not each keep their own copy
+    recent:collections.OrderedDict[tuple, SweepAxes] = collections.OrderedDict()
+    recentLock = threading.Lock()
+    RECENT_SIZE = 16
+
+    def __init__(self, frequencies:np.ndarray, electrodes:tuple[tuple[int, ...], ...]):
+        self.frequencies = frequencies
+        self.electrodes = electrodes
+
+    @classmethod
+    def Get(cls, frequencies:list[float], electrodes:list[list[int]] | None) -> SweepAxes:
+        """Returns the shared axes with these values, they must not be changed by the caller
+
+        Args:
+            frequencies (list[float]): frequencies in Hz
+            electrodes (list[list[int]] | None): electrode combinations
+
+        Returns:
+            SweepAxes: axes with a read only frequency array and electrode combinations as tuples
+        """
+        frequencies = np.asarray(frequencies, dtype=np.float64).ravel()
+        electrodes = () if electrodes is None else tuple(map(tuple, electrodes))
+        key = (frequencies.tobytes(), electrodes)
+        
+        with cls.recentLock:
+            axes = cls.recent.get(key)
+            if axes is None:
+                frequencies = frequencies.copy()
+                frequencies.flags.writeable = False
+                axes = cls.recent[key] = cls(frequencies, electrodes)
+                while len(cls.recent) > cls.RECENT_SIZE:
+                    cls.recent.popitem(last=False)
+            cls.recent.move_to_end(key)
+        
+        return axes
+
+@functools.lru_cache(maxsize=16)
+def MissingTimeStamps(shape:tuple[int, int]) -> np.ndarray:
+    """Shared read only NaN array for sweeps without device time stamps, a broadcast view that needs no memory per point
+    """
+    return np.broadcast_to(np.float64(np.nan), shape)
 
 class EISData:
     """Class acting as container for measurement data
 
+    Lean record of one sweep: a complex64 impedance matrix (channels, frequencies), device time stamps only if the
+    device sent them, start and finish time as epoch seconds and axes shared with the other sweeps of the run.
+    Time texts and derived values are created on demand.
+
     Returns:
         _type_: _description_
     """
+    __slots__ = ("axes", "impedanceArray", "timeStampArray", "startEpoch", "finishEpoch", "measurementIndex", "derivedCache")
     # Measurement index as static variable, increases after each instantiation of this class
     index = 1
 
@@ -20,86 +92,263 @@ class EISData:
         realParts: list[list[float]] | None = None,
         imagParts: list[list[float]] | None = None,
         impedances: list[list[complex]] | None = None, 
-        startTime: str | None = None,
-        finishTime: str | None = None
+        startTime: str | float | None = None,
+        finishTime: str | float | None = None,
+        singlePrecision: bool = False
     ):
-        self.timeStamps = np.asarray(timeStamp)
-        self.frequencies = np.asarray(frequencies).ravel()  # list[float]
-        if realParts and imagParts:
-            self.impedances = np.asarray([[complex(realParts[i][x], imagParts[i][x]) for x in range(len(frequencies))] for i in range(len(electrodes))]) # list[list[complex]]
-            self.realParts = np.asarray(realParts)
-            self.imagParts = np.asarray(imagParts)
-        elif impedances:
-            self.realParts = np.asarray([[impedances[i][x].real for x in range(len(frequencies))] for i in range(len(electrodes))])
-            self.imagParts = np.asarray([[impedances[i][x].imag for x in range(len(frequencies))] for i in range(len(electrodes))])
-            self.impedances = np.asarray(impedances)         
-        self.electrodes = electrodes
-        self.startTime = startTime
-        self.finishTime = finishTime
-        self.startTimeShort = startTime.split(" ")[1]
-        self.finishTimeShort = finishTime.split(" ")[1]
+        """Creates the container, the arrays are copied because measurement buffers may be reused for the next sweep
+
+        Args:
+            startTime (str | float | None, optional): local start time as ISO text or epoch seconds. Defaults to None.
+            finishTime (str | float | None, optional): local finish time as ISO text or epoch seconds. Defaults to None.
+            singlePrecision (bool, optional): store impedances as complex64 (and derived values as float32), the precision the device sends. False keeps complex128. Defaults to False.
+        """
+        self.axes = SweepAxes.Get(frequencies, electrodes)
+        self.impedanceArray = None
+        self.derivedCache = None
+        dtype = np.complex64 if singlePrecision else np.complex128
+        if realParts is not None and imagParts is not None:
+            combined = np.empty(np.shape(realParts), dtype=dtype) # list[list[complex]]
+            combined.real = realParts
+            combined.imag = imagParts
+            self.impedances = combined
+        elif impedances is not None and len(impedances) > 0:
+            # a copy, np.asarray would keep a view of the caller's buffer if the dtype already matches
+            self.impedances = np.array(impedances, dtype=dtype).reshape(len(electrodes), len(self.frequencies))
+        self.timeStamps = timeStamp
+        self.startEpoch = ParseTime(startTime)
+        self.finishEpoch = ParseTime(finishTime)
         self.measurementIndex = EISData.index
         EISData.index += 1
-        # Debug
-        # print(f"Frequencies: {self.frequencies}")
-        # print(f"Electrodes{self.electrodes}")
-        # print(f"RealPart: {self.realParts}")
-        # print(f"ImagPart: {self.imagParts}")
-        # print(f"Time: {self.timeStamps}")
-        # print(f"Impedance: {self.impedances}")
-        # print(f"StartTime: {self.startTime}")
-        # print(f"FinishTime: {self.finishTime}")
+
+    # ------------------------------------------------------------------ #
+    #  Axes, time stamps and times                                       #
+    # ------------------------------------------------------------------ #
+    @property
+    def frequencies(self) -> np.ndarray:
+        return self.axes.frequencies
+
+    @property
+    def electrodes(self) -> tuple[tuple[int, ...], ...]:
+        return self.axes.electrodes
+
+    @property
+    def timeStamps(self) -> np.ndarray:
+        """Measurement time of every point in seconds after the start time (channels, frequencies), NaN if the device did not send time stamps
+        """
+        if self.timeStampArray is None:
+            return MissingTimeStamps(np.shape(self.impedances))
+        return self.timeStampArray
+
+    @timeStamps.setter
+    def timeStamps(self, timeStamps:np.ndarray | None):
+        # copied, since the measurement buffer is reused; a sweep without device time stamps stores none
+        timeStamps = None if timeStamps is None else np.array(timeStamps, dtype=np.float64)
+        self.timeStampArray = None if timeStamps is None or np.isnan(timeStamps).all() else timeStamps
+
+    @property
+    def hasTimeStamps(self) -> bool:
+        """True if the device sent time stamps for this sweep
+        """
+        return self.timeStampArray is not None
+
+    @property
+    def startTime(self) -> str:
+        return FormatTime(self.startEpoch)
+
+    @startTime.setter
+    def startTime(self, startTime:str | float | None):
+        self.startEpoch = ParseTime(startTime)
+
+    @property
+    def finishTime(self) -> str:
+        return FormatTime(self.finishEpoch)
+
+    @finishTime.setter
+    def finishTime(self, finishTime:str | float | None):
+        self.finishEpoch = ParseTime(finishTime)
+
+    @property
+    def startTimeShort(self) -> str:
+        return FormatTime(self.startEpoch, short=True)
+
+    @property
+    def finishTimeShort(self) -> str:
+        return FormatTime(self.finishEpoch, short=True)
+
+    # ------------------------------------------------------------------ #
+    #  Impedances, read only so cached derived values can not become stale #
+    # ------------------------------------------------------------------ #
+    @property
+    def impedances(self) -> np.ndarray | None:
+        return self.impedanceArray
+
+    @impedances.setter
+    def impedances(self, impedances:np.ndarray | None):
+        if impedances is not None:
+            # read only view, the array of the caller stays writable
+            impedances = np.asarray(impedances).view()
+            impedances.flags.writeable = False
+        self.impedanceArray = impedances
+        self.Invalidate()
+
+    @property
+    def realParts(self) -> np.ndarray:
+        return self.impedances.real
+
+    @property
+    def imagParts(self) -> np.ndarray:
+        return self.impedances.imag
+
+    def Invalidate(self):
+        """Drops the cached derived values, needed only if the impedance array was changed in place
+        """
+        self.derivedCache = None
+
+    def Derived(self, name:str, compute) -> np.ndarray:
+        """Returns the cached derived array name, compute() creates it on first use
+
+        Args:
+            name (str): name of the derived value
+            compute (_type_): function without arguments computing the value
+
+        Returns:
+            np.ndarray: read only derived array
+        """
+        if self.derivedCache is None:
+            self.derivedCache = {}
+        value = self.derivedCache.get(name)
+        if value is None:
+            value = compute()
+            value.flags.writeable = False
+            self.derivedCache[name] = value
+        return value
 
     # ------------------------------------------------------------------ #
     #  Helper: |Z|, Phase, Admittance                                    #
     # ------------------------------------------------------------------ #
     @property
     def magnitudesZ(self) -> np.ndarray:
-        return np.abs(self.impedances)
+        return self.Derived("magnitudesZ", lambda: np.abs(self.impedances))
 
     @property
     def phasesZ(self) -> np.ndarray:
-        return np.angle(self.impedances, deg=True)
+        return self.Derived("phasesZ", lambda: np.angle(self.impedances, deg=True))
 
     @property
     def admittances(self) -> np.ndarray:
-        with np.errstate(divide="ignore", invalid="ignore"):
-            y = 1.0 / self.impedances
-            y[np.isinf(y)] = np.nan
-        return y
+        return self.Derived("admittances", lambda: Admittances(self.impedances))
     
     @property
     def magnitudesY(self) -> np.ndarray:
-        return np.abs(self.admittances)
+        return self.Derived("magnitudesY", lambda: np.abs(self.admittances))
     
     @property
     def phasesY(self) -> np.ndarray:
-        return np.angle(self.admittances, deg=True)
+        return self.Derived("phasesY", lambda: np.angle(self.admittances, deg=True))
 
     def SaveToDataframe(self) -> pd.DataFrame:
-    
-        dfRows = []
-        for elIndex, elComb in enumerate(self.electrodes):
-            for freqIndex, frequency in enumerate(self.frequencies):
-                dfRows.append([self.measurementIndex, str(elComb), frequency, self.impedances[elIndex][freqIndex], self.timeStamps[elIndex][freqIndex], self.startTime, self.finishTime])
-        return pd.DataFrame(dfRows, columns=["MeasurementIndex", "Electrodes", "Frequency", "Impedance", "Timestamp", "StartTime", "FinishTime"])
+        """One row per electrode combination and frequency, electrode combinations vary slowest
+        """
+        numElectrodes, numFrequencies = self.impedances.shape
+        return pd.DataFrame({"MeasurementIndex": self.measurementIndex,
+                             "Electrodes": np.repeat([str(list(elComb)) for elComb in self.electrodes], numFrequencies),
+                             "Frequency": np.tile(self.frequencies, numElectrodes),
+                             "Impedance": self.impedances.astype(np.complex128).ravel(),
+                             "Timestamp": np.asarray(self.timeStamps).ravel(),
+                             "StartTime": FormatTime(self.startEpoch, timespec="milliseconds"),
+                             "FinishTime": FormatTime(self.finishEpoch, timespec="milliseconds")})
+
+def Admittances(impedances:np.ndarray) -> np.ndarray:
+    """1 / Z, NaN where Z is zero
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = 1.0 / np.asarray(impedances)
+        y[np.isinf(y)] = np.nan
+    return y
 
 def LoadFromDataframe(df:pd.DataFrame) -> EISData:
+    """Creates the EISData of one measurement from its rows (see EISData.SaveToDataframe)
+    """
     
-    electrodes = list(set(df["Electrodes"].to_list()))
-    electrodes = [ast.literal_eval(electrodes[i]) for i in range(len(electrodes))]
-    frequencies = list(set(df["Frequency"].to_list()))
-    impedances = [list(map(complex, df["Impedance"].to_list()[i:i+len(frequencies)])) for i in range(0, df.shape[0], len(frequencies))]
-    timestamps = [df["Timestamp"].to_list()[i:i+len(frequencies)] for i in range(0, df.shape[0], len(frequencies))]
-    startTime = df["StartTime"][0]
-    finishTime = df["FinishTime"][0]
+    return LoadMeasurements(df)[0]
+
+def LoadMeasurements(df:pd.DataFrame) -> list[EISData]:
+    """Creates the EISData of every measurement in a frame with the columns of EISData.SaveToDataframe
+
+    Electrode combinations and frequencies get ordinal codes for the whole frame in order of their first
+    appearance, so the axes keep the order of the file and every row is placed by its codes. Missing points are NaN.
+
+    Args:
+        df (pd.DataFrame): rows of one or more measurements
+
+    Returns:
+        list[EISData]: measurements in order of their first row
+    """
+    
+    electrodeCodes, electrodeTexts = pd.factorize(df["Electrodes"])
+    frequencyCodes, frequencyValues = pd.factorize(df["Frequency"].astype(np.float64))
+    measurementCodes, measurementIndices = pd.factorize(df["MeasurementIndex"])
+    electrodes = [ast.literal_eval(text) for text in electrodeTexts]
+    frequencyValues = np.asarray(frequencyValues)
+    
+    impedanceColumn = df["Impedance"].to_numpy()
+    if impedanceColumn.dtype.kind != "c":
+        # "(1+2j)" text read from csv
+        impedanceColumn = np.fromiter(map(complex, impedanceColumn), dtype=np.complex128, count=len(impedanceColumn))
+    timestampColumn = pd.to_numeric(df["Timestamp"], errors="coerce").to_numpy(dtype=np.float64)
+    startTimes = df["StartTime"].to_numpy()
+    finishTimes = df["FinishTime"].to_numpy()
+    
+    # rows grouped by measurement, stable so the rows of a measurement keep their order
+    order = np.argsort(measurementCodes, kind="stable")
+    boundaries = np.searchsorted(measurementCodes[order], np.arange(len(measurementIndices) + 1))
+    
+    dataList = []
+    for measurement, (first, last) in enumerate(zip(boundaries[:-1], boundaries[1:])):
+        rows = order[first:last]
+        # axes of this measurement in order of appearance, local codes index into them
+        rowElectrodes, electrodeAxis = pd.factorize(electrodeCodes[rows])
+        rowFrequencies, frequencyAxis = pd.factorize(frequencyCodes[rows])
+        
+        impedances = np.full((len(electrodeAxis), len(frequencyAxis)), np.nan, dtype=np.complex128)
+        impedances[rowElectrodes, rowFrequencies] = impedanceColumn[rows]
+        timestamps = np.full(impedances.shape, np.nan)
+        timestamps[rowElectrodes, rowFrequencies] = timestampColumn[rows]
+        
+        data =  EISData( timeStamp=timestamps, 
+                        frequencies=frequencyValues[frequencyAxis], 
+                        electrodes=[electrodes[code] for code in electrodeAxis], 
+                        impedances=impedances, 
+                        startTime=startTimes[rows[0]],
+                        finishTime=finishTimes[rows[0]])
+        data.measurementIndex = measurementIndices[measurement]
+        dataList.append(data)
     
-    data =  EISData( timeStamp=timestamps, 
-                    frequencies=frequencies, 
-                    electrodes=electrodes, 
-                    impedances=impedances, 
-                    startTime=startTime,
-                    finishTime=finishTime)
-    data.measurementIndex = df["MeasurementIndex"][0]
+    return dataList
+
+def SaveCsv(path:str, dataList:Iterable[EISData]):
+    """Writes measurements to a csv file readable by LoadCsv, one measurement at a time
+
+    Args:
+        path (str): path of the csv file
+        dataList (Iterable[EISData]): measurements in measurement order, they may differ in their settings
+    """
+
+    with open(path, "w", newline="") as file:
+        header = True
+        for data in dataList:
+            data.SaveToDataframe().to_csv(file, index=False, header=header)
+            header = False
+
+def LoadCsv(path:str) -> list[EISData]:
+    """Loads all measurements of a csv file written from EISData.SaveToDataframe
+
+    Args:
+        path (str): path of the csv file
+
+    Returns:
+        list[EISData]: measurements in file order
+    """
     
-    return data
\ No newline at end of file
+    return LoadMeasurements(pd.read_csv(path))
@@ -0,0 +1,552 @@
+"""
+DeviceEmulator.py
+Emulates an ISX-3 on a TCP socket or pseudo terminal, speaking the binary protocol used by ImpedanceAnalyser.
+
+    python DeviceEmulator.py --tcp 5000
+    python DeviceEmulator.py --pty --latency 0.001
+"""
+import argparse, logging, math, os, socket, struct, threading, time
+import numpy as np
+
+logger = logging.getLogger("heartImpedance.emulator")
+
+ACK_SYNTAX = 0x01
+ACK_NOT_EXECUTED = 0x81
+ACK_UNKNOWN = 0x82
+ACK_OK = 0x83
+
+class DeviceEmulator():
+    """Protocol state machine of one ISX-3 with an RC circuit as device under test
+
+    Every electrode combination measures the circuit R0 + (R1 || C1), scaled by (1 + channelSpread * channel index),
+    so the channels can be told apart. Received bytes are passed to Feed, all answers go to the send callable
+    given to Connect.
+    """
+
+    def __init__(self, pointLatency:float = 0.0, r0:float = 100.0, r1:float = 1000.0, c1:float = 1e-6, channelSpread:float = 0.01, noise:float = 0.0, seed:int | None = None):
+        """Constructor
+
+        Args:
+            pointLatency (float, optional): time in seconds needed for one frequency point. Defaults to 0.0.
+            r0 (float, optional): series resistance in Ohm. Defaults to 100.0.
+            r1 (float, optional): parallel resistance in Ohm. Defaults to 1000.0.
+            c1 (float, optional): parallel capacitance in F. Defaults to 1e-6.
+            channelSpread (float, optional): relative impedance change from one electrode combination to the next. Defaults to 0.01.
+            noise (float, optional): relative standard deviation of gaussian noise added to every point. Defaults to 0.0.
+            seed (int | None, optional): seed of the noise generator. Defaults to None.
+        """
+
+        self.pointLatency = pointLatency
+        self.r0 = r0
+        self.r1 = r1
+        self.c1 = c1
+        self.channelSpread = channelSpread
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.send = None
+        self.connection = None
+        self.buffer = bytearray()
+        self.sendLock = threading.Lock()
+        self.measureThread = None
+        self.stopEvent = threading.Event()
+
+        self.commands = {
+            0x90: self.SaveSettings,
+            0x97: self.SetOptions,
+            0x98: self.GetOptions,
+            0xA1: self.ResetSystem,
+            0xB0: self.SetFeSettings,
+            0xB1: self.GetFeSettings,
+            0xB2: self.SetExtensionPortChannel,
+            0xB3: self.GetExtensionPortChannel,
+            0xB5: self.GetExtensionPortModule,
+            0xB6: self.SetSetup,
+            0xB7: self.GetSetup,
+            0xB8: self.StartStopMeasure,
+            0xB9: self.SetSyncTime,
+            0xBA: self.GetSyncTime,
+            0xBD: self.SetEthernetConfiguration,
+            0xBE: self.GetEthernetConfiguration,
+            0xCF: self.TCPConnectionWatchdog,
+            0xD0: self.GetARMFirmwareID,
+            0xD1: self.GetDeviceID,
+            0xD2: self.GetFPGAFirmwareID,
+        }
+
+        self.Reset()
+        self.ipAddress = [192, 168, 0, 10]
+        self.dhcp = False
+        self.watchdogInterval = 0
+
+
+    def Reset(self):
+        """Power on state of the device
+        """
+
+        self.frequencies = np.zeros(0)
+        self.fscale = 0
+        self.precision = 1.0
+        self.amplitude = 0.01
+        self.excitation = 0x01
+        self.feMode = 0x02
+        self.feChannel = 0x01
+        self.feRange = 0x01
+        self.channels = []
+        self.timeStamp = 0
+        self.currentRange = False
+        self.syncTime = 0
+
+    #region Connection
+    def Connect(self, send):
+        """Sets the function answers are written with, e.g. socket.sendall
+
+        Args:
+            send (_type_): callable taking bytes
+        """
+
+        self.StopMeasurement()
+        self.send = send
+        self.buffer.clear()
+
+
+    def Send(self, data:bytes):
+        with self.sendLock:
+            if self.send is not None:
+                self.send(data)
+
+
+    def Ack(self, code:int = ACK_OK):
+        self.Send(bytes([0x18, 0x01, code, 0x18]))
+
+
+    def Reply(self, ct:int, data:bytes):
+        self.Send(bytes([ct, len(data)]) + data + bytes([ct]))
+
+
+    def Feed(self, data:bytes):
+        """Processes received bytes, complete command frames are executed
+
+        Args:
+            data (bytes): bytes received from the host
+        """
+
+        self.buffer += data
+        while len(self.buffer) >= 2 and len(self.buffer) >= self.buffer[1] + 3:
+            frameLength = self.buffer[1] + 3
+            frame = bytes(self.buffer[:frameLength])
+            del self.buffer[:frameLength]
+
+            if frame[0] != frame[-1]:
+                logger.warning("Malformed command: %s", frame.hex(" "))
+                self.Ack(ACK_SYNTAX)
+                continue
+
+            handler = self.commands.get(frame[0])
+            if handler is None:
+                self.Ack(ACK_UNKNOWN)
+                continue
+
+            logger.debug("Command %s", frame.hex(" "))
+            handler(frame[2:-1])
+    #endregion
+
+    #region Commands
+    def SaveSettings(self, data:bytes):
+        self.Ack()
+
+
+    def SetOptions(self, data:bytes):
+        if len(data) != 2:
+            return self.Ack(ACK_SYNTAX)
+
+        match data[0]:
+            case 0x01:
+                self.timeStamp = 1 if data[1] else 0
+            case 0x02:
+                self.timeStamp = 2 if data[1] else 0
+            case 0x04:
+                self.currentRange = bool(data[1])
+            case _:
+                return self.Ack(ACK_NOT_EXECUTED)
+        self.Ack()
+
+
+    def GetOptions(self, data:bytes):
+        if len(data) != 1:
+            return self.Ack(ACK_SYNTAX)
+
+        match data[0]:
+            case 0x01:
+                self.Reply(0x98, bytes([0x01, self.timeStamp]))
+            case 0x04:
+                self.Reply(0x98, bytes([0x04, int(self.currentRange)]))
+            case _:
+                return self.Ack(ACK_NOT_EXECUTED)
+        self.Ack()
+
+
+    def ResetSystem(self, data:bytes):
+        self.StopMeasurement()
+        self.Reset()
+        self.Ack()
+
+
+    def SetFeSettings(self, data:bytes):
+        if len(data) != 3:
+            return self.Ack(ACK_SYNTAX)
+
+        if data == bytes([0xFF, 0xFF, 0xFF]):
+            self.channels = []
+        else:
+            self.feMode, self.feChannel, self.feRange = data
+        self.Ack()
+
+
+    def GetFeSettings(self, data:bytes):
+        self.Reply(0xB1, bytes([self.feMode, self.feChannel, self.feRange]))
+        self.Ack()
+
+
+    def SetExtensionPortChannel(self, data:bytes):
+        if len(data) != 4:
+            return self.Ack(ACK_SYNTAX)
+        if len(self.channels) >= 128:
+            return self.Ack(ACK_NOT_EXECUTED)
+
+        self.channels.append(bytes(data))
+        self.Ack()
+
+
+    def GetExtensionPortChannel(self, data:bytes):
+        for first in range(0, len(self.channels), 63):
+            self.Reply(0xB3, b"".join(self.channels[first:first + 63]))
+        self.Ack()
+
+
+    def GetExtensionPortModule(self, data:bytes):
+        # external Mux32Any2Any2202 with 32 channels, no internal module
+        self.Reply(0xB5, bytes([0x09, 0x00, 0x00, 0x20]))
+        self.Ack()
+
+
+    def SetSetup(self, data:bytes):
+        if len(data) == 1 and data[0] == 0x01:
+            self.frequencies = np.zeros(0)
+            return self.Ack()
+
+        if len(data) < 22 or data[0] != 0x03:
+            return self.Ack(ACK_SYNTAX)
+
+        fmin, fmax, fnum = struct.unpack(">fff", data[1:13])
+        self.fscale = data[13]
+        self.precision, self.amplitude = struct.unpack(">ff", data[14:22])
+        self.excitation = data[-1]
+
+        fnum = int(fnum)
+        if fnum < 1 or fmin <= 0 or fmax < fmin:
+            return self.Ack(ACK_NOT_EXECUTED)
+        if self.fscale == 0:
+            frequencies = np.linspace(fmin, fmax, fnum)
+        else:
+            frequencies = np.geomspace(fmin, fmax, fnum)
+        self.frequencies = np.concatenate((self.frequencies, frequencies))
+        self.Ack()
+
+
+    def GetSetup(self, data:bytes):
+        if len(data) == 0:
+            return self.Ack(ACK_SYNTAX)
+
+        match data[0]:
+            case 0x01:
+                self.Reply(0xB7, bytes([0x01]) + len(self.frequencies).to_bytes(2, "big"))
+            case 0x02:
+                index = int.from_bytes(data[1:3], "big")
+                if index >= len(self.frequencies):
+                    return self.Ack(ACK_NOT_EXECUTED)
+                self.Reply(0xB7, bytes([0x02]) + struct.pack(">fff", self.frequencies[index], self.precision, self.amplitude))
+            case 0x04:
+                for first in range(0, len(self.frequencies), 63):
+                    self.Reply(0xB7, bytes([0x04]) + self.frequencies[first:first + 63].astype(">f4").tobytes())
+            case 0x20:
+                pass
+            case 0x33:
+                self.Reply(0xB7, bytes([0x33]) + struct.pack(">f", 0.0))
+            case _:
+                return self.Ack(ACK_NOT_EXECUTED)
+        self.Ack()
+
+
+    def StartStopMeasure(self, data:bytes):
+        if len(data) == 1 and data[0] == 0x00:
+            self.StopMeasurement()
+            return self.Ack()
+
+        if len(data) != 3 or data[0] != 0x01:
+            return self.Ack(ACK_SYNTAX)
+        if len(self.frequencies) == 0 or (self.feChannel != 0x01 and len(self.channels) == 0):
+            return self.Ack(ACK_NOT_EXECUTED)
+
+        self.StopMeasurement()
+        self.Ack()
+        repetitions = int.from_bytes(data[1:3], "big")
+        self.measureThread = threading.Thread(target=self.Measure, args=(repetitions,), name="EmulatorMeasure", daemon=True)
+        self.measureThread.start()
+
+
+    def SetSyncTime(self, data:bytes):
+        if len(data) != 4:
+            return self.Ack(ACK_SYNTAX)
+
+        self.syncTime = int.from_bytes(data, "big")
+        self.Ack()
+
+
+    def GetSyncTime(self, data:bytes):
+        self.Reply(0xBA, self.syncTime.to_bytes(4, "big"))
+        self.Ack()
+
+
+    def SetEthernetConfiguration(self, data:bytes):
+        match data[:1]:
+            case b"\x01" if len(data) == 5:
+                self.ipAddress = list(data[1:5])
+            case b"\x03" if len(data) == 2:
+                self.dhcp = bool(data[1])
+            case _:
+                return self.Ack(ACK_SYNTAX)
+        self.Ack()
+
+
+    def GetEthernetConfiguration(self, data:bytes):
+        match data[:1]:
+            case b"\x01":
+                self.Reply(0xBE, bytes([0x01] + self.ipAddress))
+            case b"\x02":
+                self.Reply(0xBE, bytes([0x02, 0x00, 0x1A, 0x2B, 0x3C, 0x4D, 0x5E]))
+            case b"\x03":
+                self.Reply(0xBE, bytes([0x03, int(self.dhcp)]))
+            case _:
+                return self.Ack(ACK_SYNTAX)
+        self.Ack()
+
+
+    def TCPConnectionWatchdog(self, data:bytes):
+        if len(data) != 5:
+            return self.Ack(ACK_SYNTAX)
+
+        self.watchdogInterval = int.from_bytes(data[1:5], "big")
+        self.Ack()
+
+
+    def GetARMFirmwareID(self, data:bytes):
+        self.Reply(0xD0, bytes([0x00, 0x00]) + (1).to_bytes(2, "big") + (100).to_bytes(2, "big"))
+        self.Ack()
+
+
+    def GetDeviceID(self, data:bytes):
+        # version, device identifier, serial number, years since 2010 of delivery
+        self.Reply(0xD1, bytes([0x01]) + (0x0003).to_bytes(2, "big") + (1).to_bytes(2, "big") + (14).to_bytes(2, "big"))
+        self.Ack()
+
+
+    def GetFPGAFirmwareID(self, data:bytes):
+        self.Reply(0xD2, bytes(5) + (1).to_bytes(2, "big") + (100).to_bytes(2, "big"))
+        self.Ack()
+    #endregion
+
+    #region Measurement
+    def ResultDtype(self) -> np.dtype:
+        """Layout of one result frame for the current options, see ImpedanceAnalyser.GetResultDtype
+        """
+
+        fields = [("ct", "u1"), ("le", "u1"), ("frequencyIndex", ">u2")]
+        if self.timeStamp == 1:
+            fields.append(("timeStamp", ">u4"))
+        elif self.timeStamp == 2:
+            fields.append(("timeStamp", "u1", (5,)))
+        if self.currentRange:
+            fields.append(("currentRange", "u1"))
+        fields += [("real", ">f4"), ("imag", ">f4"), ("ctEnd", "u1")]
+
+        return np.dtype(fields)
+
+
+    def ModelImpedance(self, channel:int) -> np.ndarray:
+        """Impedance of the RC circuit at all frequencies of the setup
+
+        Args:
+            channel (int): index of the electrode combination
+
+        Returns:
+            np.ndarray: complex impedances
+        """
+
+        omega = 2 * math.pi * self.frequencies
+        impedance = (self.r0 + self.r1 / (1 + 1j * omega * self.r1 * self.c1)) * (1 + self.channelSpread * channel)
+        if self.noise > 0:
+            impedance = impedance * (1 + self.noise * (self.rng.standard_normal(len(impedance)) + 1j * self.rng.standard_normal(len(impedance))))
+
+        return impedance
+
+
+    def Measure(self, repetitions:int):
+        """Sends the result frames of repetitions sweeps over the channel list, 0 repeats until stopped
+        """
+
+        dtype = self.ResultDtype()
+        numFrequencies = len(self.frequencies)
+        channels = self.channels if self.feChannel != 0x01 else [bytes(4)]
+
+        frames = np.zeros(numFrequencies, dtype=dtype)
+        frames["ct"] = 0xB8
+        frames["le"] = dtype.itemsize - 3
+        frames["ctEnd"] = 0xB8
+        frames["frequencyIndex"] = np.arange(numFrequencies)
+        if self.currentRange:
+            frames["currentRange"] = self.feRange
+        impedances = [self.ModelImpedance(channel) for channel in range(len(channels))]
+
+        # sync time delays the first point after the start command
+        startTime = time.perf_counter() + self.syncTime * 1e-6
+        pointIndex = 0
+        sweep = 0
+        while (repetitions == 0 or sweep < repetitions) and not self.stopEvent.is_set():
+            for channel in range(len(channels)):
+                # virtual time of every point, so the time stamps do not depend on the scheduling of this thread
+                pointTimes = (pointIndex + np.arange(numFrequencies)) * self.pointLatency
+                finishTime = startTime + pointTimes[-1] + self.pointLatency
+                if self.stopEvent.wait(max(0.0, finishTime - time.perf_counter())):
+                    return
+                if self.pointLatency == 0:
+                    pointTimes = np.full(numFrequencies, time.perf_counter() - startTime)
+
+                if self.noise > 0:
+                    impedances[channel] = self.ModelImpedance(channel)
+                frames["real"] = impedances[channel].real
+                frames["imag"] = impedances[channel].imag
+                if self.timeStamp == 1:
+                    frames["timeStamp"] = (pointTimes * 1e3).astype(np.uint32)
+                elif self.timeStamp == 2:
+                    microseconds = (pointTimes * 1e6).astype(">u8").view(np.uint8).reshape(-1, 8)
+                    frames["timeStamp"] = microseconds[:, 3:]
+
+                try:
+                    self.Send(frames.tobytes())
+                except OSError:
+                    return
+                pointIndex += numFrequencies
+            sweep += 1
+
+
+    def StopMeasurement(self):
+        """Stops a running measurement, frames already sent stay in the stream
+        """
+
+        if self.measureThread is not None and self.measureThread is not threading.current_thread():
+            self.stopEvent.set()
+            self.measureThread.join()
+        self.measureThread = None
+        self.stopEvent.clear()
+    #endregion
+
+    #region Servers
+    def ServeTcp(self, host:str = "127.0.0.1", port:int = 0, ready:threading.Event | None = None):
+        """Accepts one host connection after the other and serves it until it is closed, blocks forever
+
+        Args:
+            host (str, optional): address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): port to listen on, 0 picks a free one (see self.port). Defaults to 0.
+            ready (threading.Event | None, optional): set once the socket is listening. Defaults to None.
+        """
+
+        with socket.create_server((host, port)) as server:
+            self.port = server.getsockname()[1]
+            logger.info("Emulator listening on %s:%d", host, self.port)
+            if ready is not None:
+                ready.set()
+
+            while True:
+                connection, address = server.accept()
+                logger.info("Host connected from %s:%d", *address[:2])
+                with connection:
+                    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.connection = connection
+                    self.Connect(connection.sendall)
+                    while True:
+                        try:
+                            data = connection.recv(65536)
+                        except OSError:
+                            break
+                        if not data:
+                            break
+                        self.Feed(data)
+                self.connection = None
+                self.Connect(None)
+
+
+    def DropConnection(self, powerCycle:bool = False):
+        """Closes the current TCP connection from the device side, like a network outage
+
+        Args:
+            powerCycle (bool, optional): also restore the power-on state, like a device restart. Defaults to False.
+        """
+
+        connection = self.connection
+        if powerCycle:
+            self.Reset()
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+    def OpenPty(self) -> str:
+        """Creates a pseudo terminal served by a background thread, POSIX only
+
+        Returns:
+            str: path of the terminal to open as serial port, e.g. ImpedanceAnalyser(path)
+        """
+
+        import pty, tty
+
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        path = os.ttyname(slave)
+
+        def Serve():
+            self.Connect(lambda data: os.write(master, data))
+            while True:
+                try:
+                    data = os.read(master, 65536)
+                except OSError:
+                    break
+                self.Feed(data)
+
+        # the slave end is kept open, so reading the master does not fail while no host has the port open
+        self.ptySlave = slave
+        threading.Thread(target=Serve, name="EmulatorPty", daemon=True).start()
+        logger.info("Emulator listening on %s", path)
+
+        return path
+    #endregion
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ISX-3 device emulator")
+    parser.add_argument("--tcp", type=int, metavar="PORT", help="listen on this TCP port")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on for --tcp")
+    parser.add_argument("--pty", action="store_true", help="create a pseudo terminal instead")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per frequency point")
+    parser.add_argument("--noise", type=float, default=0.0, help="relative noise of the impedances")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
+    emulator = DeviceEmulator(pointLatency=args.latency, noise=args.noise)
+    if args.pty:
+        print(emulator.OpenPty(), flush=True)
+        threading.Event().wait()
+    else:
+        emulator.ServeTcp(args.host, args.tcp if args.tcp is not None else 0)
@@ -0,0 +1,201 @@
+import time
+import numpy as np
+
+class FrameReader():
+    """Buffered reader that splits the byte stream of the device into [CT, LE, data..., CT] frames
+
+    All bytes waiting at the device are read in one call into a reusable bytearray. Frames are handed
+    out as memoryviews into this buffer, they stay valid until the next call to the reader.
+    """
+
+    def __init__(self, device, bufferSize:int = 65536):
+        """Constructor
+
+        Args:
+            device (_type_): opened device with read(n) and in_waiting, e.g. serial.Serial
+            bufferSize (int, optional): size of the receive buffer in bytes, must hold at least one frame. Defaults to 65536.
+        """
+
+        self.device = device
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.readPos = 0
+        self.writePos = 0
+        # optional ProtocolTrace.CaptureFile receiving every chunk read from the device
+        self.capture = None
+        # optional Metrics.Metrics counting received bytes and frames
+        self.metrics = None
+
+
+    def Clear(self):
+        """Drops all buffered bytes, e.g. after the device was reopened
+        """
+
+        self.readPos = 0
+        self.writePos = 0
+
+
+    def Available(self) -> int:
+        """Number of buffered bytes not handed out yet
+        """
+
+        return self.writePos - self.readPos
+
+
+    def Reserve(self, minBytes:int = 1) -> int:
+        """Makes room for new bytes at the end of the buffer
+
+        Args:
+            minBytes (int, optional): number of bytes that are about to be added. Defaults to 1.
+
+        Returns:
+            int: number of bytes that can be added with Feed
+        """
+
+        # Move the unread rest to the front when running out of space, frames handed out before are invalid afterwards
+        if self.readPos == self.writePos:
+            self.Clear()
+        elif len(self.buffer) - self.writePos < max(minBytes, 258):
+            remaining = self.Available()
+            self.buffer[:remaining] = self.buffer[self.readPos:self.writePos]
+            self.readPos = 0
+            self.writePos = remaining
+
+        return len(self.buffer) - self.writePos
+
+
+    def Feed(self, data:bytes):
+        """Appends received bytes, Reserve must have made room for them before
+
+        Args:
+            data (bytes): bytes received from the device
+        """
+
+        if self.capture is not None:
+            self.capture.Write(self.capture.RX, data)
+        if self.metrics is not None:
+            self.metrics.Increment("bytesIn", len(data))
+
+        self.buffer[self.writePos:(self.writePos + len(data))] = data
+        self.writePos += len(data)
+
+
+    def Fill(self, minBytes:int = 1) -> int:
+        """Reads all bytes waiting at the device into the buffer
+
+        Args:
+            minBytes (int, optional): number of bytes to block for, 0 only takes what is already waiting. Defaults to 1.
+
+        Raises:
+            Exception: Thrown if the device returned less than minBytes bytes (read timeout)
+
+        Returns:
+            int: number of bytes read
+        """
+
+        numBytes = min(max(self.device.in_waiting, minBytes), self.Reserve(minBytes))
+        if numBytes == 0:
+            return 0
+
+        if self.metrics is not None:
+            readStart = time.perf_counter()
+        data = self.device.read(numBytes)
+        if self.metrics is not None:
+            self.metrics.Observe("serialWait", time.perf_counter() - readStart)
+        self.Feed(data)
+        if len(data) < minBytes:
+            raise Exception(f"Timeout: received {len(data)} of {minBytes} requested bytes.")
+
+        return len(data)
+
+
+    def Require(self, numBytes:int):
+        """Blocks until at least numBytes unread bytes are buffered
+        """
+
+        while self.Available() < numBytes:
+            self.Fill(numBytes - self.Available())
+
+
+    def NextFrameLength(self) -> int:
+        """Length of the next frame, blocking until its header is received
+        """
+
+        self.Require(2)
+        return self.buffer[self.readPos + 1] + 3
+
+
+    def NextFrame(self) -> memoryview:
+        """Returns the next frame, blocking until it is completely received
+
+        Raises:
+            Warning: Thrown if the closing CT byte does not match the opening one
+
+        Returns:
+            memoryview: frame including CT, LE and closing CT, valid until the next call to the reader
+        """
+
+        frameLength = self.NextFrameLength()
+        self.Require(frameLength)
+
+        frame = self.view[self.readPos:(self.readPos + frameLength)]
+        if frame[0] != frame[-1]:
+            # Skip a single byte so the next call can resynchronise
+            self.readPos += 1
+            raise Warning("Malformed message received.")
+
+        self.readPos += frameLength
+        if self.metrics is not None:
+            self.metrics.Increment("frames")
+        return frame
+
+
+    def NextResultBlock(self, maxFrames:int, frameLength:int) -> tuple[memoryview, int]:
+        """Returns as many consecutive result frames of a fixed length as are buffered, at least one
+
+        Args:
+            maxFrames (int): maximal number of result frames to return
+            frameLength (int): length of one result frame in bytes
+
+        Returns:
+            tuple[memoryview, int]: (frames, number of result frames), if the next frame is no result frame (e.g. acknowledge) it is returned alone with count 0
+        """
+
+        if self.NextFrameLength() != frameLength:
+            return self.NextFrame(), 0
+
+        numFrames = min(maxFrames, self.Available() // frameLength)
+        if numFrames == 0:
+            self.Require(frameLength)
+            numFrames = 1
+
+        # Stop in front of the first frame that does not look like a result (acknowledge, malformed)
+        frames = np.frombuffer(self.buffer, dtype=np.uint8, count=numFrames * frameLength, offset=self.readPos).reshape(numFrames, frameLength)
+        ct = frames[0, 0]
+        valid = (frames[:, 0] == ct) & (frames[:, 1] == frameLength - 3) & (frames[:, -1] == ct)
+        if not valid.all():
+            numFrames = int(np.argmin(valid))
+            if numFrames == 0:
+                return self.NextFrame(), 0
+
+        block = self.view[self.readPos:(self.readPos + numFrames * frameLength)]
+        self.readPos += numFrames * frameLength
+        if self.metrics is not None:
+            self.metrics.Increment("frames", numFrames)
+        return block, numFrames
+
+
+    def ReadAvailable(self) -> list[bytes]:
+        """Reads whatever the device has sent so far without blocking
+
+        Returns:
+            list[bytes]: all completely received frames, an incomplete last frame stays buffered
+        """
+
+        self.Fill(0)
+
+        frames = []
+        while self.Available() >= 2 and self.Available() >= self.buffer[self.readPos + 1] + 3:
+            frames.append(bytes(self.NextFrame()))
+
+        return frames
@@ -1,7 +1,16 @@
-import itertools, struct
+import itertools, struct, time
 
 # Helper functions: some conversions and old matlab GenElectrodeConf
 
+# wall clock time minus monotonic clock in ns, taken once so measurement times do not jump with clock adjustments
+wallClockAnchorNs = time.time_ns() - time.monotonic_ns()
+
+def WallClock() -> float:
+    """Current wall clock time in seconds since epoch, measured with the monotonic nanosecond clock
+    """
+    
+    return (wallClockAnchorNs + time.monotonic_ns()) * 1e-9
+
 def GenElectrodeConf(electrodes:list = [], ordered:bool = True) -> list[list[int]]:
     
     if not electrodes:
@@ -1,15 +1,33 @@
-import math, datetime
-import serial
+import math, logging, time
+from collections.abc import Iterator
+import numpy as np
 from EnumClasses import CurrentRange, InjectionType, FrequencyScale, FeMode, FeChannel, TimeStamp, ExternalModule, InternalModule
-from HelperFunctions import GetHexSingle, GetFloatFromBytes, GetFloatResultsFromBytes
-class ImpedanceAnalyser():
-    """Device for handling communication with ScioSpec device
+from HelperFunctions import GetHexSingle, GetFloatFromBytes, WallClock
+from FrameReader import FrameReader
+from Transport import Transport, OpenTransport
+from ProtocolTrace import CaptureFile, logger
+from Metrics import Metrics
+class AnalyserProtocol():
+    """Settings, command encoders, device state cache and result decoding of the ISX-3 without any I/O
+
+    ImpedanceAnalyser and AsyncImpedanceAnalyser add the communication with the device on top of it.
     """
     
     #region Constructor
-    def __init__(self, comPort:str):
-        # communication
-        self.device = serial.Serial(port=comPort, timeout=256000)
+    def __init__(self, reader:FrameReader):
+        """Constructor
+
+        Args:
+            reader (FrameReader): frame buffer the results are read from
+        """
+        
+        self.reader = reader
+        # last configuration acknowledged by the device, used to skip redundant commands
+        self.deviceState = {}
+        # optional raw byte capture, see StartCapture
+        self.capture = None
+        # optional hot path counters and timings, see EnableMetrics
+        self.metrics = None
         self.timeout = 10
         
         # front end settings
@@ -24,6 +42,8 @@ class ImpedanceAnalyser():
         self.amplitude = 0.5
         self.resTimeStamp = TimeStamp.off
         self.resCurrentRange = True
+        # wall clock time in s of the start command that measured each channel, origin of its device time stamps
+        self.channelStarts = np.zeros(0)
         
         # frequency range
         self.fmin = 1e3
@@ -90,8 +110,8 @@ class ImpedanceAnalyser():
     def SetExcitationAmplitude(self, amplitude:float):
         
         self.amplitude = amplitude
-        
-        
+    
+    
     def SetTimeStamp(self, timeStamp:TimeStamp):
         
         if isinstance(timeStamp, TimeStamp):
@@ -127,8 +147,451 @@ class ImpedanceAnalyser():
             for combination in self.muxElConfig:
                 if len(set(combination)) != len(combination):
                     raise Exception(f"Electorde config does not match mode: {self.feMode}")
+    #endregion
+    
+    #region Frames
+    def StartCapture(self, path:str):
+        """Starts writing all raw bytes sent to and received from the device to a capture file
+
+        Args:
+            path (str): path of the capture file, see ProtocolTrace.ReadCapture
+        """
+        
+        self.StopCapture()
+        self.capture = CaptureFile(path)
+        self.reader.capture = self.capture
+    
+    
+    def StopCapture(self):
+        """Stops and closes a running capture
+        """
+        
+        if self.capture is not None:
+            self.reader.capture = None
+            self.capture.Close()
+            self.capture = None
+    
+    
+    def EnableMetrics(self, metrics:Metrics | None):
+        """Attaches a Metrics object recording counters and timings of the communication, None disables the recording
+
+        Args:
+            metrics (Metrics | None): metrics to record into
+        """
+        
+        self.metrics = metrics
+        self.reader.metrics = metrics
+    
+    
+    def InvalidateDeviceState(self):
+        """Forgets the cached device configuration, required after a reset or reconnect
+        """
+        
+        self.deviceState.clear()
+    
+    
+    def FramePayloads(self, msg:bytes) -> list[bytes]:
+        """Splits the concatenated answer frames of SendAndReceive into their data bytes
+
+        Args:
+            msg (bytes): answer of SendAndReceive
+
+        Returns:
+            list[bytes]: data bytes of each frame without CT and LE
+        """
+        
+        payloads = []
+        pos = 0
+        while pos + 2 < len(msg):
+            payloads.append(msg[(pos + 2):(pos + 2 + msg[pos + 1])])
+            pos += msg[pos + 1] + 3
+        
+        return payloads
+    
+    
+    def IsAck(self, msg:bytes) -> bool:
+        
+        if len(msg) == 4 and msg[0] == 0x18 and msg[1] == 0x01 and msg[3] == 0x18:
+            return True
+        
+        return False
+    
+    
+    def WarningACK(self, ack:int):
+        
+        match ack:
+            case 0x01:
+                raise Exception("Ack: 0x01 Frame-Not-Acknowledge: Incorrect syntax.")
+            case 0x02:
+                raise Exception("Ack: 0x02 Timeout: Communication-timeout (less data than expected).")
+            case 0x04:
+                logger.info("Ack: 0x04 Wake-Up Message: System boot ready.")
+            case 0x11:
+                logger.info("Ack: 0x11 TCP-Socket: Valid TCP client-socket connection.")
+            case 0x81:
+                raise Exception("Ack: 0x81 Not-Acknowledge: Command has not been executed.")
+            case 0x82:
+                raise Exception("Ack: 0x82 Not-Acknowledge: Command could not be recognized.")
+            case 0x83:
+                logger.debug("Command-Acknowledge")
+            case 0x84:
+                logger.info("Ack: 0x84 System-Ready Message: System is operational and ready to receive data.")
+            case 0x90:
+                logger.warning("Ack: 0x90 Overcurrent Detected.")
+            case 0x91:
+                logger.warning("Ack: 0x91 Overvoltage Detected.")
+            case _:
+                logger.warning("ACK: Unknown! Msg: %s", ack)
+    #endregion
+    
+    #region Command encoders
+    def EncodeOptions(self) -> list[bytes]:
+        """0x97 - Set Options - command frames for the current time stamp and current range options
+
+        Raises:
+            ValueError: Timestamp must be from enum class
+
+        Returns:
+            list[bytes]: command frames in sending order
+        """
+        
+        match self.resTimeStamp:
+            case TimeStamp.off:
+                commands = [bytes([0x97, 0x02, 0x01, 0x00, 0x97])]
+            case TimeStamp.ms:
+                commands = [bytes([0x97, 0x02, 0x01, 0x01, 0x97])]
+            case TimeStamp.us:
+                commands = [bytes([0x97, 0x02, 0x02, 0x01, 0x97])]
+            case _:
+                raise ValueError(f"TimeStamp type not recognised: {self.resTimeStamp}")
+        
+        if self.resCurrentRange:
+            commands.append(bytes([0x97, 0x02, 0x04, 0x01, 0x97]))
+        else:
+            commands.append(bytes([0x97, 0x02, 0x04, 0x00, 0x97]))
+        
+        return commands
+    
+    
+    def EncodeFeSettings(self) -> list[bytes]:
+        """0xB0 - Set FE Settings - command frames for the current front end settings
+
+        Returns:
+            list[bytes]: reset frame followed by the settings frame
+        """
+        
+        return [bytes([0xB0, 0x03, 0xFF, 0xFF, 0xFF, 0xB0]), 
+                bytes([0xB0, 0x03, self.feMode.value, self.feChannel.value, self.feRange.value, 0xB0])]
+    
+    
+    def EncodeExtensionPortChannels(self, offsets:range | list[int]) -> list[bytes]:
+        """0xB2 - Set ExtenstionPort Channel - command frames for several channel configurations
+        
+        Args:
+            offsets (range | list[int]): indices of channel configurations to be set, in this order
+        
+        Raises:
+            IndexError: Thrown if an index is out of list bounds
+        
+        Returns:
+            list[bytes]: one command frame per offset
+        """
+        
+        commands = []
+        for offset in offsets:
+            if offset >= len(self.muxElConfig):
+                raise IndexError("There are not enough configurations for this offset.")
+            commands.append(bytes([0xB2, 0x04] + list(self.muxElConfig[offset]) + [0xB2]))
+        
+        return commands
+    
+    
+    def EncodeSetup(self) -> list[bytes]:
+        """0xB6 - Set Setup - command frames for the current frequency and excitation settings
+
+        Returns:
+            list[bytes]: reset frame followed by the frequency list frame
+        """
+        
+        command = bytes([0xB6, 0x25, 0x03])
+
+        if self.fscale is FrequencyScale.linear:
+            freqScale = 0
+        else:
+            freqScale = 1
+        # Required data bytes
+        command += bytes(GetHexSingle(self.fmin) + GetHexSingle(self.fmax) + GetHexSingle(self.fnum) + [freqScale] + GetHexSingle(self.precision) + GetHexSingle(self.amplitude))
+        
+        # Optional data bytes
+        command += bytes([0x01, 0x00, 0x00, 0x00, 0x00, 0x02, 0x00, 0x00, 0x00, 0x00, 0x03, 0x00, 0x00, 0x00])
+        
+        if self.excitation is InjectionType.voltage:
+            command += bytes([0x01])
+        else:
+            command += bytes([0x02])
+            
+        # closing command tag
+        command += bytes([0xB6])
+        
+        return [bytes([0xB6, 0x01, 0x01, 0xB6]), command]
+    
     
+    def EncodeStartMeasure(self, repetitions:int = 1) -> bytes:
+        """0xB8 - Start Measure - command frame
+        
+        Args:
+            repetitions (int, optional): number of sweeps over the channel list, 0 measures continuously until StopMeasure. Defaults to 1.
+        
+        Raises:
+            ValueError: Thrown if repetitions does not fit into two bytes
+        
+        Returns:
+            bytes: command frame
+        """
+        
+        if repetitions < 0 or repetitions > 0xFFFF:
+            raise ValueError("Repetitions need to be between 0 and 65535.")
+        
+        return bytes([0xB8, 0x03, 0x01]) + repetitions.to_bytes(2, "big") + bytes([0xB8])
+    #endregion
+    
+    #region Result processing
+    def GetResultDtype(self) -> np.dtype:
+        """Structured dtype of one result frame for the current timestamp and current range options
+
+        Returns:
+            np.dtype: dtype with fields ct, le, frequencyIndex, [timeStamp], [currentRange], real, imag, ctEnd
+        """
+        
+        fields = [("ct", "u1"), ("le", "u1"), ("frequencyIndex", ">u2")]
+        
+        match self.resTimeStamp:
+            case TimeStamp.ms:
+                fields.append(("timeStamp", ">u4"))
+            case TimeStamp.us:
+                fields.append(("timeStamp", "u1", (5,)))
+        
+        if self.resCurrentRange:
+            fields.append(("currentRange", "u1"))
+        
+        fields += [("real", ">f4"), ("imag", ">f4"), ("ctEnd", "u1")]
+        
+        return np.dtype(fields)
+    
+    
+    def DeserializeResultsBulk(self, results:bytes | bytearray | memoryview, numPoints:int, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Decodes the raw bytes of many result frames at once
+
+        Args:
+            results (bytes | bytearray | memoryview): concatenated result frames, acknowledge frames in between are allowed
+            numPoints (int): number of result frames contained in results
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None, optional): arrays with numPoints elements each to decode into, same order as the return value. Defaults to None.
+
+        Raises:
+            Exception: Thrown if the bytes do not contain numPoints well formed result frames
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (real float32, imag float32, current range uint8, time stamp uint64, warning uint32), each of length numPoints
+        """
+        
+        dtype = self.GetResultDtype()
+        
+        if out is None:
+            out = (np.empty(numPoints, dtype=np.float32), np.empty(numPoints, dtype=np.float32), np.empty(numPoints, dtype=np.uint8), np.empty(numPoints, dtype=np.uint64), np.empty(numPoints, dtype=np.uint32))
+        real, imag, currentRange, timeStamp, warn = out
+        warn[...] = 0
+        
+        if len(results) == numPoints * dtype.itemsize:
+            frames = np.frombuffer(results, dtype=dtype, count=numPoints)
+        else:
+            # Acknowledge frames (e.g. overcurrent warnings) are mixed in, separate them from the results first
+            frameBytes = bytearray()
+            ackWarn = np.zeros(numPoints, dtype=np.uint32)
+            bytePos = 0
+            pointIdx = 0
+            ackWeight = 1
+            while bytePos < len(results) and pointIdx < numPoints:
+                frameEnd = bytePos + results[bytePos + 1] + 3
+                frame = results[bytePos:frameEnd]
+                if self.IsAck(frame):
+                    ackWarn[pointIdx] += frame[2] * ackWeight
+                    ackWeight *= 1000
+                else:
+                    frameBytes += frame
+                    pointIdx += 1
+                    ackWeight = 1
+                bytePos = frameEnd
+            
+            if len(frameBytes) != numPoints * dtype.itemsize:
+                raise Exception(f"Expected {numPoints} result frames of {dtype.itemsize} bytes, received {len(frameBytes)} bytes.")
+            frames = np.frombuffer(frameBytes, dtype=dtype)
+            warn[...] = ackWarn.reshape(warn.shape)
+        
+        if np.any(frames["ct"] != frames["ctEnd"]) or np.any(frames["le"] != dtype.itemsize - 3):
+            raise Exception("Malformed result frame received.")
+        
+        real[...] = frames["real"].reshape(real.shape)
+        imag[...] = frames["imag"].reshape(imag.shape)
+        
+        if self.resCurrentRange:
+            currentRange[...] = frames["currentRange"].reshape(currentRange.shape)
+        else:
+            currentRange[...] = 0
+        
+        match self.resTimeStamp:
+            case TimeStamp.ms:
+                timeStamp[...] = frames["timeStamp"].reshape(timeStamp.shape)
+            case TimeStamp.us:
+                timeStamp[...] = (frames["timeStamp"].astype(np.uint64) @ (np.uint64(1) << np.arange(32, -1, -8, dtype=np.uint64))).reshape(timeStamp.shape)
+            case _:
+                timeStamp[...] = 0
+        
+        return real, imag, currentRange, timeStamp, warn
+    
+    
+    def AllocateResultBuffers(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Allocates result buffers for GetMeasurements matching the current mux configuration and number of frequencies
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (impedances complex64, current range uint8, time stamp uint64, warning uint32), each shaped (channels, frequencies)
+        """
+        
+        shape = (len(self.muxElConfig), self.fnum)
+        
+        return np.zeros(shape, dtype=np.complex64), np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=np.uint64), np.zeros(shape, dtype=np.uint32)
+    
+    
+    def GetFlatResultBuffers(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Checks result buffers against the configuration and returns flat views as used by ReadResults
+
+        Args:
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]): buffers from AllocateResultBuffers
+
+        Raises:
+            ValueError: Thrown if the buffers do not match the current configuration
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (real, imag, current range, time stamp, warning) views in channel major order
+        """
+        
+        shape = (len(self.muxElConfig), self.fnum)
+        if any(result.shape != shape or not result.flags.c_contiguous for result in out):
+            raise ValueError(f"Result buffers must be contiguous arrays of shape {shape}.")
+        
+        resImpedance, resRange, resTime, resWarning = out
+        flatImpedance = resImpedance.reshape(-1)
+        
+        return flatImpedance.real, flatImpedance.imag, resRange.reshape(-1), resTime.reshape(-1), resWarning.reshape(-1)
+    
+    
+    def PointTimes(self, resTime:np.ndarray, startTime:float) -> np.ndarray | None:
+        """Measurement time of every point from the device time stamps of the last sweep
+
+        The device counts its time stamps from the start command of the measured channel chunk, they are placed
+        on the wall clock with the times noted when the start commands were sent.
+
+        Args:
+            resTime (np.ndarray): time stamps (channels, frequencies) in device ticks as returned by GetMeasurements
+            startTime (float): start time of the sweep in seconds since epoch as returned by GetMeasurements
+
+        Returns:
+            np.ndarray | None: seconds after startTime (channels, frequencies), None if time stamps are off
+        """
+        
+        match self.resTimeStamp:
+            case TimeStamp.ms:
+                resolution = 1e-3
+            case TimeStamp.us:
+                resolution = 1e-6
+            case _:
+                return None
+        
+        offsets = self.channelStarts - startTime if len(self.channelStarts) == len(resTime) else np.zeros(len(resTime))
+        
+        return resTime * resolution + offsets[:, None]
+    #endregion
+
+
+class ResultDecoder():
+    """Decodes result frames into flat result arrays block by block, the step shared by the sync and async result loops
+
+    Acknowledge frames between the results (e.g. overcurrent warnings) are added to the warning of the next point.
+    """
     
+    def __init__(self, analyser:AnalyserProtocol, numPoints:int, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]):
+        """Constructor
+
+        Args:
+            analyser (AnalyserProtocol): analyser with the result format and optional metrics
+            numPoints (int): number of result frames to decode
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]): flat arrays (real, imag, current range, time stamp, warning) with numPoints elements each
+        """
+        
+        self.analyser = analyser
+        self.numPoints = numPoints
+        self.out = out
+        self.frameLength = analyser.GetResultDtype().itemsize
+        self.pointPos = 0
+        self.ackWarn = 0
+        self.ackWeight = 1
+    
+    
+    def Remaining(self) -> int:
+        return self.numPoints - self.pointPos
+    
+    
+    def Decode(self, block:bytes | memoryview, numFrames:int) -> bool:
+        """Decodes a block of FrameReader.NextResultBlock
+
+        Args:
+            block (bytes | memoryview): numFrames result frames or a single acknowledge frame if numFrames is 0
+            numFrames (int): number of result frames in block
+
+        Raises:
+            Exception: Thrown if block is neither results nor an acknowledge
+
+        Returns:
+            bool: True if points were decoded, False for an acknowledge
+        """
+        
+        if numFrames == 0:
+            if not self.analyser.IsAck(block):
+                raise Exception(f"Unexpected frame received while reading results: {list(block)}")
+            self.ackWarn += block[2] * self.ackWeight
+            self.ackWeight *= 1000
+            return False
+        
+        metrics = self.analyser.metrics
+        points = slice(self.pointPos, self.pointPos + numFrames)
+        if metrics is not None:
+            decodeStart = time.perf_counter()
+        self.analyser.DeserializeResultsBulk(block, numFrames, tuple(result[points] for result in self.out))
+        if metrics is not None:
+            metrics.Observe("decode", time.perf_counter() - decodeStart)
+            metrics.Increment("points", numFrames)
+        self.out[4][self.pointPos] += self.ackWarn
+        self.ackWarn = 0
+        self.ackWeight = 1
+        self.pointPos += numFrames
+        
+        return True
+
+
+class ImpedanceAnalyser(AnalyserProtocol):
+    """Device for handling communication with ScioSpec device
+    """
+    
+    #region Constructor
+    def __init__(self, comPort:str | Transport):
+        # communication: serial port name, "tcp://host:port" or an opened Transport
+        self.device = OpenTransport(comPort) if isinstance(comPort, str) else comPort
+        super().__init__(FrameReader(self.device))
+        self.device.AddReconnectCallback(self.ConnectionReopened)
+        # configurations the device lost by a reconnect, sent again by RestoreConfiguration
+        self.lostConfiguration = []
+    #endregion
+    
+    #region Class variable setting functions
     def DoInitialSetup(self, fmin:float, fmax:float, fnum:int, fscale:FrequencyScale, channel:FeChannel, mode:FeMode, currRange:CurrentRange, precision:float, excitationType:InjectionType, excitationAmplitude:float, timestamp:TimeStamp):
         self.SetFrequency(fmin, fmax, fnum, fscale)
         self.SetFeChannel(channel)
@@ -139,23 +602,47 @@ class ImpedanceAnalyser():
         self.SetExcitationAmplitude(excitationAmplitude)
         self.SetTimeStamp(timestamp)
         
-        print(f"Precision: {precision}, amplitude: {excitationAmplitude}")
+        logger.info("Precision: %s, amplitude: %s", precision, excitationAmplitude)
         self.SetSetup()
         self.SetFeSettings()
         self.SetOptions()
     #endregion
     
     #region SerialPort Communication
-    def SendAndReceive(self, command:bytes) -> bytes:
+    def Write(self, command:bytes):
+        """Writes raw command bytes to the device
+
+        Args:
+            command (bytes): one or more complete command frames
+        """
+        
+        if self.capture is not None:
+            self.capture.Write(CaptureFile.TX, command)
+        if self.metrics is not None:
+            self.metrics.Increment("bytesOut", len(command))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("TX %s", command.hex(" "))
         
         self.device.write(command)
+    
+    
+    def SendAndReceive(self, command:bytes) -> bytes:
+        
+        if self.metrics is not None:
+            sendTime = time.perf_counter()
+        
+        self.Write(command)
         
         msg = bytes()
         while True:
             frame = self.ReadFrame()
-            print(list(frame))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("RX %s", frame.hex(" "))
             if self.IsAck(frame):
                 ack = frame[2]
+                if self.metrics is not None:
+                    self.metrics.Observe(f"roundTrip.0x{command[0]:02X}", time.perf_counter() - sendTime)
+                    self.metrics.Increment("commands")
                 self.WarningACK(ack)
                 break
             
@@ -164,69 +651,156 @@ class ImpedanceAnalyser():
         return msg
     
     
-    def ReadFrame(self) -> bytes:
+    def SendAndReceiveMany(self, commands:list[bytes], names:list[str] | None = None) -> list[bytes]:
+        """Writes several commands back to back and collects their answers in the same order
+
+        Args:
+            commands (list[bytes]): complete command frames
+            names (list[str] | None, optional): description of each command used in error messages. Defaults to None.
+
+        Raises:
+            Exception: Thrown for the first command that was not acknowledged, after all answers have been read so that the stream stays in sync
+
+        Returns:
+            list[bytes]: answer of each command without the acknowledge frame
+        """
         
-        msgHeader = self.device.read(2)
-        ct = msgHeader[0]
-        le = msgHeader[1]
+        if names is None:
+            names = [f"command {index}" for index in range(len(commands))]
+        
+        if self.metrics is not None:
+            sendTime = time.perf_counter()
+        
+        self.Write(b"".join(commands))
+        
+        msgs = []
+        error = None
+        for command, name in zip(commands, names):
+            msg = bytes()
+            while True:
+                frame = self.ReadFrame()
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("RX %s", frame.hex(" "))
+                if self.IsAck(frame):
+                    # pipelined commands: time from the common write to the acknowledge of this command
+                    if self.metrics is not None:
+                        self.metrics.Observe(f"roundTrip.0x{command[0]:02X}", time.perf_counter() - sendTime)
+                        self.metrics.Increment("commands")
+                    try:
+                        self.WarningACK(frame[2])
+                    except Exception as e:
+                        if error is None:
+                            error = Exception(f"{name}: {e}")
+                    break
+                
+                msg += frame
+            msgs.append(msg)
         
-        msgBody = self.device.read(le+1)
-        if ct != msgBody[-1]:
-            raise Warning("Malformed message received.")
+        if error is not None:
+            raise error
         
-        return msgHeader + msgBody
+        return msgs
     
     
-    def ReadBuffer(self) -> tuple[list, bytes]:
+    def SendConfiguration(self, key:str, commands:list[bytes], force:bool = False) -> bool:
+        """Sends configuration commands unless the device already acknowledged the same ones
+
+        Args:
+            key (str): name of the configuration in the device state
+            commands (list[bytes]): complete command frames setting the configuration
+            force (bool, optional): send even if the cached state matches. Defaults to False.
+
+        Returns:
+            bool: True if the commands were sent
+        """
         
-        buffer = self.device.read(self.device.bytesize)
+        if not force and self.deviceState.get(key) == commands:
+            return False
         
-        bytePos = 1
-        msgs = bytes()
-        while bytePos < len(buffer):
-            le = buffer[bytePos]
-            
-            msgThis = buffer[bytePos:(bytePos + le + 2)]
-            bytePos += le + 3
-            
-            msgs += msgThis
-            
-        return msgs, buffer
+        # Unknown until every command has been acknowledged
+        self.deviceState.pop(key, None)
+        for command in commands:
+            self.SendAndReceive(command)
+        self.deviceState[key] = commands
+        
+        return True
     
     
-    def IsAck(self, msg:bytes) -> bool:
+    def ConnectionReopened(self):
+        """Called by the transport after it reconnected, buffered bytes of the old connection are dropped
+        """
         
-        if len(msg) == 4 and msg[0] == 0x18 and msg[1] == 0x01 and msg[3] == 0x18:
-            return True
+        logger.info("Connection reopened, device configuration will be sent again")
+        # FE settings and channels are sent by ConfigureChannels anyway once the state is unknown
+        self.lostConfiguration = [key for key in ("setup", "options") if key in self.deviceState]
+        self.InvalidateDeviceState()
+        self.reader.Clear()
+    
+    
+    def RestoreConfiguration(self):
+        """Reconnects a connection closed by the device and sends the setup and options again that it lost
+        """
         
-        return False
+        self.device.CheckConnection()
+        lost, self.lostConfiguration = self.lostConfiguration, []
+        if "setup" in lost:
+            self.SetSetup()
+        if "options" in lost:
+            self.SetOptions()
     
     
-    def WarningACK(self, ack:int):
+    def ReadFrame(self) -> memoryview:
+        """Reads the next frame from the device
+
+        Returns:
+            memoryview: frame including CT, LE and closing CT, valid until the next read
+        """
         
-        match ack:
-            case 0x01:
-                raise Exception("Ack: 0x01 Frame-Not-Acknowledge: Incorrect syntax.")
-            case 0x02:
-                raise Exception("Ack: 0x02 Timeout: Communication-timeout (less data than expected).")
-            case 0x04:
-                print("Ack: 0x04 Wake-Up Message: System boot ready.")
-            case 0x11:
-                print("Ack: 0x11 TCP-Socket: Valid TCP client-socket connection.")
-            case 0x81:
-                raise Exception("Ack: 0x81 Not-Acknowledge: Command has not been executed.")
-            case 0x82:
-                raise Exception("Ack: 0x82 Not-Acknowledge: Command could not be recognized.")
-            case 0x83:
-                print("Command-Acknowledge")
-            case 0x84:
-                print("Ack: 0x84 System-Ready Message: System is operational and ready to receive data.")
-            case 0x90:
-                print("Ack: 0x90 Overcurrent Detected.")
-            case 0x91:
-                print("Ack: 0x91 Overvoltage Detected.")
-            case _:
-                print(f"ACK: Unknown! Msg: {ack}")
+        return self.reader.NextFrame()
+    
+    
+    def ReadBuffer(self) -> tuple[list, bytes]:
+        """Reads all frames the device has sent so far without blocking
+
+        Returns:
+            tuple[list, bytes]: (list of frames, concatenated bytes of these frames)
+        """
+        
+        msgs = self.reader.ReadAvailable()
+        
+        return msgs, b"".join(msgs)
+    
+    
+    def ReadResults(self, numPoints:int, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]):
+        """Reads numPoints result frames and decodes them block wise as they arrive
+
+        Args:
+            numPoints (int): number of result frames to read
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]): flat arrays (real, imag, current range, time stamp, warning) with numPoints elements each
+        """
+        
+        for _ in self.IterReadResults(numPoints, out):
+            pass
+    
+    
+    def IterReadResults(self, numPoints:int, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]) -> Iterator[int]:
+        """Reads numPoints result frames like ReadResults and reports the progress after every decoded block
+
+        Args:
+            numPoints (int): number of result frames to read
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]): flat arrays (real, imag, current range, time stamp, warning) with numPoints elements each
+
+        Yields:
+            Iterator[int]: number of points decoded into out so far
+        """
+        
+        decoder = ResultDecoder(self, numPoints, out)
+        while decoder.Remaining() > 0:
+            block, numFrames = self.reader.NextResultBlock(decoder.Remaining(), decoder.frameLength)
+            if decoder.Decode(block, numFrames):
+                yield decoder.pointPos
+    
+    
     #endregion
     
     #region ScioSpec commands
@@ -238,31 +812,14 @@ class ImpedanceAnalyser():
         self.SendAndReceive(command)
     
     
-    def SetOptions(self):
+    def SetOptions(self, force:bool = False):
         """0x97 - Set Options
 
-        Raises:
-            ValueError: Timestamp must be from enum class
+        Args:
+            force (bool, optional): send even if the device already has these options. Defaults to False.
         """
         
-        match self.resTimeStamp:
-            case TimeStamp.off:
-                command = bytes([0x97, 0x02, 0x01, 0x00, 0x97])
-            case TimeStamp.ms:
-                command = bytes([0x97, 0x02, 0x01, 0x01, 0x97])
-            case TimeStamp.us:
-                command = bytes([0x97, 0x02, 0x02, 0x01, 0x97])
-            case _:
-                raise ValueError(f"TimeStamp type not recognised: {self.resTimeStamp}")
-        
-        self.SendAndReceive(command)
-        
-        if self.resCurrentRange:
-            command = bytes([0x97, 0x02, 0x04, 0x01, 0x97])
-        else:
-            command = bytes([0x97, 0x02, 0x04, 0x00, 0x97])
-            
-        self.SendAndReceive(command)
+        self.SendConfiguration("options", self.EncodeOptions(), force)
     
     
     def GetOptionsTimeStamp(self) -> (TimeStamp | None):
@@ -294,17 +851,24 @@ class ImpedanceAnalyser():
         
         command = bytes([0xA1, 0x00, 0xA1])
         self.SendAndReceive(command)
+        self.InvalidateDeviceState()
     
     
-    def SetFeSettings(self):
+    def SetFeSettings(self, force:bool = False):
         """0xB0 - Set FE Settings
+        
+        Args:
+            force (bool, optional): send even if the device already has these settings. Defaults to False.
         """
         
-        command = bytes([0xB0, 0x03, 0xFF, 0xFF, 0xFF, 0xB0])
-        self.SendAndReceive(command)
+        commands = self.EncodeFeSettings()
+        if not force and self.deviceState.get("feSettings") == commands:
+            return
         
-        command = bytes([0xB0, 0x03, self.feMode.value, self.feChannel.value, self.feRange.value, 0xB0])
-        self.SendAndReceive(command)
+        # The reset frame also clears the channel list of the device
+        self.deviceState.pop("mux", None)
+        self.SendConfiguration("feSettings", commands, True)
+        self.deviceState["mux"] = ()
     
     
     def GetFeSettings(self) -> tuple[FeMode | None, FeChannel | None, CurrentRange | None]:
@@ -358,10 +922,53 @@ class ImpedanceAnalyser():
         if offset >= len(self.muxElConfig):
             raise IndexError("There are not enough configurations for this offset.")
         
-        portBytes = self.muxElConfig[offset]
+        portBytes = list(self.muxElConfig[offset])
         
         command = bytes([0xB2, 0x04] + portBytes + [0xB2])
+        
+        channels = self.deviceState.pop("mux", None)
         self.SendAndReceive(command)
+        if channels is not None:
+            self.deviceState["mux"] = channels + (tuple(portBytes),)
+    
+    
+    def SetExtensionPortChannels(self, offsets:range | list[int]):
+        """0xB2 - Set ExtenstionPort Channel for several configurations with a single write
+        
+        Args:
+            offsets (range | list[int]): indices of channel configurations to be set, in this order
+        
+        Raises:
+            IndexError: Thrown if an index is out of list bounds
+        """
+        
+        commands = self.EncodeExtensionPortChannels(offsets)
+        
+        channels = self.deviceState.pop("mux", None)
+        self.SendAndReceiveMany(commands, [f"Channel {offset} {list(self.muxElConfig[offset])}" for offset in offsets])
+        if channels is not None:
+            self.deviceState["mux"] = channels + tuple(tuple(self.muxElConfig[offset]) for offset in offsets)
+    
+    
+    def ConfigureChannels(self, offsets:range | list[int]):
+        """0xB0/0xB2 - Sets the FE settings and a fresh channel list, skipped if the device already has exactly this configuration
+
+        Args:
+            offsets (range | list[int]): indices of channel configurations to be set, in this order
+        """
+        
+        self.RestoreConfiguration()
+        channels = tuple(tuple(self.muxElConfig[offset]) for offset in offsets)
+        current = self.deviceState.get("mux")
+        
+        # The device list can only be extended, anything else needs a reset through the FE settings
+        if self.deviceState.get("feSettings") == self.EncodeFeSettings() and current is not None and channels[:len(current)] == current:
+            if len(current) < len(channels):
+                self.SetExtensionPortChannels(offsets[len(current):])
+            return
+        
+        self.SetFeSettings(force=True)
+        self.SetExtensionPortChannels(offsets)
     
     
     def GetExtensionPortChannel(self) -> list[int]:
@@ -374,7 +981,8 @@ class ImpedanceAnalyser():
         command = bytearray([0xB3, 0x00, 0xB3])
         msg = self.SendAndReceive(command)
         
-        return [list(msg[x:x+4]) for x in range(2, len(msg) - 1, 4)]
+        # Long channel lists are split over several frames
+        return [list(payload[x:x+4]) for payload in self.FramePayloads(msg) for x in range(0, len(payload), 4)]
     
     
     def GetExtensionPortModule(self) -> tuple[ExternalModule | None, InternalModule | None, int | None, int | None]:
@@ -402,34 +1010,14 @@ class ImpedanceAnalyser():
         return externalModule, internalModule, channelCountExt, channelCountInt
     
     
-    def SetSetup(self):
+    def SetSetup(self, force:bool = False):
         """0xB6 - Set Setup
-        """
         
-        command = bytes([0xB6, 0x01, 0x01, 0xB6])
-        self.SendAndReceive(command)
-        
-        command = bytes([0xB6, 0x25, 0x03])
-
-        if self.fscale is FrequencyScale.linear:
-            freqScale = 0
-        else:
-            freqScale = 1
-        # Required data bytes
-        command += bytes(GetHexSingle(self.fmin) + GetHexSingle(self.fmax) + GetHexSingle(self.fnum) + [freqScale] + GetHexSingle(self.precision) + GetHexSingle(self.amplitude))
-        
-        # Optional data bytes
-        command += bytes([0x01, 0x00, 0x00, 0x00, 0x00, 0x02, 0x00, 0x00, 0x00, 0x00, 0x03, 0x00, 0x00, 0x00])
-        
-        if self.excitation is InjectionType.voltage:
-            command += bytes([0x01])
-        else:
-            command += bytes([0x02])
-            
-        # closing command tag
-        command += bytes([0xB6])
+        Args:
+            force (bool, optional): send even if the device already has this setup. Defaults to False.
+        """
         
-        self.SendAndReceive(command)
+        self.SendConfiguration("setup", self.EncodeSetup(), force)
     
     
     # Get Setup functions
@@ -476,7 +1064,8 @@ class ImpedanceAnalyser():
         command = bytes([0xB7, 0x01, 0x04, 0xB7])
         msg = self.SendAndReceive(command)
         
-        return [GetFloatFromBytes(msg[i:i+4]) for i in range(3, len(msg) - 2, 4)]
+        # Long frequency lists are split over several frames, each starting with the option byte
+        return [GetFloatFromBytes(payload[i:i+4]) for payload in self.FramePayloads(msg) for i in range(1, len(payload), 4)]
     
     
     def SaveSetupToSlot(self, slot:int):
@@ -509,19 +1098,50 @@ class ImpedanceAnalyser():
         return GetFloatFromBytes(msg[3:7])
     
     
-    def StartMeasure(self):
+    def StartMeasure(self, repetitions:int = 1):
         """0xB8 - Start Measure
+        
+        Args:
+            repetitions (int, optional): number of sweeps over the channel list, 0 measures continuously until StopMeasure. Defaults to 1.
+        
+        Raises:
+            ValueError: Thrown if repetitions does not fit into two bytes
         """
         
-        command = bytes([0xB8, 0x03, 0x01, 0x00, 0x01, 0xB8])
-        self.SendAndReceive(command)
+        self.SendAndReceive(self.EncodeStartMeasure(repetitions))
     
-    def StopMeasure(self):
+    def StopMeasure(self, timeout:float | None = None):
         """0xB8 - Stop Measure
+        
+        Result frames still in flight and their warnings are discarded until the command is acknowledged.
+
+        Args:
+            timeout (float | None, optional): seconds to wait for the acknowledge, None waits like every other command. Defaults to None.
+
+        Raises:
+            TimeoutError: Thrown if the acknowledge did not arrive within timeout
         """
         
         command = bytes([0xB8, 0x01, 0x00, 0xB8])
-        self.SendAndReceive(command)
+        self.Write(command)
+        
+        if timeout is None:
+            while True:
+                frame = self.ReadFrame()
+                if self.IsAck(frame) and frame[2] not in (0x90, 0x91):
+                    self.WarningACK(frame[2])
+                    return
+        
+        # only complete frames are taken, so a silent device can not block longer than timeout
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            for frame in self.reader.ReadAvailable():
+                if self.IsAck(frame) and frame[2] not in (0x90, 0x91):
+                    self.WarningACK(frame[2])
+                    return
+            time.sleep(0.001)
+        
+        raise TimeoutError(f"Stop Measure was not acknowledged within {timeout} s.")
     
     def SetSyncTime(self, syncTime:int):
         """0xB9 - Set Sync Time
@@ -530,13 +1150,13 @@ class ImpedanceAnalyser():
             syncTime (int): sync time in microseconds, needs to be between 0 and 180e6
 
         Raises:
-            ValueError: _description_
+            ValueError: Thrown if syncTime is out of range
         """
         
         if syncTime < 0 or syncTime > 180e6:
             raise ValueError("SyncTime needs to be between 0 and 180 seconds")
         
-        command = bytes([0xB9, 0x04, syncTime.to_bytes(4, "big")])
+        command = bytes([0xB9, 0x04]) + int(syncTime).to_bytes(4, "big") + bytes([0xB9])
         self.SendAndReceive(command)
     
     
@@ -593,7 +1213,7 @@ class ImpedanceAnalyser():
         command = bytes([0xBE, 0x01, 0x01, 0xBE])
         msg = self.SendAndReceive(command)
         
-        return ".".join(list(msg[3:7]))
+        return ".".join(str(part) for part in msg[3:7])
     
     
     def GetMACAddress(self) -> str:
@@ -646,8 +1266,8 @@ class ImpedanceAnalyser():
         command = bytes([0xD0, 0x00, 0xD0])
         msg = self.SendAndReceive(command)
         
-        revisionNumber = int.from_bytes(msg[4, 5], "big")
-        buildNumber = int.from_bytes(msg[6, 7], "big")
+        revisionNumber = int.from_bytes(msg[4:6], "big")
+        buildNumber = int.from_bytes(msg[6:8], "big")
         
         return revisionNumber, buildNumber
     
@@ -663,9 +1283,9 @@ class ImpedanceAnalyser():
         msg = self.SendAndReceive(command)
         
         version = msg[2]
-        deviceID = int.from_bytes(msg[3, 4], "big")
-        serialNumber = int.from_bytes(msg[5, 6], "big")
-        deliveryDate = 2010 + int.from_bytes(msg[7, 8], "big")
+        deviceID = int.from_bytes(msg[3:5], "big")
+        serialNumber = int.from_bytes(msg[5:7], "big")
+        deliveryDate = 2010 + int.from_bytes(msg[7:9], "big")
         
         return version, deviceID, serialNumber, deliveryDate
     
@@ -680,86 +1300,150 @@ class ImpedanceAnalyser():
         command = bytes([0xD2, 0x00, 0xD2])
         msg = self.SendAndReceive(command)
         
-        revisionNumber = int.from_bytes(msg[7, 8], "big")
-        buildNumber = int.from_bytes(msg[9, 10], "big")
+        revisionNumber = int.from_bytes(msg[7:9], "big")
+        buildNumber = int.from_bytes(msg[9:11], "big")
         
         return revisionNumber, buildNumber
     #endregion
     
     #region Result processing
-    def DeserializeResults(self, results:bytes) -> tuple[float, float, int, CurrentRange, list]:
+    def GetMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]:
+        """Runs one sweep over all configured electrode combinations and frequencies
+
+        Args:
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None, optional): buffers from AllocateResultBuffers to reuse, new ones are allocated if None. Defaults to None.
+
+        Raises:
+            ValueError: Thrown if the buffers do not match the current configuration
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]: (real, imag, warning, current range, time stamp, start time, finish time), arrays shaped (channels, frequencies), real and imag are views into the impedance buffer, time stamps in device ticks (see PointTimes), start and finish as wall clock seconds since epoch
+        """
         
-        warn = 0
-        if self.IsAck(results):
-            warn = results[2]
-            results = self.ReadFrame()
-            
-            if self.IsAck(results):
-                warn += results[2] * 1000
-                results = self.ReadFrame()
+        if out is None:
+            out = self.AllocateResultBuffers()
+        resImpedance, resRange, resTime, resWarning = out
         
+        startTime = WallClock()
         
-        if self.resTimeStamp is TimeStamp.off:
-            lengthTime = 0
-            timeOffset = None
-        elif self.resTimeStamp is TimeStamp.ms:
-            lengthTime = 4
-            timeOffset = list(results[7:3:-1])
-        else:
-            lengthTime = 5
-            timeOffset = [0, 0, 0] + list(results[8:3:-1])
+        for _ in self.IterMeasurements(out):
+            pass
             
-        if not self.resCurrentRange:
-            lengthCurrent = 0
-            currentRange = 0
-        else:
-            lengthCurrent = 1
-            currentRange = results[4 + lengthTime]
+        finishTime = WallClock()
         
-        zReal = GetFloatResultsFromBytes(results[(7 + lengthCurrent + lengthTime):(3 + lengthCurrent + lengthTime):-1])
-        zImag = GetFloatResultsFromBytes(results[(11 + lengthCurrent + lengthTime):(7 + lengthTime + lengthCurrent):-1])
-        
-        return zReal, zImag, warn, CurrentRange(currentRange), timeOffset
+        return resImpedance.real, resImpedance.imag, resWarning, resRange, resTime, startTime, finishTime
     
     
-    def GetMeasurements(self) -> tuple[list, list, list, list, list, str, str]:
+    def IterMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> Iterator[tuple[int, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        """Runs one sweep like GetMeasurements and yields every electrode combination as soon as all its frequencies are read
+
+        Args:
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None, optional): buffers from AllocateResultBuffers to decode into. Defaults to None.
+
+        Raises:
+            ValueError: Thrown if the buffers do not match the current configuration
+
+        Yields:
+            Iterator[tuple[int, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]: (channel index, real, imag, warning, current range, time stamp), arrays are views of the channel row in the buffers
+        """
         
         self.CheckSettings()
         
         muxConfigLen = len(self.muxElConfig)
-        resWarning = [[0 for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resReal = [[None for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resImag = [[None for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resRange = [["" for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resTime = [[None for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        
-        counter = 0
-        startTime = datetime.datetime.now().isoformat(" ", "seconds")
+        if out is None:
+            out = self.AllocateResultBuffers()
+        resImpedance, resRange, resTime, resWarning = out
+        resReal = resImpedance.real
+        resImag = resImpedance.imag
+        flatResults = self.GetFlatResultBuffers(out)
+        if len(self.channelStarts) != muxConfigLen:
+            self.channelStarts = np.zeros(muxConfigLen)
+        
+        if self.metrics is not None:
+            sweepStart = time.perf_counter()
         
         for idxElChunks in range(math.ceil(muxConfigLen / 128)):
             
-            numMeas = muxConfigLen - 128 * idxElChunks
-                
-            self.SetFeSettings()
-            
-            for _ in range(numMeas):
-                self.SetExtensionPortChannel(counter)
-                counter += 1
+            numMeas = min(128, muxConfigLen - 128 * idxElChunks)
             
+            if self.metrics is not None:
+                setupStart = time.perf_counter()
+            self.ConfigureChannels(range(128 * idxElChunks, 128 * idxElChunks + numMeas))
+            if self.metrics is not None:
+                self.metrics.Observe("muxSetup", time.perf_counter() - setupStart)
+            self.channelStarts[128 * idxElChunks:128 * idxElChunks + numMeas] = WallClock()
             self.StartMeasure()
             
-            for measIdx in range(numMeas):
-                for freqIdx in range(self.fnum):
-                    results = self.ReadFrame()
-                    real, imag, warn, currentRange, timeOffset = self.DeserializeResults(results)
-                    
-                    resReal[measIdx + 128 * idxElChunks][freqIdx] = real
-                    resImag[measIdx + 128 * idxElChunks][freqIdx] = imag
-                    resWarning[measIdx + 128 * idxElChunks][freqIdx] = warn
-                    resRange[measIdx + 128 * idxElChunks][freqIdx] = currentRange
-                    resTime[measIdx + 128 * idxElChunks][freqIdx] = timeOffset
-            
-        finishTime = datetime.datetime.now().isoformat(" ", "seconds")
+            firstChannel = 128 * idxElChunks
+            nextChannel = firstChannel
+            points = slice(firstChannel * self.fnum, (firstChannel + numMeas) * self.fnum)
+            for numPoints in self.IterReadResults(numMeas * self.fnum, tuple(result[points] for result in flatResults)):
+                while (nextChannel - firstChannel + 1) * self.fnum <= numPoints:
+                    yield nextChannel, resReal[nextChannel], resImag[nextChannel], resWarning[nextChannel], resRange[nextChannel], resTime[nextChannel]
+                    nextChannel += 1
         
-        return resReal, resImag, resWarning, resRange, resTime, startTime, finishTime
+        if self.metrics is not None:
+            self.metrics.Observe("sweep", time.perf_counter() - sweepStart)
+            self.metrics.Increment("sweeps")
+    
+    
+    def IterContinuousMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]]:
+        """Configures the device once, lets it measure continuously and yields every sweep as soon as it is complete
+        
+        No other command must be sent while iterating. Closing the generator (or leaving a for loop over it) stops the measurement.
+
+        Args:
+            out (tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None, optional): buffers from AllocateResultBuffers, they are overwritten by every sweep. Defaults to None.
+
+        Raises:
+            ValueError: Thrown if more than 128 electrode combinations are configured or the buffers do not match
+
+        Yields:
+            Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]]: same tuple as GetMeasurements for every sweep, the device time stamps continue over all sweeps
+        """
+        
+        self.CheckSettings()
+        
+        muxConfigLen = len(self.muxElConfig)
+        if muxConfigLen > 128:
+            raise ValueError("Continuous measurements support at most 128 electrode combinations.")
+        
+        if out is None:
+            out = self.AllocateResultBuffers()
+        resImpedance, resRange, resTime, resWarning = out
+        resReal = resImpedance.real
+        resImag = resImpedance.imag
+        flatResults = self.GetFlatResultBuffers(out)
+        
+        if self.metrics is not None:
+            setupStart = time.perf_counter()
+        self.ConfigureChannels(range(muxConfigLen))
+        if self.metrics is not None:
+            self.metrics.Observe("muxSetup", time.perf_counter() - setupStart)
+        self.channelStarts = np.full(muxConfigLen, WallClock())
+        self.StartMeasure(0)
+        
+        try:
+            while True:
+                startTime = WallClock()
+                if self.metrics is not None:
+                    sweepStart = time.perf_counter()
+                self.ReadResults(muxConfigLen * self.fnum, flatResults)
+                if self.metrics is not None:
+                    self.metrics.Observe("sweep", time.perf_counter() - sweepStart)
+                    self.metrics.Increment("sweeps")
+                finishTime = WallClock()
+                
+                yield resReal, resImag, resWarning, resRange, resTime, startTime, finishTime
+        except Exception:
+            # after a read or decode error the link may be broken or out of sync, stopping must neither hang nor hide the error
+            try:
+                self.StopMeasure(timeout=1.0)
+            except Exception as e:
+                logger.warning("Stopping the measurement after an error failed: %s", e)
+            raise
+        except BaseException:
+            # closing the generator is the regular way to stop
+            self.StopMeasure()
+            raise
     #endregion
\ No newline at end of file
@@ -1,6 +1,7 @@
-import math, datetime
+import math
+from collections.abc import Iterator
 from EnumClasses import CurrentRange, InjectionType, FrequencyScale, FeMode, FeChannel, TimeStamp, ExternalModule, InternalModule
-from HelperFunctions import GetHexSingle, GetFloatFromBytes, GetFloatResultsFromBytes
+from HelperFunctions import GetHexSingle, GetFloatFromBytes, GetFloatResultsFromBytes, WallClock
 import numpy as np
 import random
 class ImpedanceAnalyserFake():
@@ -12,6 +13,7 @@ class ImpedanceAnalyserFake():
         # communication
         self.device = comPort
         self.timeout = 10
+        self.metrics = None
         
         # front end settings
         self.feMode = FeMode.mode4pt
@@ -143,6 +145,11 @@ class ImpedanceAnalyserFake():
         self.CheckSettings()
         self.SetSetup()
         self.SetOptions()
+    
+    
+    def EnableMetrics(self, metrics):
+        
+        self.metrics = metrics
     #endregion
     
     #region ScioSpec commands
@@ -259,6 +266,17 @@ class ImpedanceAnalyserFake():
         print(f"Send command:  {list(command)}")
     
     
+    def SetExtensionPortChannels(self, offsets:range | list[int]):
+        """0xB2 - Set ExtenstionPort Channel for several configurations with a single write
+        
+        Args:
+            offsets (range | list[int]): indices of channel configurations to be set, in this order
+        """
+        
+        for offset in offsets:
+            self.SetExtensionPortChannel(offset)
+    
+    
     def GetExtensionPortChannel(self) -> list[int]:
         """0xB3 - Get ExtensionPort Channel
 
@@ -386,11 +404,18 @@ class ImpedanceAnalyserFake():
             return np.linspace(self.fmin, self.fmax, self.fnum)
     
     
-    def StartMeasure(self):
+    def StartMeasure(self, repetitions:int = 1):
         """0xB8 - Start Measure
         """
         
-        command = bytes([0xB8, 0x03, 0x01, 0x00, 0x01, 0xB8])
+        command = bytes([0xB8, 0x03, 0x01]) + repetitions.to_bytes(2, "big") + bytes([0xB8])
+        print(list(command))
+    
+    def StopMeasure(self):
+        """0xB8 - Stop Measure
+        """
+        
+        command = bytes([0xB8, 0x01, 0x00, 0xB8])
         print(list(command))
     #endregion
     
@@ -422,43 +447,76 @@ class ImpedanceAnalyserFake():
         return zReal, zImag, warn, CurrentRange(currentRange), timeOffset
     
     
-    def GetMeasurements(self) -> tuple[list, list, list, list, str, str]:
+    def AllocateResultBuffers(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Allocates result buffers for GetMeasurements matching the current mux configuration and number of frequencies
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (impedances complex64, current range uint8, time stamp uint64, warning uint32), each shaped (channels, frequencies)
+        """
+        
+        shape = (len(self.muxElConfig), self.fnum)
+        
+        return np.zeros(shape, dtype=np.complex64), np.zeros(shape, dtype=np.uint8), np.zeros(shape, dtype=np.uint64), np.zeros(shape, dtype=np.uint32)
+    
+    
+    def PointTimes(self, resTime:np.ndarray, startTime:float) -> np.ndarray | None:
+        
+        # the fake device sends no time stamps
+        return None
+    
+    
+    def GetMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]:
         
         muxConfigLen = len(self.muxElConfig)
-        resWarning = [[0 for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resReal = [[None for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resImag = [[None for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resRange = [["" for _ in range(self.fnum)] for _ in range(muxConfigLen)]
-        resTime = [[None for _ in range(self.fnum)] for _ in range(muxConfigLen)]
+        if out is None:
+            out = self.AllocateResultBuffers()
+        resImpedance, resRange, resTime, resWarning = out
         
         counter = 0
         
-        startTime = datetime.datetime.now().isoformat(" ", "seconds")
+        startTime = WallClock()
         
         for idxElChunks in range(math.ceil(muxConfigLen / 128)):
             
-            numMeas = muxConfigLen - 128 * idxElChunks
+            numMeas = min(128, muxConfigLen - 128 * idxElChunks)
                 
             self.SetFeSettings()
-            
-            for _ in range(numMeas):
-                self.SetExtensionPortChannel(counter)
-                counter += 1
+            self.SetExtensionPortChannels(range(counter, counter + numMeas))
+            counter += numMeas
             
             self.StartMeasure()
             
             for measIdx in range(numMeas):
                 for freqIdx in range(self.fnum):
                     results = bytes([184, 11, 0, 0, 1, random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), random.randint(0, 255), 184])
-                    real, imag, warn, currentRange, timeOffset = self.DeserializeResults(results)
+                    real, imag, warn, currentRange, _ = self.DeserializeResults(results)
                     
-                    resReal[measIdx + 128 * idxElChunks][freqIdx] = real
-                    resImag[measIdx + 128 * idxElChunks][freqIdx] = imag
+                    resImpedance[measIdx + 128 * idxElChunks][freqIdx] = complex(real, imag)
                     resWarning[measIdx + 128 * idxElChunks][freqIdx] = warn
-                    resRange[measIdx + 128 * idxElChunks][freqIdx] = currentRange
-                    resTime[measIdx + 128 * idxElChunks][freqIdx] = timeOffset
+                    resRange[measIdx + 128 * idxElChunks][freqIdx] = currentRange.value
+                    resTime[measIdx + 128 * idxElChunks][freqIdx] = 0
                     
-        finishTime = datetime.datetime.now().isoformat(" ", "seconds")
+        finishTime = WallClock()
+        
+        return resImpedance.real, resImpedance.imag, resWarning, resRange, resTime, startTime, finishTime
+    
+    
+    def IterContinuousMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> Iterator[tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, float, float]]:
+        
+        if out is None:
+            out = self.AllocateResultBuffers()
+        
+        try:
+            while True:
+                yield self.GetMeasurements(out)
+        finally:
+            self.StopMeasure()
+    
+    
+    def IterMeasurements(self, out:tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray] | None = None) -> Iterator[tuple[int, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        
+        resReal, resImag, resWarning, resRange, resTime, _, _ = self.GetMeasurements(out)
         
-        return resReal, resImag, resWarning, resRange, resTime, startTime, finishTime
+        for channel in range(len(self.muxElConfig)):
+            yield channel, resReal[channel], resImag[channel], resWarning[channel], resRange[channel], resTime[channel]
     #endregion
\ No newline at end of file
@@ -0,0 +1,478 @@
+from __future__ import annotations
+import os, tempfile
+import numpy as np
+from PySide6.QtCore import QObject, Signal
+from DataManager import EISData, SweepAxes, FormatTime, MissingTimeStamps
+from ProtocolTrace import logger
+from RecordingFile import Recording, RecordingWriter
+
+def Grow(array:np.ndarray, size:int, limit:int | None = None) -> np.ndarray:
+    """Returns array with room for at least size rows, the capacity is doubled to make appending amortized O(1)
+
+    Args:
+        array (np.ndarray): array to grow
+        size (int): number of rows needed
+        limit (int | None, optional): the doubling does not go beyond this many rows, e.g. a retention limit. Defaults to None.
+    """
+
+    if size <= len(array):
+        return array
+
+    capacity = max(size, 2 * len(array), 16)
+    if limit is not None:
+        capacity = max(size, min(capacity, limit))
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+
+    return grown
+
+
+class StoredSweep(EISData):
+    """EISData view of one sweep of a MeasurementStore, the arrays are views into the store
+    """
+
+    def __init__(self, store:MeasurementStore, index:int):
+        self.impedances, timeStamps = store.Row(index)
+        # like a measured sweep, one without device time stamps keeps none
+        self.timeStampArray = None if np.isnan(timeStamps).all() else timeStamps
+        self.axes = SweepAxes.Get(store.frequencies, store.electrodes)
+        self.measurementIndex = int(store.measurementIndices[index])
+        self.startEpoch = float(store.startTimes[index])
+        self.finishEpoch = float(store.finishTimes[index])
+
+
+class MeasurementStore(QObject):
+    """Central storage of all sweeps shown by the tabs
+
+    Sweeps of one configuration (frequencies and electrode combinations) are kept as (sweeps, channels, frequencies)
+    complex64 cube and vectors of measurement index, start and finish time. The time stamp cube of the hot part
+    is only allocated once a sweep with device time stamps arrives. Sweeps loaded from
+    a recording stay in its memory map, measured sweeps are appended to growing arrays in memory (hot part).
+    With a retention policy (SetRetention) older hot sweeps are spilled to a temporary recording file and read
+    back through its memory map, so only the retained sweeps and the small vectors occupy memory.
+    Tabs read through Row, Values and the vectors instead of keeping their own lists and are notified by
+    sweepsAppended with the range of new sweeps.
+    """
+
+    # start and stop index of the appended sweeps
+    sweepsAppended = Signal(int, int)
+    cleared = Signal()
+
+    def __init__(self, parent:QObject | None = None, spillDirectory:str | None = None):
+        """Constructor
+
+        Args:
+            parent (QObject | None, optional): Qt parent. Defaults to None.
+            spillDirectory (str | None, optional): directory of the spill file, None for the temporary directory. Defaults to None.
+        """
+
+        super().__init__(parent)
+        self.spillDirectory = spillDirectory
+        self.maxHotSweeps = None
+        self.maxHotSeconds = None
+        self.spillBatch = 32
+        self.recording = None
+        self.spillWriter = None
+        self.spillRecording = None
+        self.Reset()
+
+
+    def Reset(self):
+        self.frequencies = np.empty(0)
+        self.electrodes:list[list[int]] = []
+        # read only cubes in memory maps: the loaded recording and the spill file
+        self.coldSegments:list[tuple[np.ndarray, np.ndarray]] = []
+        self.coldCount = 0
+        self.hotImpedances = np.empty((0, 0, 0), dtype=np.complex64)
+        # None while no hot sweep has device time stamps
+        self.hotTimeStamps = None
+        self.hotCount = 0
+        self.allMeasurementIndices = np.empty(0, dtype=np.int64)
+        # wall clock seconds since epoch, NaN if unknown
+        self.allStartTimes = np.empty(0)
+        self.allFinishTimes = np.empty(0)
+
+
+    def __len__(self) -> int:
+        return self.coldCount + self.hotCount
+
+
+    @property
+    def measurementIndices(self) -> np.ndarray:
+        return self.allMeasurementIndices[:len(self)]
+
+    @property
+    def startTimes(self) -> np.ndarray:
+        return self.allStartTimes[:len(self)]
+
+    @property
+    def finishTimes(self) -> np.ndarray:
+        return self.allFinishTimes[:len(self)]
+
+
+    def Clear(self):
+        """Removes all sweeps, releases the recording and deletes the spill file
+        """
+
+        self.recording = None
+        self.RemoveSpillFile()
+        self.Reset()
+        self.cleared.emit()
+
+
+    def Close(self):
+        self.RemoveSpillFile()
+
+
+    def SetRetention(self, maxSweeps:int | None = None, maxMinutes:float | None = None, spillBatch:int = 32):
+        """Sets how many sweeps are kept in memory, older ones are spilled to disk
+
+        Args:
+            maxSweeps (int | None, optional): number of newest sweeps kept in memory, None for no limit. Defaults to None.
+            maxMinutes (float | None, optional): sweeps started within this time before the newest one are kept in memory, None for no limit. Defaults to None.
+            spillBatch (int, optional): sweeps are spilled once at least this many exceed the limits, which bounds the cost of remapping the spill file. Defaults to 32.
+        """
+
+        self.maxHotSweeps = maxSweeps
+        self.maxHotSeconds = None if maxMinutes is None else 60 * maxMinutes
+        self.spillBatch = max(1, spillBatch)
+        self.Spill()
+
+
+    def RetainedCount(self) -> int:
+        """Number of newest hot sweeps the retention policy keeps in memory
+        """
+
+        retained = self.hotCount
+        if self.maxHotSweeps is not None:
+            retained = min(retained, self.maxHotSweeps)
+        if self.maxHotSeconds is not None and self.hotCount > 0:
+            hotStartTimes = self.allStartTimes[self.coldCount:len(self)]
+            retained = min(retained, int(np.count_nonzero(hotStartTimes >= hotStartTimes[-1] - self.maxHotSeconds)))
+
+        return retained
+
+
+    def HotCapacityLimit(self) -> int | None:
+        """Number of hot sweeps the in memory cubes can need under the retention policy, None without a sweep limit
+        """
+
+        # sweeps are only spilled once spillBatch of them exceed the limit
+        return None if self.maxHotSweeps is None else self.maxHotSweeps + self.spillBatch
+
+
+    def Spill(self, force:bool = False):
+        """Moves the sweeps exceeding the retention policy from memory to the spill file
+
+        Args:
+            force (bool, optional): spill even if less than spillBatch sweeps exceed the limits. Defaults to False.
+        """
+
+        excess = self.hotCount - self.RetainedCount()
+        if excess <= 0 or (excess < self.spillBatch and not force):
+            return
+
+        if self.spillWriter is None:
+            descriptor, path = tempfile.mkstemp(suffix=".eisr", prefix="spill-", dir=self.spillDirectory)
+            os.close(descriptor)
+            # the spill file is a cache of this process, syncing it would only slow down the acquisition
+            self.spillWriter = RecordingWriter(path, fsyncPolicy="never")
+            self.spillRecording = Recording(path)
+            self.coldSegments.append(None)
+            logger.info("Spilling sweeps to %s", path)
+
+        offsets = [self.spillWriter.Append(StoredSweep(self, index)) for index in range(self.coldCount, self.coldCount + excess)]
+        self.spillWriter.Flush()
+
+        # the spill file is always the last cold segment, it is mapped again with the new sweeps
+        spilled = len(self.spillRecording)
+        self.spillRecording.Extend(offsets)
+        self.coldSegments[-1] = self.spillRecording.Cube(0, len(self.spillRecording), spilled)
+        self.coldCount += excess
+
+        # new arrays instead of shifting in place, so views of the hot sweeps stay valid
+        remaining = self.hotCount - excess
+        hotImpedances = np.empty_like(self.hotImpedances)
+        hotImpedances[:remaining] = self.hotImpedances[excess:self.hotCount]
+        self.hotImpedances = hotImpedances
+        if self.hotTimeStamps is not None:
+            hotTimeStamps = np.empty_like(self.hotTimeStamps)
+            hotTimeStamps[:remaining] = self.hotTimeStamps[excess:self.hotCount]
+            self.hotTimeStamps = hotTimeStamps
+        self.hotCount = remaining
+
+
+    def RemoveSpillFile(self):
+        if self.spillWriter is None:
+            return
+
+        self.spillWriter.Close()
+        try:
+            os.remove(self.spillWriter.path)
+            os.remove(self.spillWriter.path + ".idx")
+        except OSError as e:
+            # on Windows a file can not be removed while views of its memory map are in use
+            logger.warning("Spill file %s could not be removed: %s", self.spillWriter.path, e)
+        self.spillWriter = None
+        self.spillRecording = None
+
+
+    def Matches(self, data:EISData) -> bool:
+        """True if data can be appended, i.e. the store is empty or data has the same frequencies and electrode combinations
+        """
+
+        return len(self) == 0 or self.SameAxes(data)
+
+
+    def SameAxes(self, data:EISData) -> bool:
+        return np.array_equal(np.asarray(data.frequencies), self.frequencies) and [list(combination) for combination in data.electrodes] == self.electrodes
+
+
+    def Append(self, data:EISData):
+        self.Extend([data])
+
+
+    def Extend(self, dataList:list[EISData]):
+        """Appends sweeps and emits sweepsAppended once
+
+        Args:
+            dataList (list[EISData]): sweeps with the frequencies and electrode combinations of the store
+
+        Raises:
+            ValueError: Thrown if a sweep does not match the store
+        """
+
+        if not dataList:
+            return
+
+        if len(self) == 0:
+            self.frequencies = np.asarray(dataList[0].frequencies, dtype=np.float64).copy()
+            self.electrodes = [list(combination) for combination in dataList[0].electrodes]
+        if not all(self.SameAxes(data) for data in dataList):
+            raise ValueError("Sweeps with different frequencies or electrode combinations can not be stored together.")
+
+        start = len(self)
+        stop = start + len(dataList)
+        shape = (len(self.electrodes), len(self.frequencies))
+        if self.hotImpedances.shape[1:] != shape:
+            self.hotImpedances = np.empty((0,) + shape, dtype=np.complex64)
+            self.hotTimeStamps = None
+        limit = self.HotCapacityLimit()
+        self.hotImpedances = Grow(self.hotImpedances, self.hotCount + len(dataList), limit)
+        if self.hotTimeStamps is None and any(data.hasTimeStamps for data in dataList):
+            self.hotTimeStamps = np.full(self.hotImpedances.shape, np.nan)
+        if self.hotTimeStamps is not None:
+            self.hotTimeStamps = Grow(self.hotTimeStamps, len(self.hotImpedances), len(self.hotImpedances))
+        self.allMeasurementIndices = Grow(self.allMeasurementIndices, stop)
+        self.allStartTimes = Grow(self.allStartTimes, stop)
+        self.allFinishTimes = Grow(self.allFinishTimes, stop)
+
+        for position, data in enumerate(dataList, self.hotCount):
+            self.hotImpedances[position] = data.impedances
+            if self.hotTimeStamps is not None:
+                self.hotTimeStamps[position] = np.asarray(data.timeStamps, dtype=np.float64).reshape(shape)
+        self.allMeasurementIndices[start:stop] = [data.measurementIndex for data in dataList]
+        self.allStartTimes[start:stop] = [data.startEpoch for data in dataList]
+        self.allFinishTimes[start:stop] = [data.finishEpoch for data in dataList]
+        self.hotCount += len(dataList)
+        self.Spill()
+
+        self.sweepsAppended.emit(start, stop)
+
+
+    def AttachRecording(self, recording:Recording) -> int:
+        """Replaces the content by the sweeps of a recording without reading their data
+
+        Only the last run of sweeps with equal frequencies and electrode combinations is used. The current content
+        is only cleared once the run could be mapped, so an invalid recording leaves it in place.
+
+        Args:
+            recording (Recording): opened recording
+
+        Raises:
+            ValueError: Thrown if the recording contains no sweeps or its last run can not be mapped
+
+        Returns:
+            int: number of earlier sweeps that were skipped because of different settings
+        """
+
+        headers = recording.Headers()
+        first = len(headers)
+        if first > 0:
+            lastFrequencies, _, _, lastElectrodes = recording[-1].Arrays()
+        # the header sizes are compared first, so the axes of sweeps with other shapes are never read
+        while first > 0 and headers[first - 1][2:7] == headers[-1][2:7]:
+            frequencies, _, _, electrodes = recording[first - 1].Arrays()
+            if not (np.array_equal(frequencies, lastFrequencies) and np.array_equal(electrodes, lastElectrodes)):
+                break
+            first -= 1
+
+        if first == len(headers):
+            raise ValueError("The recording contains no measurements.")
+        impedances, timeStamps = recording.Cube(first, len(headers))
+
+        self.Clear()
+        lastRecord = recording[first]
+        self.recording = recording
+        self.frequencies = np.array(lastRecord.frequencies)
+        self.electrodes = lastRecord.electrodes
+        self.coldSegments = [(impedances, timeStamps)]
+        self.coldCount = len(impedances)
+        self.hotImpedances = np.empty((0,) + impedances.shape[1:], dtype=np.complex64)
+        self.hotTimeStamps = None
+
+        count = len(headers) - first
+        self.allMeasurementIndices = np.array([fields[1] for fields in headers[first:]], dtype=np.int64)
+        self.allStartTimes = np.array([fields[7] for fields in headers[first:]], dtype=np.float64)
+        self.allFinishTimes = np.array([fields[8] for fields in headers[first:]], dtype=np.float64)
+
+        self.sweepsAppended.emit(0, count)
+
+        return first
+
+
+    def Load(self, dataList:list[EISData]) -> int:
+        """Replaces the content by sweeps, e.g. read from a csv file
+
+        Like AttachRecording only the last run of sweeps with equal frequencies and electrode combinations is used,
+        the current content is only cleared once that run is known.
+
+        Args:
+            dataList (list[EISData]): sweeps in measurement order, possibly of several configurations
+
+        Raises:
+            ValueError: Thrown if dataList is empty
+
+        Returns:
+            int: number of earlier sweeps that were skipped because of different settings
+        """
+
+        if not dataList:
+            raise ValueError("The file contains no measurements.")
+
+        last = dataList[-1]
+        first = len(dataList) - 1
+        while first > 0:
+            previous = dataList[first - 1]
+            if previous.axes is not last.axes and not (np.array_equal(previous.frequencies, last.frequencies) and previous.electrodes == last.electrodes):
+                break
+            first -= 1
+
+        self.Clear()
+        self.Extend(dataList[first:])
+
+        return first
+
+
+    def HotTimeStamps(self) -> np.ndarray:
+        """Time stamp cube of the hot sweeps, a shared read only NaN view if none of them has device time stamps
+        """
+
+        if self.hotTimeStamps is None:
+            return MissingTimeStamps(self.hotImpedances.shape)
+        return self.hotTimeStamps
+
+
+    def Row(self, index:int) -> tuple[np.ndarray, np.ndarray]:
+        """Impedances and time stamps (channels, frequencies) of one sweep as views
+
+        Args:
+            index (int): sweep index, negative values count from the end
+        """
+
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("Sweep index out of range.")
+
+        if index >= self.coldCount:
+            return self.hotImpedances[index - self.coldCount], self.HotTimeStamps()[index - self.coldCount]
+
+        for impedances, timeStamps in self.coldSegments:
+            if index < len(impedances):
+                return impedances[index], timeStamps[index]
+            index -= len(impedances)
+
+
+    def Values(self, channel:int | slice = slice(None), frequency:int | slice = slice(None), start:int = 0, stop:int | None = None) -> np.ndarray:
+        """Impedances of sweeps start to stop, spilled sweeps are read from disk
+
+        The result is a view if all sweeps are in memory or in the same memory map, otherwise a copy.
+
+        Args:
+            channel (int | slice, optional): electrode combination index. Defaults to all.
+            frequency (int | slice, optional): frequency index. Defaults to all.
+            start (int, optional): first sweep. Defaults to 0.
+            stop (int | None, optional): sweep after the last one, None for all. Defaults to None.
+
+        Returns:
+            np.ndarray: impedances with the sweeps as first axis
+        """
+
+        return self.Collect(0, channel, frequency, start, stop)
+
+
+    def TimeStamps(self, channel:int | slice = slice(None), frequency:int | slice = slice(None), start:int = 0, stop:int | None = None) -> np.ndarray:
+        """Measurement times in seconds after the start of their sweep like Values, NaN without device time stamps
+        """
+
+        return self.Collect(1, channel, frequency, start, stop)
+
+
+    def Collect(self, part:int, channel:int | slice, frequency:int | slice, start:int, stop:int | None) -> np.ndarray:
+        """Selection of the impedance (part 0) or time stamp (part 1) cubes over all segments for Values and TimeStamps
+        """
+
+        stop = len(self) if stop is None else min(stop, len(self))
+        parts = []
+        segmentStart = 0
+        for cubes in self.coldSegments + [(self.hotImpedances[:self.hotCount], self.HotTimeStamps()[:self.hotCount])]:
+            segmentStop = segmentStart + len(cubes[part])
+            if start < segmentStop and stop > segmentStart:
+                parts.append(cubes[part][max(start - segmentStart, 0):stop - segmentStart, channel, frequency])
+            segmentStart = segmentStop
+
+        if len(parts) == 1:
+            return parts[0]
+        if not parts:
+            return np.empty(0, dtype=np.complex64 if part == 0 else np.float64)
+
+        return np.concatenate(parts)
+
+
+    def ElapsedSeconds(self, start:int = 0, stop:int | None = None, channel:int | None = None, frequency:int | None = None) -> np.ndarray:
+        """Start times of sweeps start to stop in seconds after the start of the first sweep
+
+        With channel and frequency the measurement time of that point is used where the device sent time stamps.
+        """
+
+        if len(self) == 0:
+            return np.empty(0)
+
+        elapsed = self.startTimes[start:stop] - self.allStartTimes[0]
+        if channel is not None and frequency is not None:
+            pointTimes = self.TimeStamps(channel, frequency, start, stop)
+            elapsed = np.where(np.isnan(pointTimes), elapsed, elapsed + pointTimes)
+
+        return elapsed
+
+
+    def Descriptions(self, start:int = 0, stop:int | None = None, short:bool = False) -> list[str]:
+        """Texts "measurement index: start - finish" of sweeps start to stop for comboboxes
+        """
+
+        stop = len(self) if stop is None else stop
+        descriptions = []
+        for index, startTime, finishTime in zip(self.allMeasurementIndices[start:stop], self.allStartTimes[start:stop], self.allFinishTimes[start:stop]):
+            startText, finishText = FormatTime(startTime, short), FormatTime(finishTime, short)
+            descriptions.append(f"{index}: {startText} - {finishText}")
+
+        return descriptions
+
+
+    def Sweep(self, index:int) -> StoredSweep:
+        return StoredSweep(self, index)
+
+
+    def Sweeps(self) -> list[StoredSweep]:
+        return [StoredSweep(self, index) for index in range(len(self))]
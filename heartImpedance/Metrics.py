@@ -0,0 +1,102 @@
+import bisect, math, threading, time
+
+class Histogram():
+    """Histogram of durations with logarithmic buckets, percentiles are accurate to about 19 %
+    """
+
+    # upper bucket bounds from 1 us to about 300 s, 4 buckets per factor of two
+    bounds = [1e-6 * 2 ** (index / 4) for index in range(113)]
+
+    def __init__(self):
+        self.counts = [0] * (len(Histogram.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.minimum = math.inf
+        self.maximum = 0.0
+
+
+    def Observe(self, value:float):
+        self.counts[bisect.bisect_left(Histogram.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.minimum = min(self.minimum, value)
+        self.maximum = max(self.maximum, value)
+
+
+    def Percentile(self, percent:float) -> float:
+        """Upper bound of the bucket holding the percentile, clamped to the observed range
+        """
+
+        rank = math.ceil(self.count * percent / 100)
+        cumulated = 0
+        for index, count in enumerate(self.counts):
+            cumulated += count
+            if cumulated >= rank:
+                bound = Histogram.bounds[index] if index < len(Histogram.bounds) else self.maximum
+                return min(max(bound, self.minimum), self.maximum)
+
+        return self.maximum
+
+
+    def Summary(self) -> dict:
+        if self.count == 0:
+            return {"count": 0}
+
+        return {"count": self.count, "mean": self.total / self.count, "min": self.minimum, "p50": self.Percentile(50),
+                "p90": self.Percentile(90), "p99": self.Percentile(99), "max": self.maximum}
+
+
+class Metrics():
+    """Opt-in counters and duration histograms of the acquisition hot path
+
+    ImpedanceAnalyser, FrameReader and MeasurementWorker only record values while a Metrics object is attached
+    (see ImpedanceAnalyser.EnableMetrics), otherwise the cost is a single None check. Recording and Snapshot
+    can be called from different threads.
+
+    Counters: bytesOut, bytesIn, commands, frames, points, sweeps
+    Histograms (seconds): roundTrip.0xCT per command code, serialWait, decode, muxSetup, sweep, emitLatency, tabUpdate
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.Reset()
+
+
+    def Reset(self):
+        """Clears all values and restarts the rate measurement
+        """
+
+        with self.lock:
+            self.counters:dict[str, int] = {}
+            self.histograms:dict[str, Histogram] = {}
+            self.startTime = time.perf_counter()
+
+
+    def Increment(self, name:str, value:int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def Observe(self, name:str, seconds:float):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.Observe(seconds)
+
+
+    def Snapshot(self) -> dict:
+        """Current values as plain dict
+
+        Returns:
+            dict: {"elapsed": s, "counters": {...}, "rates": {counter: per second}, "histograms": {name: {count, mean, min, p50, p90, p99, max}}}
+        """
+
+        with self.lock:
+            elapsed = time.perf_counter() - self.startTime
+            counters = dict(self.counters)
+            histograms = {name: histogram.Summary() for name, histogram in sorted(self.histograms.items())}
+
+        return {"elapsed": elapsed, "counters": counters,
+                "rates": {name: value / elapsed for name, value in counters.items()} if elapsed > 0 else {},
+                "histograms": histograms}
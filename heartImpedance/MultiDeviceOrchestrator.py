@@ -0,0 +1,205 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from HelperFunctions import WallClock
+from ImpedanceAnalyser import ImpedanceAnalyser
+from ProtocolTrace import logger
+
+class MultiDeviceOrchestrator():
+    """Runs synchronised sweeps on several ISX-3 devices in parallel, every device on its own thread
+
+    Each device keeps its own configuration (frequencies, channel list, ...) which has to be set on the
+    analysers before measuring. The sweeps of all devices are started together and their result points
+    are merged into a single timeline.
+    """
+
+    def __init__(self, analysers:list[ImpedanceAnalyser]):
+        """Constructor, the orchestrator takes ownership of the analysers
+
+        Args:
+            analysers (list[ImpedanceAnalyser]): connected devices, each one on its own port
+
+        Raises:
+            ValueError: Thrown if no analyser is given
+        """
+
+        if len(analysers) == 0:
+            raise ValueError("At least one analyser is required.")
+
+        self.analysers = list(analysers)
+        self.executor = ThreadPoolExecutor(max_workers=len(self.analysers), thread_name_prefix="ISX3")
+        self.buffers = [None] * len(self.analysers)
+
+
+    @classmethod
+    def FromComPorts(cls, comPorts:list[str]) -> "MultiDeviceOrchestrator":
+        """Opens one ImpedanceAnalyser per device address
+
+        Args:
+            comPorts (list[str]): serial ports or "tcp://host:port" addresses of the devices
+
+        Returns:
+            MultiDeviceOrchestrator: orchestrator owning the opened devices
+        """
+
+        return cls([ImpedanceAnalyser(comPort) for comPort in comPorts])
+
+
+    def Close(self):
+        """Stops the device threads and closes the serial ports
+        """
+
+        self.executor.shutdown(wait=True)
+        for analyser in self.analysers:
+            if analyser.device is not None:
+                analyser.device.close()
+
+
+    def ForEach(self, function, *args) -> list:
+        """Calls function(analyser, *args) for every device in parallel
+
+        Args:
+            function (_type_): callable taking the analyser as first argument, e.g. ImpedanceAnalyser.SetSetup
+
+        Raises:
+            Exception: Thrown with the device index if a call failed, after all calls are finished
+
+        Returns:
+            list: return values in the order of the analysers
+        """
+
+        futures = [self.executor.submit(function, analyser, *args) for analyser in self.analysers]
+
+        results = []
+        error = None
+        for deviceIndex, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(None)
+                if error is None:
+                    error = Exception(f"Device {deviceIndex}: {e}")
+
+        if error is not None:
+            raise error
+
+        return results
+
+
+    def SetSyncTime(self, syncTime:int):
+        """0xB9 - Sets the same sync time on every device so their measurement timing is aligned
+
+        Args:
+            syncTime (int): sync time in microseconds, needs to be between 0 and 180e6
+        """
+
+        self.ForEach(ImpedanceAnalyser.SetSyncTime, syncTime)
+
+
+    def MeasureDevice(self, deviceIndex:int, barrier:threading.Barrier) -> tuple:
+        """Runs one sweep on a single device, executed on the thread of the device
+
+        Args:
+            deviceIndex (int): index of the analyser
+            barrier (threading.Barrier): released once every device is configured
+
+        Returns:
+            tuple: same tuple as ImpedanceAnalyser.GetMeasurements plus the host times in s at which the sweep was started and finished
+        """
+
+        analyser = self.analysers[deviceIndex]
+        buffers = self.buffers[deviceIndex]
+        if buffers is None or buffers[0].shape != (len(analyser.muxElConfig), analyser.fnum):
+            buffers = analyser.AllocateResultBuffers()
+            self.buffers[deviceIndex] = buffers
+
+        # Configure the first channel chunk in advance, so only the start commands are sent after the barrier
+        try:
+            analyser.CheckSettings()
+            analyser.ConfigureChannels(range(min(128, len(analyser.muxElConfig))))
+        except Exception:
+            barrier.abort()
+            raise
+        barrier.wait()
+
+        hostStart = WallClock()
+        result = analyser.GetMeasurements(buffers)
+        return result + (hostStart, WallClock())
+
+
+    def GetMeasurements(self) -> tuple[list[tuple], tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]:
+        """Runs one sweep on all devices in parallel and merges the result points into one timeline
+
+        Raises:
+            Exception: Thrown with the device index if a device failed
+
+        Returns:
+            tuple[list[tuple], tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]]: (results of every device as returned by ImpedanceAnalyser.GetMeasurements, merged timeline see MergeTimeline), the device arrays are reused by the next call
+        """
+
+        barrier = threading.Barrier(len(self.analysers))
+        futures = [self.executor.submit(self.MeasureDevice, deviceIndex, barrier) for deviceIndex in range(len(self.analysers))]
+
+        results = []
+        error = None
+        for deviceIndex, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except threading.BrokenBarrierError:
+                results.append(None)
+            except Exception as e:
+                results.append(None)
+                if error is None:
+                    error = Exception(f"Device {deviceIndex}: {e}")
+
+        if error is not None:
+            raise error
+
+        hostStarts = [result[-2] for result in results]
+        hostFinishes = [result[-1] for result in results]
+        logger.debug("Sweep of %d devices, start spread %.3f ms", len(results), 1000 * (max(hostStarts) - min(hostStarts)))
+
+        results = [result[:-2] for result in results]
+        return results, self.MergeTimeline(results, hostStarts, hostFinishes)
+
+
+    def MergeTimeline(self, results:list[tuple], hostStarts:list[float], hostFinishes:list[float]) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Merges the result points of all devices, sorted by their measurement time
+
+        The device time stamps are placed on the host clock by ImpedanceAnalyser.PointTimes. Without time stamps the
+        points are spread evenly over the sweep duration.
+
+        Args:
+            results (list[tuple]): results of every device as returned by ImpedanceAnalyser.GetMeasurements
+            hostStarts (list[float]): host time in s at which the sweep of each device was started
+            hostFinishes (list[float]): host time in s at which the sweep of each device was finished
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (time in s since epoch, device index, channel index, frequency index, complex impedance), one entry per point
+        """
+
+        times = []
+        devices = []
+        channels = []
+        frequencies = []
+        impedances = []
+        for deviceIndex, (analyser, result, hostStart, hostFinish) in enumerate(zip(self.analysers, results, hostStarts, hostFinishes)):
+            resReal, resImag, _, _, resTime, _, _ = result
+
+            pointTimes = analyser.PointTimes(resTime, hostStart)
+            if pointTimes is None:
+                pointTimes = np.linspace(hostStart, hostFinish, resReal.size, endpoint=False)
+            else:
+                pointTimes = hostStart + pointTimes.reshape(-1)
+
+            channelIndex, frequencyIndex = np.divmod(np.arange(resReal.size), resReal.shape[1])
+            times.append(pointTimes)
+            devices.append(np.full(resReal.size, deviceIndex))
+            channels.append(channelIndex)
+            frequencies.append(frequencyIndex)
+            impedances.append((resReal + 1j * resImag).reshape(-1))
+
+        times = np.concatenate(times)
+        order = np.argsort(times, kind="stable")
+
+        return times[order], np.concatenate(devices)[order], np.concatenate(channels)[order], np.concatenate(frequencies)[order], np.concatenate(impedances)[order]
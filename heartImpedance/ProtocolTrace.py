@@ -0,0 +1,85 @@
+import logging, struct, threading, time
+from collections.abc import Iterator
+
+# Frame level trace of the device communication, TX/RX frames are logged with DEBUG level
+logger = logging.getLogger("heartImpedance.protocol")
+
+def EnableProtocolTrace(level:int = logging.DEBUG):
+    """Turns on the protocol trace, a handler has to be configured e.g. with logging.basicConfig
+
+    Args:
+        level (int, optional): logging level, DEBUG shows every frame. Defaults to logging.DEBUG.
+    """
+
+    logger.setLevel(level)
+
+
+class CaptureFile():
+    """Binary capture of the raw bytes sent to and received from the device for offline analysis
+
+    After an 8 byte magic each record consists of a little endian header (uint64 wall clock time in ns,
+    uint8 direction, uint32 length) followed by the data bytes.
+    """
+
+    MAGIC = b"ISX3CAP1"
+    TX = 0
+    RX = 1
+    recordHeader = struct.Struct("<QBI")
+
+    def __init__(self, path:str):
+        """Creates the capture file, an existing file is overwritten
+
+        Args:
+            path (str): path of the capture file
+        """
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "wb")
+        self.file.write(CaptureFile.MAGIC)
+
+
+    def Write(self, direction:int, data:bytes | bytearray | memoryview):
+        """Appends one record
+
+        Args:
+            direction (int): CaptureFile.TX or CaptureFile.RX
+            data (bytes | bytearray | memoryview): raw bytes
+        """
+
+        with self.lock:
+            self.file.write(CaptureFile.recordHeader.pack(time.time_ns(), direction, len(data)))
+            self.file.write(data)
+
+
+    def Close(self):
+        """Flushes and closes the file
+        """
+
+        with self.lock:
+            self.file.close()
+
+
+def ReadCapture(path:str) -> Iterator[tuple[int, int, bytes]]:
+    """Reads a capture file written by CaptureFile
+
+    Args:
+        path (str): path of the capture file
+
+    Raises:
+        ValueError: Thrown if the file is no capture file
+
+    Yields:
+        Iterator[tuple[int, int, bytes]]: (time in ns, direction, data) for each record
+    """
+
+    with open(path, "rb") as file:
+        if file.read(len(CaptureFile.MAGIC)) != CaptureFile.MAGIC:
+            raise ValueError(f"{path} is not a capture file.")
+
+        while True:
+            header = file.read(CaptureFile.recordHeader.size)
+            if len(header) < CaptureFile.recordHeader.size:
+                return
+            timeNs, direction, length = CaptureFile.recordHeader.unpack(header)
+            yield timeNs, direction, file.read(length)
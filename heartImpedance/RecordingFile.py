@@ -0,0 +1,598 @@
+import json, mmap, os, struct, threading, time
+from collections.abc import Iterator
+import numpy as np
+from DataManager import EISData
+
+# Binary recording of EISData sweeps (*.eisr)
+#
+# File header: MAGIC, uint32 length of a JSON description, the JSON text, zero padding to 8 bytes.
+# Then one record per sweep: recordHeader followed by the payload arrays, each padded to 8 bytes:
+#   frequencies   float64    (frequencies)
+#   impedances    complex64  (channels, frequencies), real and imaginary part as interleaved float32
+#   timeStamps    float64    (channels, frequencies), seconds after the start time, NaN if unknown
+#   electrodes    int16      (electrode combinations, electrodes per combination)
+# All numbers are little endian, so the arrays can be used directly from a memory map.
+
+MAGIC = b"EISREC02"
+INDEX_MAGIC = b"EISRIDX1"
+RECORD_TAG = b"SWP2"
+# tag, measurement index, channels, frequencies, electrode combinations, electrodes per combination, payload length, start time, finish time
+# (wall clock seconds since epoch like WallClock, NaN if unknown)
+recordHeader = struct.Struct("<4sIIIIIQdd")
+# index sidecar (*.eisr.idx): INDEX_MAGIC followed by one entry (offset, length, measurement index) per completely written record
+indexEntry = struct.Struct("<QQI")
+FORMAT_DESCRIPTION = {
+    "format": "heartImpedance EIS recording",
+    "version": 2,
+    "recordHeader": "<4sIIIIIQdd: tag, measurementIndex, channels, frequencies, electrodeCombinations, electrodesPerCombination, payloadLength, startTime, finishTime",
+    "payload": ["frequencies <f8 (F)", "impedances <c8 (C, F)", "timeStamps <f8 (C, F)", "electrodes <i2 (E, W)"],
+    "alignment": 8,
+}
+
+def Padding(length:int) -> int:
+    return -length % 8
+
+
+def EncodeFileHeader() -> bytes:
+    """File header with the format description
+    """
+
+    description = json.dumps(FORMAT_DESCRIPTION).encode()
+    header = MAGIC + struct.pack("<I", len(description)) + description
+
+    return header + bytes(Padding(len(header)))
+
+
+def EncodeRecord(data:EISData) -> list[bytes | memoryview]:
+    """Encodes one sweep into the buffers of a record, written in this order they form the record
+
+    Args:
+        data (EISData): sweep to encode
+
+    Returns:
+        list[bytes | memoryview]: record header followed by the payload buffers and their padding
+    """
+
+    frequencies = np.ascontiguousarray(data.frequencies, dtype="<f8")
+    impedances = np.ascontiguousarray(data.impedances, dtype="<c8")
+    timeStamps = np.ascontiguousarray(np.asarray(data.timeStamps, dtype=np.float64).reshape(impedances.shape), dtype="<f8")
+    electrodes = np.asarray(data.electrodes if data.electrodes else np.zeros((0, 4)), dtype="<i2")
+    if electrodes.ndim == 1:
+        electrodes = electrodes.reshape(len(electrodes), -1)
+
+    payload = []
+    for array in (frequencies, impedances, timeStamps, electrodes):
+        payload.append(memoryview(array).cast("B"))
+        payload.append(bytes(Padding(array.nbytes)))
+
+    header = recordHeader.pack(RECORD_TAG, int(data.measurementIndex), impedances.shape[0], impedances.shape[1], electrodes.shape[0], electrodes.shape[1],
+                               sum(len(buffer) for buffer in payload), data.startEpoch, data.finishEpoch)
+
+    return [header] + payload
+
+
+def SaveRecording(path:str, dataList:list[EISData]):
+    """Writes all sweeps into a new recording file and its index
+
+    The files are written under a temporary name and replace an existing recording only when complete,
+    so the sweeps may be lazily read from the recording that is overwritten.
+
+    Args:
+        path (str): path of the recording, an existing file is overwritten
+        dataList (list[EISData]): sweeps in recording order
+    """
+
+    with open(path + ".tmp", "wb") as file, open(path + ".idx.tmp", "wb") as indexFile:
+        file.write(EncodeFileHeader())
+        indexFile.write(INDEX_MAGIC)
+        for data in dataList:
+            buffers = EncodeRecord(data)
+            indexFile.write(indexEntry.pack(file.tell(), sum(len(buffer) for buffer in buffers), int(data.measurementIndex)))
+            file.writelines(buffers)
+
+    os.replace(path + ".tmp", path)
+    os.replace(path + ".idx.tmp", path + ".idx")
+
+
+def RecordsStart(buffer) -> int:
+    """Offset of the first record
+
+    Raises:
+        ValueError: Thrown if the buffer does not start with a recording file header
+    """
+
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        if bytes(buffer[:len(MAGIC) - 2]) == MAGIC[:-2]:
+            raise ValueError(f"Recording format version {bytes(buffer[len(MAGIC) - 2:len(MAGIC)]).decode(errors='replace')} is not supported.")
+        raise ValueError("Not a heartImpedance recording file.")
+
+    descriptionLength = struct.unpack_from("<I", buffer, len(MAGIC))[0]
+    headerLength = len(MAGIC) + 4 + descriptionLength
+
+    return headerLength + Padding(headerLength)
+
+
+def IterRecordHeaders(buffer, offset:int | None = None) -> Iterator[tuple[int, tuple]]:
+    """Walks the record headers, a truncated last record (e.g. after a crash) is ignored
+
+    Args:
+        buffer (_type_): bytes, mmap or memoryview of the whole file
+        offset (int | None, optional): offset of the first record to read, None starts after the file header. Defaults to None.
+
+    Raises:
+        ValueError: Thrown if a record header is corrupted
+
+    Yields:
+        Iterator[tuple[int, tuple]]: (offset of the record, unpacked recordHeader fields)
+    """
+
+    if offset is None:
+        offset = RecordsStart(buffer)
+
+    while offset + recordHeader.size <= len(buffer):
+        fields = recordHeader.unpack_from(buffer, offset)
+        if fields[0] != RECORD_TAG:
+            raise ValueError(f"Corrupted record at offset {offset}.")
+        if offset + recordHeader.size + fields[6] > len(buffer):
+            return
+
+        yield offset, fields
+        offset += recordHeader.size + fields[6]
+
+
+def ReadRecordArrays(buffer, offset:int, fields:tuple) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the payload arrays of a record as views into buffer
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]: (frequencies, impedances, time stamps, electrodes)
+    """
+
+    _, _, numChannels, numFrequencies, numElectrodes, electrodeWidth, _, _, _ = fields
+
+    arrays = []
+    position = offset + recordHeader.size
+    for dtype, shape in (("<f8", (numFrequencies,)), ("<c8", (numChannels, numFrequencies)), ("<f8", (numChannels, numFrequencies)), ("<i2", (numElectrodes, electrodeWidth))):
+        count = int(np.prod(shape))
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=position).reshape(shape)
+        arrays.append(array)
+        position += array.nbytes + Padding(array.nbytes)
+
+    return tuple(arrays)
+
+
+def ReadRecord(buffer, offset:int, fields:tuple) -> EISData:
+    """Creates the EISData of one record, the arrays are copied out of the buffer
+    """
+
+    frequencies, impedances, timeStamps, electrodes = ReadRecordArrays(buffer, offset, fields)
+
+    data = EISData( timeStamp=timeStamps,
+                    frequencies=np.array(frequencies),
+                    electrodes=electrodes.tolist(),
+                    realParts=impedances.real,
+                    imagParts=impedances.imag,
+                    startTime=fields[7],
+                    finishTime=fields[8],
+                    singlePrecision=True)
+    data.measurementIndex = fields[1]
+
+    return data
+
+
+def LoadRecording(path:str) -> list[EISData]:
+    """Reads all sweeps of a recording file through a memory map
+
+    Args:
+        path (str): path of the recording
+
+    Returns:
+        list[EISData]: sweeps in recording order
+    """
+
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        return [ReadRecord(buffer, offset, fields) for offset, fields in IterRecordHeaders(buffer)]
+
+
+def ReadIndex(path:str, fileLength:int | None = None) -> np.ndarray:
+    """Reads the record offsets of the index sidecar written by RecordingWriter
+
+    Args:
+        path (str): path of the recording, the index is read from path + ".idx"
+        fileLength (int | None, optional): length of the recording, entries of records reaching beyond it are dropped. Defaults to None.
+
+    Raises:
+        ValueError: Thrown if the index file is invalid
+
+    Returns:
+        np.ndarray: structured array with fields offset, length and measurementIndex
+    """
+
+    with open(path + ".idx", "rb") as file:
+        content = file.read()
+
+    if content[:len(INDEX_MAGIC)] != INDEX_MAGIC:
+        raise ValueError(f"{path}.idx is not a recording index.")
+
+    # an entry cut off by a crash is ignored
+    numEntries = (len(content) - len(INDEX_MAGIC)) // indexEntry.size
+    entries = np.frombuffer(content, dtype=np.dtype([("offset", "<u8"), ("length", "<u8"), ("measurementIndex", "<u4")]), count=numEntries, offset=len(INDEX_MAGIC))
+    if fileLength is not None:
+        entries = entries[entries["offset"] + entries["length"] <= fileLength]
+
+    return entries.copy()
+
+
+def CopyPrefix(source:str, target:str, length:int):
+    """Copies the first length bytes of source into a new file target, inside the kernel where the OS supports it
+    """
+
+    with open(source, "rb") as sourceFile, open(target, "wb") as targetFile:
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < length:
+                    count = os.copy_file_range(sourceFile.fileno(), targetFile.fileno(), length - copied, copied, copied)
+                    if count == 0:
+                        break
+                    copied += count
+            except OSError:
+                # e.g. not supported between these file systems, the rest is copied below
+                pass
+
+        sourceFile.seek(copied)
+        targetFile.seek(copied)
+        while copied < length:
+            chunk = sourceFile.read(min(length - copied, 1024 * 1024))
+            if not chunk:
+                break
+            targetFile.write(chunk)
+            copied += len(chunk)
+
+
+class RecordingWriter():
+    """Append-only writer of a recording file, used to store every sweep as soon as it is measured
+
+    Records are collected in a bounded buffer and written once it is full or flushInterval has passed.
+    With the "always" and "interval" fsync policies the index sidecar only gets an entry after its record
+    was synced, so after a crash the index never points to incomplete data and a truncated record at the
+    end of the file is ignored by the readers. With "never" the entries are written right after their
+    records and the OS may store them first, Recording then falls back to scanning the record tags.
+    """
+
+    def __init__(self, path:str, bufferSize:int = 4 * 1024 * 1024, flushInterval:float = 1.0, fsyncPolicy:str = "interval", fsyncInterval:float = 5.0):
+        """Creates the recording and its index, existing files are overwritten
+
+        Args:
+            path (str): path of the recording, the index is written to path + ".idx"
+            bufferSize (int, optional): maximal number of buffered bytes before writing. Defaults to 4 MiB.
+            flushInterval (float, optional): maximal time in seconds a sweep stays buffered. Defaults to 1.0.
+            fsyncPolicy (str, optional): "always" syncs after every write, "interval" at most every fsyncInterval seconds and holds back the index entries until then, "never" leaves it to the OS. Defaults to "interval".
+            fsyncInterval (float, optional): seconds between two syncs for the "interval" policy. Defaults to 5.0.
+
+        Raises:
+            ValueError: Thrown if the fsync policy is unknown
+        """
+
+        if fsyncPolicy not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsyncPolicy}")
+
+        self.path = path
+        self.bufferSize = bufferSize
+        self.flushInterval = flushInterval
+        self.fsyncPolicy = fsyncPolicy
+        self.fsyncInterval = fsyncInterval
+        self.lock = threading.Lock()
+
+        self.file = open(path, "wb")
+        self.indexFile = open(path + ".idx", "wb")
+        self.file.write(EncodeFileHeader())
+        self.indexFile.write(INDEX_MAGIC)
+        self.position = self.file.tell()
+
+        self.pending = []
+        self.pendingBytes = 0
+        self.pendingIndex = []
+        self.unsyncedIndex = []
+        self.count = 0
+        self.lastFlush = time.monotonic()
+        self.lastSync = time.monotonic()
+        self.Sync()
+
+
+    def Append(self, data:EISData) -> int:
+        """Adds one sweep, it is written once the buffer is full or flushInterval has passed
+
+        Args:
+            data (EISData): sweep to append
+
+        Returns:
+            int: offset of the record in the file, e.g. for Recording.Extend after the next Flush
+        """
+
+        buffers = EncodeRecord(data)
+        length = sum(len(buffer) for buffer in buffers)
+
+        with self.lock:
+            offset = self.position + self.pendingBytes
+            # the arrays of data may be changed later, so the buffered record gets its own copy
+            self.pending.append(b"".join(buffers))
+            self.pendingIndex.append(indexEntry.pack(offset, length, int(data.measurementIndex)))
+            self.pendingBytes += length
+            self.count += 1
+
+            if self.pendingBytes >= self.bufferSize or time.monotonic() - self.lastFlush >= self.flushInterval:
+                self.FlushLocked()
+
+        return offset
+
+
+    def Flush(self, sync:bool = False):
+        """Writes all buffered sweeps
+
+        Args:
+            sync (bool, optional): fsync regardless of the policy. Defaults to False.
+        """
+
+        with self.lock:
+            self.FlushLocked(sync)
+
+
+    def FlushLocked(self, sync:bool = False):
+        # also writes out the file header after creation
+        if self.pending:
+            self.file.writelines(self.pending)
+            self.position += self.pendingBytes
+        self.file.flush()
+
+        sync = sync or self.fsyncPolicy == "always" or (self.fsyncPolicy == "interval" and time.monotonic() - self.lastSync >= self.fsyncInterval)
+        if sync:
+            os.fsync(self.file.fileno())
+
+        # index entries only after their records are on disk, until the next sync they wait in unsyncedIndex
+        self.unsyncedIndex.extend(self.pendingIndex)
+        if sync or self.fsyncPolicy == "never":
+            self.indexFile.writelines(self.unsyncedIndex)
+            self.indexFile.flush()
+            if sync:
+                os.fsync(self.indexFile.fileno())
+            self.unsyncedIndex.clear()
+        if sync:
+            self.lastSync = time.monotonic()
+
+        self.pending.clear()
+        self.pendingIndex.clear()
+        self.pendingBytes = 0
+        self.lastFlush = time.monotonic()
+
+
+    def Sync(self):
+        self.Flush(sync=True)
+
+
+    def Finalize(self, targetPath:str):
+        """Makes the recording complete on disk and copies it with its index to targetPath, recording can continue afterwards
+
+        Only the sync and the lengths are taken under the lock, the copy runs without it, so Append does not wait
+        for it. Sweeps appended meanwhile are not part of the copy.
+
+        Args:
+            targetPath (str): path of the saved recording
+        """
+
+        with self.lock:
+            self.FlushLocked(sync=True)
+            length = self.position
+            indexLength = self.indexFile.tell()
+
+        if os.path.abspath(targetPath) != os.path.abspath(self.path):
+            # written under a temporary name like SaveRecording, so an existing recording is only replaced when complete
+            CopyPrefix(self.path, targetPath + ".tmp", length)
+            CopyPrefix(self.path + ".idx", targetPath + ".idx.tmp", indexLength)
+            os.replace(targetPath + ".tmp", targetPath)
+            os.replace(targetPath + ".idx.tmp", targetPath + ".idx")
+
+
+    def Close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.FlushLocked(sync=True)
+            self.file.close()
+            self.indexFile.close()
+
+
+class LazyEISData(EISData):
+    """EISData of one record of a memory mapped Recording
+
+    Only the record header is read on creation, the arrays are views into the map that are created when a tab
+    uses them, so the operating system pages in just the displayed sweeps. Use Materialize for an independent copy.
+    """
+
+    def __init__(self, buffer, offset:int):
+        """Reads the record header, the measurement index is taken from the record
+
+        Args:
+            buffer (_type_): memory map of the recording
+            offset (int): offset of the record
+        """
+
+        self.buffer = buffer
+        self.offset = offset
+        self.fields = recordHeader.unpack_from(buffer, offset)
+        self.measurementIndex = self.fields[1]
+        self.startEpoch = self.fields[7]
+        self.finishEpoch = self.fields[8]
+        self.derivedCache = None
+        self.electrodeList = None
+
+
+    def Arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        return ReadRecordArrays(self.buffer, self.offset, self.fields)
+
+
+    @property
+    def frequencies(self) -> np.ndarray:
+        return self.Arrays()[0]
+
+    @property
+    def impedances(self) -> np.ndarray:
+        return self.Arrays()[1]
+
+    @property
+    def timeStamps(self) -> np.ndarray:
+        return self.Arrays()[2]
+
+    @property
+    def hasTimeStamps(self) -> bool:
+        return not np.isnan(self.timeStamps).all()
+
+    @property
+    def electrodes(self) -> list[list[int]]:
+        if self.electrodeList is None:
+            self.electrodeList = self.Arrays()[3].tolist()
+        return self.electrodeList
+
+
+    def Materialize(self) -> EISData:
+        """Copies the record out of the map into a regular EISData
+        """
+
+        return ReadRecord(self.buffer, self.offset, self.fields)
+
+
+class Recording():
+    """Memory mapped recording file giving LazyEISData sweeps
+
+    The record offsets are taken from the index sidecar if there is one and completed by walking the record
+    headers after its last entry, so opening a large recording neither reads nor copies the sweep data.
+    """
+
+    def __init__(self, path:str):
+        """Maps the file and builds the index of its records
+
+        Args:
+            path (str): path of the recording
+
+        Raises:
+            ValueError: Thrown if the file is not a recording
+        """
+
+        self.path = path
+        self.Map()
+        self.offsets = self.BuildIndex()
+
+
+    def Map(self):
+        with open(self.path, "rb") as file:
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        # tabs read single sweeps or single values of many sweeps, read ahead would page in data that is not shown
+        if hasattr(mmap, "MADV_RANDOM"):
+            self.buffer.madvise(mmap.MADV_RANDOM)
+
+
+    def Extend(self, offsets:list[int]):
+        """Adds records a RecordingWriter appended and flushed since the file was opened, without reading the index
+
+        The file is mapped again, LazyEISData and cubes of the previous map stay valid.
+
+        Args:
+            offsets (list[int]): record offsets returned by RecordingWriter.Append
+        """
+
+        self.Map()
+        self.offsets.extend(offsets)
+
+
+    def BuildIndex(self) -> list[int]:
+        """Offsets of all complete records
+
+        Returns:
+            list[int]: record offsets in file order
+        """
+
+        start = RecordsStart(self.buffer)
+        try:
+            entries = ReadIndex(self.path, len(self.buffer))
+        except (OSError, ValueError):
+            entries = None
+
+        offsets = []
+        # an index not belonging to this file is ignored
+        if entries is not None and len(entries) > 0 and self.buffer[int(entries["offset"][-1]):int(entries["offset"][-1]) + len(RECORD_TAG)] == RECORD_TAG:
+            offsets = entries["offset"].tolist()
+            start = int(entries["offset"][-1] + entries["length"][-1])
+
+        # records written after the last index entry, or all of them without an index
+        offsets.extend(offset for offset, _ in IterRecordHeaders(self.buffer, start))
+
+        return offsets
+
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+
+    def __getitem__(self, index:int) -> LazyEISData:
+        return LazyEISData(self.buffer, self.offsets[index])
+
+
+    def __iter__(self) -> Iterator[LazyEISData]:
+        for offset in self.offsets:
+            yield LazyEISData(self.buffer, offset)
+
+
+    def Headers(self) -> list[tuple]:
+        """Unpacked recordHeader fields of all records
+        """
+
+        return [recordHeader.unpack_from(self.buffer, offset) for offset in self.offsets]
+
+
+    def Cube(self, start:int, stop:int, checkedStop:int | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Impedances and time stamps of consecutive records with equal shapes as strided views into the map
+
+        Args:
+            start (int): index of the first record
+            stop (int): index after the last record
+            checkedStop (int | None, optional): records start to checkedStop were already checked by an earlier call, so only the following ones are. Defaults to None.
+
+        Raises:
+            ValueError: Thrown if the records differ in shape, frequencies or electrode combinations
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: read only (sweeps, channels, frequencies) arrays of impedances and time stamps
+        """
+
+        first = recordHeader.unpack_from(self.buffer, self.offsets[start])
+        numChannels, numFrequencies = first[2], first[3]
+        recordSize = recordHeader.size + first[6]
+        checkStart = start if checkedStop is None else max(start, checkedStop - 1)
+        if np.any(np.diff(self.offsets[checkStart:stop]) != recordSize):
+            raise ValueError("Records differ in shape.")
+
+        impedancesOffset = self.offsets[start] + recordHeader.size + 8 * numFrequencies + Padding(8 * numFrequencies)
+        timeStampsOffset = impedancesOffset + 8 * numChannels * numFrequencies + Padding(8 * numChannels * numFrequencies)
+        electrodesOffset = timeStampsOffset + 8 * numChannels * numFrequencies + Padding(8 * numChannels * numFrequencies) - self.offsets[start]
+
+        # equal sizes do not mean equal layouts, so the counts in the header, the frequencies and the electrodes
+        # of every record are compared with the first one, column wise over all records at once
+        records = np.ndarray((stop - checkStart, recordSize), dtype=np.uint8, buffer=self.buffer, offset=self.offsets[checkStart])
+        reference = np.frombuffer(self.buffer, dtype=np.uint8, count=recordSize, offset=self.offsets[start])
+        for axis in (slice(8, 24), slice(recordHeader.size, recordHeader.size + 8 * numFrequencies), slice(electrodesOffset, recordSize)):
+            if np.any(records[:, axis] != reference[axis]):
+                raise ValueError("Records differ in frequencies or electrode combinations.")
+        shape = (stop - start, numChannels, numFrequencies)
+        impedances = np.ndarray(shape, dtype="<c8", buffer=self.buffer, offset=impedancesOffset, strides=(recordSize, 8 * numFrequencies, 8))
+        timeStamps = np.ndarray(shape, dtype="<f8", buffer=self.buffer, offset=timeStampsOffset, strides=(recordSize, 8 * numFrequencies, 8))
+
+        return impedances, timeStamps
+
+
+    def Close(self):
+        """Unmaps the file, only possible once no LazyEISData arrays are in use anymore
+
+        Raises:
+            BufferError: Thrown if arrays of the map are still in use
+        """
+
+        self.buffer.close()
@@ -0,0 +1,430 @@
+import abc, select, socket, threading, time, weakref
+import serial
+from ProtocolTrace import logger
+
+class Transport(abc.ABC):
+    """Byte stream to the device with the pyserial interface used by ImpedanceAnalyser and FrameReader
+
+    Subclasses implement open, close, write, read(n) and in_waiting, read returns less than n bytes on timeout.
+    A transport that reopens its connection by itself calls NotifyReconnect afterwards, so users of the connection
+    can drop state the device lost (see AddReconnectCallback).
+    """
+
+    def __init__(self):
+        # weak references to the functions called after a reconnect
+        self.reconnectCallbacks:list[weakref.ref] = []
+
+
+    def AddReconnectCallback(self, callback):
+        """Registers a function without arguments called after the connection was reopened
+
+        Only a weak reference is kept, so a pooled transport does not keep its analysers alive.
+        """
+
+        self.reconnectCallbacks.append(weakref.WeakMethod(callback) if hasattr(callback, "__self__") else weakref.ref(callback))
+
+
+    def NotifyReconnect(self):
+        for reference in list(self.reconnectCallbacks):
+            callback = reference()
+            if callback is None:
+                self.reconnectCallbacks.remove(reference)
+            else:
+                callback()
+
+
+    def CheckConnection(self):
+        """Reopens a connection the other side closed, so it is noticed before commands depending on the device state are chosen
+        """
+
+        pass
+
+
+    @abc.abstractmethod
+    def open(self):
+        pass
+
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+    @property
+    @abc.abstractmethod
+    def is_open(self) -> bool:
+        pass
+
+
+    @abc.abstractmethod
+    def write(self, data:bytes) -> int:
+        pass
+
+
+    @abc.abstractmethod
+    def read(self, size:int = 1) -> bytes:
+        pass
+
+
+    @property
+    @abc.abstractmethod
+    def in_waiting(self) -> int:
+        pass
+
+
+class SerialTransport(Transport):
+    """USB serial connection of the device
+    """
+
+    def __init__(self, comPort:str, timeout:float = 256000):
+        """Opens the serial port
+
+        Args:
+            comPort (str): serial port of the device, e.g. COM5
+            timeout (float, optional): read timeout in seconds. Defaults to 256000.
+        """
+
+        super().__init__()
+        self.comPort = comPort
+        self.port = serial.Serial(port=comPort, timeout=timeout)
+
+
+    def open(self):
+        self.port.open()
+
+
+    def close(self):
+        self.port.close()
+
+
+    @property
+    def is_open(self) -> bool:
+        return self.port.is_open
+
+
+    def write(self, data:bytes) -> int:
+        return self.port.write(data)
+
+
+    def read(self, size:int = 1) -> bytes:
+        return self.port.read(size)
+
+
+    @property
+    def in_waiting(self) -> int:
+        return self.port.in_waiting
+
+
+class TcpTransport(Transport):
+    """Persistent TCP connection to the Ethernet interface of the device
+
+    On every (re)connect the TCP connection watchdog (0xCF) of the device is enabled, so the device drops
+    connections of a vanished host and accepts the next one. A broken connection is reopened automatically;
+    a failed write is repeated on the new connection, a failed read raises ConnectionError because the
+    answer is lost.
+    """
+
+    def __init__(self, host:str, port:int, timeout:float | None = None, watchdogInterval:int | None = 60, reconnectAttempts:int = 3):
+        """Connects to the device
+
+        Args:
+            host (str): IP address or host name of the device
+            port (int): TCP port of the device
+            timeout (float | None, optional): read timeout in seconds, None blocks. Defaults to None.
+            watchdogInterval (int | None, optional): interval of the device TCP watchdog in seconds (1 - 600), None leaves it unchanged. Defaults to 60.
+            reconnectAttempts (int, optional): number of connection attempts after the connection broke. Defaults to 3.
+
+        Raises:
+            ValueError: Thrown if watchdogInterval is out of range
+        """
+
+        if watchdogInterval is not None and (watchdogInterval < 1 or watchdogInterval > 600):
+            raise ValueError("Watchdog interval needs to be between 1 and 600 seconds.")
+
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.watchdogInterval = watchdogInterval
+        self.reconnectAttempts = reconnectAttempts
+        self.sock = None
+        # bytes received by in_waiting but not read yet
+        self.pending = bytearray()
+        # serialises the keep alive of TransportPool with reads and writes of the analyser
+        self.lock = threading.RLock()
+        self.lastActivity = time.monotonic()
+
+        self.open()
+
+
+    def open(self):
+        """Connects to the device and enables its TCP connection watchdog
+        """
+
+        with self.lock:
+            self.close()
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self.lastActivity = time.monotonic()
+            logger.info("Connected to %s:%d", self.host, self.port)
+
+            if self.watchdogInterval is not None:
+                self.SendWatchdog()
+
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+            self.pending.clear()
+
+
+    @property
+    def is_open(self) -> bool:
+        return self.sock is not None
+
+
+    def Reconnect(self):
+        """Reopens the connection, retrying with an increasing delay
+
+        Raises:
+            ConnectionError: Thrown if all attempts failed
+        """
+
+        for attempt in range(self.reconnectAttempts):
+            try:
+                self.open()
+            except OSError as e:
+                logger.warning("Reconnect to %s:%d failed (%s)", self.host, self.port, e)
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+
+            # the device may have been power cycled and lost its configuration
+            self.NotifyReconnect()
+            return
+
+        raise ConnectionError(f"Connection to {self.host}:{self.port} could not be restored.")
+
+
+    def CheckConnection(self):
+        with self.lock:
+            try:
+                closed = self.sock is None or not self.Poll()
+            except OSError:
+                closed = True
+            if closed:
+                self.Reconnect()
+
+
+    def SendWatchdog(self):
+        """0xCF - TCP Connection Watchdog - sent directly on the socket and acknowledged before the analyser uses the connection
+
+        Raises:
+            Exception: Thrown if the device did not acknowledge the command
+        """
+
+        with self.lock:
+            self.sock.sendall(bytes([0xCF, 0x05, 0x00]) + self.watchdogInterval.to_bytes(4, "big") + bytes([0xCF]))
+            ack = self.ReceiveExactly(4)
+            if ack != bytes([0x18, 0x01, 0x83, 0x18]):
+                raise Exception(f"TCP connection watchdog was not acknowledged: {list(ack)}")
+            self.lastActivity = time.monotonic()
+
+
+    def ReceiveExactly(self, size:int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError(f"Connection to {self.host}:{self.port} was closed.")
+            data += chunk
+
+        return bytes(data)
+
+
+    def KeepAlive(self) -> bool:
+        """Refreshes the device watchdog if the connection was idle for half of its interval
+
+        Returns:
+            bool: True if the watchdog command was sent
+        """
+
+        if self.watchdogInterval is None or not self.lock.acquire(blocking=False):
+            return False
+
+        try:
+            if self.sock is None or len(self.pending) > 0 or time.monotonic() - self.lastActivity < self.watchdogInterval / 2:
+                return False
+            if self.in_waiting > 0:
+                return False
+
+            try:
+                self.SendWatchdog()
+            except OSError:
+                self.Reconnect()
+            return True
+        finally:
+            self.lock.release()
+
+
+    def Poll(self) -> bool:
+        """Moves all received bytes into the pending buffer without blocking
+
+        Returns:
+            bool: False if the device closed the connection
+        """
+
+        while select.select([self.sock], [], [], 0)[0]:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return False
+            self.pending += chunk
+
+        return True
+
+
+    def write(self, data:bytes) -> int:
+        with self.lock:
+            # A connection closed by the device is only noticed when reading, reopen it before the command gets lost
+            if self.sock is None or not self.Poll():
+                self.Reconnect()
+            try:
+                self.sock.sendall(data)
+            except OSError as e:
+                logger.warning("Write to %s:%d failed (%s), reconnecting", self.host, self.port, e)
+                self.Reconnect()
+                self.sock.sendall(data)
+            self.lastActivity = time.monotonic()
+
+        return len(data)
+
+
+    def read(self, size:int = 1) -> bytes:
+        with self.lock:
+            try:
+                while len(self.pending) < size:
+                    chunk = self.sock.recv(max(size - len(self.pending), 65536))
+                    if not chunk:
+                        raise ConnectionError(f"Connection to {self.host}:{self.port} was closed.")
+                    self.pending += chunk
+            except socket.timeout:
+                pass
+            except OSError:
+                self.Reconnect()
+                raise
+
+            data = bytes(self.pending[:size])
+            del self.pending[:size]
+            self.lastActivity = time.monotonic()
+
+        return data
+
+
+    @property
+    def in_waiting(self) -> int:
+        with self.lock:
+            if self.sock is None:
+                return 0
+            if not self.Poll():
+                self.Reconnect()
+                raise ConnectionError(f"Connection to {self.host}:{self.port} was closed.")
+
+            return len(self.pending)
+
+
+class TransportPool():
+    """Keeps one persistent TCP connection per device address and refreshes idle ones in the background
+    """
+
+    def __init__(self, keepAlivePeriod:float = 5):
+        """Constructor
+
+        Args:
+            keepAlivePeriod (float, optional): seconds between two checks for idle connections. Defaults to 5.
+        """
+
+        self.keepAlivePeriod = keepAlivePeriod
+        self.transports:dict[tuple[str, int], TcpTransport] = {}
+        self.lock = threading.Lock()
+        self.stopEvent = threading.Event()
+        self.keepAliveThread = None
+
+
+    def Get(self, host:str, port:int, **kwargs) -> TcpTransport:
+        """Returns the open connection to host:port, a new one is opened if there is none
+
+        Args:
+            host (str): IP address or host name of the device
+            port (int): TCP port of the device
+            kwargs: further arguments for TcpTransport, only used for a new connection
+
+        Returns:
+            TcpTransport: persistent connection
+        """
+
+        with self.lock:
+            transport = self.transports.get((host, port))
+            if transport is None:
+                transport = TcpTransport(host, port, **kwargs)
+                self.transports[(host, port)] = transport
+            elif not transport.is_open:
+                transport.Reconnect()
+
+            if self.keepAliveThread is None:
+                self.keepAliveThread = threading.Thread(target=self.KeepAliveLoop, name="TransportPool", daemon=True)
+                self.keepAliveThread.start()
+
+        return transport
+
+
+    def KeepAliveLoop(self):
+        while not self.stopEvent.wait(self.keepAlivePeriod):
+            with self.lock:
+                transports = list(self.transports.values())
+            for transport in transports:
+                try:
+                    transport.KeepAlive()
+                except Exception as e:
+                    logger.warning("Keep alive of %s:%d failed: %s", transport.host, transport.port, e)
+
+
+    def CloseAll(self):
+        """Stops the keep alive thread and closes all connections
+        """
+
+        self.stopEvent.set()
+        if self.keepAliveThread is not None:
+            self.keepAliveThread.join()
+            self.keepAliveThread = None
+        with self.lock:
+            for transport in self.transports.values():
+                transport.close()
+            self.transports.clear()
+        self.stopEvent.clear()
+
+
+# connections shared by all analysers of the process
+defaultPool = TransportPool()
+
+def OpenTransport(address:str) -> Transport:
+    """Opens the transport for a device address
+
+    Args:
+        address (str): "tcp://host:port" for the Ethernet interface (pooled), otherwise the name of a serial port
+
+    Raises:
+        ValueError: Thrown if a TCP address has no port
+
+    Returns:
+        Transport: opened transport
+    """
+
+    if address.startswith("tcp://"):
+        host, separator, port = address[len("tcp://"):].rpartition(":")
+        if separator == "" or not port.isdigit():
+            raise ValueError(f"TCP address needs a port: {address}")
+        return defaultPool.Get(host, int(port))
+
+    return SerialTransport(address)
@@ -1,8 +1,10 @@
-import time
+import time, collections
 from PySide6.QtWidgets import QComboBox, QDialog, QLabel, QLineEdit, QPushButton, QVBoxLayout
 from PySide6.QtCore import QThread, Signal
-from DataManager import EISData, LoadFromDataframe
+from DataManager import EISData, LoadFromDataframe, SweepAxes
+from HelperFunctions import WallClock
 from ImpedanceAnalyser import ImpedanceAnalyser
+from RecordingFile import RecordingWriter
 
 class MeasurementWorker(QThread):
     """Worker for parallel execution of measurements while user can switch between gui tabs
@@ -11,66 +13,154 @@ class MeasurementWorker(QThread):
         QThread (_type_): _description_
     """
     resultReady = Signal(EISData)
+    # index of the electrode combination, its impedances and the SweepAxes of the run, emitted while a sweep is still running
+    channelReady = Signal(int, object, object)
     finished = Signal(bool)
     
-    def __init__(self, impedanceAnalyser:ImpedanceAnalyser, timeMode:bool, measVariable:int, intervalMs:int):
+    def __init__(self, impedanceAnalyser:ImpedanceAnalyser, timeMode:bool, measVariable:int, intervalMs:int, continuous:bool = False, recordingWriter:RecordingWriter | None = None):
         """Standard constructor with device and measurement parameters
 
         Args:
             impedanceAnalyser (ImpedanceAnalyser): connected device
             timeMode (bool): True if time mode selected, False if repetition mode
             measVariable (int): If time mode, duration in ms, else number of repetitions
-            intervalMs (int): Waiting time before starting the next measurement
+            intervalMs (int): Waiting time before starting the next measurement, ignored in continuous mode
+            continuous (bool, optional): True to let the device measure continuously instead of starting every sweep. Defaults to False.
+            recordingWriter (RecordingWriter | None, optional): recording every finished sweep is appended to. Defaults to None.
         """
         super().__init__()
         self.impedanceAnalyser = impedanceAnalyser
         self.timeMode = timeMode
         self.measVariable = measVariable
         self.intervalMs = intervalMs
+        self.continuous = continuous
+        self.recordingWriter = recordingWriter
+        # emit times of resultReady while metrics are recorded, taken by the receiving slot to measure the delivery latency
+        self.emitTimes = collections.deque()
     
     def run(self):
         
         try:
-            if self.timeMode:
+            if self.continuous:
+                self.RunContinuous()
+            
+            elif self.timeMode:
                 startTimeLoop = time.time()
                 measIndex = 0
+                buffers = self.impedanceAnalyser.AllocateResultBuffers()
+                # The axes do not change during the run, they are read once instead of after every sweep
+                frequencies = self.impedanceAnalyser.GetFrequencyList()
+                electrodes = [list(combination) for combination in self.impedanceAnalyser.muxElConfig]
+                axes = SweepAxes.Get(frequencies, electrodes)
                 # Runs measurements until it reaches time provided by user
-                while ((time.time() - startTimeLoop) * 1000 < self.measVariable):
+                while ((time.time() - startTimeLoop) * 1000 < self.measVariable) and not self.isInterruptionRequested():
                     measIndex += 1
-                    resReal, resImag, _, _, resTime, startTime, finishTime = self.impedanceAnalyser.GetMeasurements()
-                    frequencies = self.impedanceAnalyser.GetFrequencyList()
-                    electrodes = self.impedanceAnalyser.GetExtensionPortChannel()
-                    data = EISData( timeStamp = resTime, 
+                    resReal, resImag, _, _, resTime, startTime, finishTime = self.MeasureSweep(buffers, axes)
+                    data = EISData( timeStamp = self.impedanceAnalyser.PointTimes(resTime, startTime), 
                                     frequencies = frequencies, 
                                     electrodes = electrodes, 
                                     realParts = resReal, 
                                     imagParts = resImag, 
                                     startTime=startTime, 
-                                    finishTime=finishTime)
+                                    finishTime=finishTime,
+                                    singlePrecision=True)
                     if data.impedances is not None:
-                        self.resultReady.emit(data)
+                        self.EmitResult(data)
                     time.sleep(self.intervalMs / 1000)
             
             else:
                 # Runs measurements until the number of repetitions provided by user is reached
+                buffers = self.impedanceAnalyser.AllocateResultBuffers()
+                # The axes do not change during the run, they are read once instead of after every sweep
+                frequencies = self.impedanceAnalyser.GetFrequencyList()
+                electrodes = [list(combination) for combination in self.impedanceAnalyser.muxElConfig]
+                axes = SweepAxes.Get(frequencies, electrodes)
                 for measIndex in range(1, self.measVariable + 1):
-                    resReal, resImag, _, _, resTime, startTime, finishTime = self.impedanceAnalyser.GetMeasurements()
-                    frequencies = self.impedanceAnalyser.GetFrequencyList()
-                    electrodes = self.impedanceAnalyser.GetExtensionPortChannel()
-                    data = EISData( timeStamp = resTime, 
+                    if self.isInterruptionRequested():
+                        break
+                    resReal, resImag, _, _, resTime, startTime, finishTime = self.MeasureSweep(buffers, axes)
+                    data = EISData( timeStamp = self.impedanceAnalyser.PointTimes(resTime, startTime), 
                                     frequencies = frequencies, 
                                     electrodes = electrodes, 
                                     realParts = resReal, 
                                     imagParts = resImag, 
                                     startTime=startTime, 
-                                    finishTime=finishTime)
+                                    finishTime=finishTime,
+                                    singlePrecision=True)
                     if data.impedances is not None:
-                        self.resultReady.emit(data)
+                        self.EmitResult(data)
                     time.sleep(self.intervalMs / 1000)
         except Exception as e:
             print("Exception encountered: " + str(e))
         finally:
+            if self.recordingWriter is not None:
+                self.recordingWriter.Flush()
             self.finished.emit(True)
+    
+    def EmitResult(self, data:EISData):
+        """Appends the sweep to the recording, emits resultReady and notes the emit time if metrics are recorded
+
+        Args:
+            data (EISData): finished sweep
+        """
+        
+        if self.recordingWriter is not None:
+            self.recordingWriter.Append(data)
+        if self.impedanceAnalyser.metrics is not None:
+            self.emitTimes.append(time.perf_counter())
+        self.resultReady.emit(data)
+    
+    def MeasureSweep(self, buffers:tuple, axes:SweepAxes) -> tuple:
+        """Runs one sweep and emits channelReady for every electrode combination as soon as it is read
+
+        Args:
+            buffers (tuple): result buffers from AllocateResultBuffers
+            axes (SweepAxes): frequencies and electrode combinations of the sweep, so receivers can check that the rows belong to their data
+
+        Returns:
+            tuple: same tuple as ImpedanceAnalyser.GetMeasurements
+        """
+        
+        startTime = WallClock()
+        for channelIndex, _, _, _, _, _ in self.impedanceAnalyser.IterMeasurements(out=buffers):
+            # copied, the buffer row is overwritten by the next sweep while the GUI may still draw it
+            self.channelReady.emit(channelIndex, buffers[0][channelIndex].copy(), axes)
+        finishTime = WallClock()
+        
+        resImpedance, resRange, resTime, resWarning = buffers
+        return resImpedance.real, resImpedance.imag, resWarning, resRange, resTime, startTime, finishTime
+    
+    def RunContinuous(self):
+        """Streams sweeps from the device without restarting it until the duration or number of repetitions is reached
+        """
+        
+        # Commands can not be sent while the device is streaming, so the axes are read once in advance
+        frequencies = self.impedanceAnalyser.GetFrequencyList()
+        electrodes = [list(combination) for combination in self.impedanceAnalyser.muxElConfig]
+        buffers = self.impedanceAnalyser.AllocateResultBuffers()
+        
+        startTimeLoop = time.time()
+        sweeps = self.impedanceAnalyser.IterContinuousMeasurements(out=buffers)
+        try:
+            for measIndex, (resReal, resImag, _, _, resTime, startTime, finishTime) in enumerate(sweeps, 1):
+                data = EISData( timeStamp = self.impedanceAnalyser.PointTimes(resTime, startTime), 
+                                frequencies = frequencies, 
+                                electrodes = electrodes, 
+                                realParts = resReal, 
+                                imagParts = resImag, 
+                                startTime=startTime, 
+                                finishTime=finishTime,
+                                singlePrecision=True)
+                self.EmitResult(data)
+                
+                if self.timeMode and (time.time() - startTimeLoop) * 1000 >= self.measVariable:
+                    break
+                if not self.timeMode and measIndex >= self.measVariable:
+                    break
+                if self.isInterruptionRequested():
+                    break
+        finally:
+            sweeps.close()
 
 class RestartWorker(QThread):
     """Worker for parallel restarting of the device while user can switch between gui tabs
@@ -91,6 +181,8 @@ class RestartWorker(QThread):
         self.impedanceAnalyser.device.close()
         time.sleep(12)
         self.impedanceAnalyser.device.open()
+        self.impedanceAnalyser.reader.Clear()
+        self.impedanceAnalyser.InvalidateDeviceState()
         self.restartFinished.emit(True)
 
 class UnitComboBox(QComboBox):
@@ -133,7 +225,7 @@ class StartupPopup(QDialog):
         self.setWindowTitle("COM-Port input")
         
         # Defining controls
-        self.label = QLabel("Enter COM-Port used by the device:")
+        self.label = QLabel("Enter COM-Port used by the device (or tcp://host:port for Ethernet):")
         self.userInput = QLineEdit(text="COM5")
         self.okButton = QPushButton("OK")
         
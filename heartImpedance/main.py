@@ -3,16 +3,22 @@ main.py
 Starts GUI, shows dialog serial port choice and opens settings tab as the default.
 """
 from __future__ import annotations
-import sys
+import sys, os, asyncio, datetime, logging, time
 import serial
-import pandas as pd
-from PySide6.QtWidgets import QApplication,QWidget, QVBoxLayout, QHBoxLayout, QTabWidget, QPushButton, QFileDialog, QMessageBox, QRadioButton, QButtonGroup,QLineEdit, QLabel, QDialog
+from PySide6.QtWidgets import QApplication,QWidget, QVBoxLayout, QHBoxLayout, QTabWidget, QPushButton, QFileDialog, QMessageBox, QRadioButton, QButtonGroup,QLineEdit, QLabel, QDialog, QCheckBox
 from PySide6.QtCore import Slot
 from AdditionalClasses import MeasurementWorker, UnitComboBox, RestartWorker, StartupPopup
-from DataManager import EISData, LoadFromDataframe
-from TabClasses import SettingsTab, BodeDiagramTab, TimeSeriesTab, DerivedValueTab
+from DataManager import EISData, LoadCsv, SaveCsv
+from MeasurementStore import MeasurementStore
+from RecordingFile import SaveRecording, Recording, RecordingWriter
+from TabClasses import SettingsTab, BodeDiagramTab, TimeSeriesTab, DerivedValueTab, MetricsTab
 from ImpedanceAnalyser import ImpedanceAnalyser
 from ImpedanceAnalyserFake import ImpedanceAnalyserFake
+try:
+    # optional, lets AsyncImpedanceAnalyser coroutines run on the Qt event loop
+    import qasync
+except ImportError:
+    qasync = None
 
 # ---------------------------------------------------------------------- #
 #  GUI MainWindow                                                        #
@@ -32,25 +38,32 @@ class MainWindow(QWidget):
             self.impedanceAnalyser = ImpedanceAnalyserFake("COM5")
         else:
             try:
-                self.impedanceAnalyser = ImpedanceAnalyser("COM5")
-            except serial.SerialException as e:
+                self.impedanceAnalyser = ImpedanceAnalyser(comPort)
+            except (serial.SerialException, OSError) as e:
                 QMessageBox.critical(self, "Connection unsuccessful", f"The connection with port: {comPort} was unsuccessful. Error message: " + str(e))
         
-        # Initiates workers and data list
+        # Initiates workers and the measurement store shared by all tabs
         self.measWorker = None
         self.restartWorker = None
-        self.savedData:list[EISData] = []
+        self.store = MeasurementStore(self)
+        # True while the store holds sweeps that were loaded instead of measured in this session
+        self.dataLoaded = False
+        # every measured sweep is appended to the session recording, so a crash does not lose the session
+        self.recordingWriter = None
+        self.StartSessionRecording()
 
         # Tabs
         self.tabs = QTabWidget()
         self.tabSettings = SettingsTab(self.impedanceAnalyser)
-        self.tabBode = BodeDiagramTab()
-        self.tabTimeSeries = TimeSeriesTab()
-        self.tabDerived = DerivedValueTab()
+        self.tabBode = BodeDiagramTab(self.store)
+        self.tabTimeSeries = TimeSeriesTab(self.store)
+        self.tabDerived = DerivedValueTab(self.store)
+        self.tabMetrics = MetricsTab(self.impedanceAnalyser)
         self.tabs.addTab(self.tabSettings, "Settings")
         self.tabs.addTab(self.tabBode, "Bode")
         self.tabs.addTab(self.tabTimeSeries, "Time Series")
         self.tabs.addTab(self.tabDerived, "Derived value")
+        self.tabs.addTab(self.tabMetrics, "Metrics")
 
         # Buttons
         self.saveButton = QPushButton("Save")
@@ -58,11 +71,14 @@ class MainWindow(QWidget):
         self.singleMeasurementButton = QPushButton("Run Single Measurement")
         self.restartDeviceButton = QPushButton("Restart device")
         self.runLoopMeasurementButton = QPushButton("Run Multiple Measurements")
+        self.stopMeasurementButton = QPushButton("Stop")
+        self.stopMeasurementButton.setEnabled(False)
         self.saveButton.clicked.connect(self.SaveData)
         self.loadButton.clicked.connect(self.load_data)
         self.singleMeasurementButton.clicked.connect(self.RunSingleMeasurement)
         self.restartDeviceButton.clicked.connect(self.RestartDevice)
         self.runLoopMeasurementButton.clicked.connect(self.RunMultipleMeasurements)
+        self.stopMeasurementButton.clicked.connect(self.StopMeasurement)
         
         # MeasurementParameters
         self.radioButtonGroup = QButtonGroup()
@@ -81,9 +97,19 @@ class MainWindow(QWidget):
         self.intervalLineEdit = QLineEdit(text="1")
         self.intervalLineEdit.setMaximumWidth(50)
         self.intervalComboBox = UnitComboBox()
+        self.continuousCheckBox = QCheckBox("Continuous")
+        self.continuousCheckBox.setToolTip("Device measures without restarting between sweeps, interval is ignored")
         self.repetitionMode.clicked.connect(self.repetitionModeClicked)
         self.timeMode.clicked.connect(self.timeModeClicked)
         
+        # Retention, older sweeps are moved from memory to disk, empty fields mean no limit
+        self.retentionSweepsLineEdit = QLineEdit(text="1000")
+        self.retentionSweepsLineEdit.setMaximumWidth(50)
+        self.retentionTimeLineEdit = QLineEdit()
+        self.retentionTimeLineEdit.setMaximumWidth(50)
+        self.retentionUnitComboBox = UnitComboBox()
+        self.retentionUnitComboBox.setCurrentText("min")
+        
         
         hl = QHBoxLayout()
         hl.addWidget(self.saveButton)
@@ -98,6 +124,13 @@ class MainWindow(QWidget):
         hl.addWidget(QLabel("Interval: "))
         hl.addWidget(self.intervalLineEdit)
         hl.addWidget(self.intervalComboBox)
+        hl.addWidget(self.continuousCheckBox)
+        hl.addWidget(QLabel("In memory: "))
+        hl.addWidget(self.retentionSweepsLineEdit)
+        hl.addWidget(QLabel("sweeps or"))
+        hl.addWidget(self.retentionTimeLineEdit)
+        hl.addWidget(self.retentionUnitComboBox)
+        hl.addWidget(self.stopMeasurementButton)
         hl.addStretch()
         hl.addWidget(self.restartDeviceButton)
 
@@ -108,36 +141,55 @@ class MainWindow(QWidget):
     # ------------------------------------------------------------------ #
     @Slot()
     def SaveData(self):
-        """Saves data stored in self.savedData to csv
+        """Saves the measurement data to a binary recording or csv
         """
-        path, _ = QFileDialog.getSaveFileName(self, "Save data", __file__.replace("main.py", "SavedMeasurements"), "Files (*.csv)")
+        path, _ = QFileDialog.getSaveFileName(self, "Save data", __file__.replace("main.py", "SavedMeasurements"), "Recordings (*.eisr);;Files (*.csv)")
         if not path:
             return
         
         try:
-            bigDf = pd.DataFrame()
-            for data in self.savedData:
-                bigDf = pd.concat([bigDf, data.SaveToDataframe()])
-            bigDf.to_csv(path, index=False)
+            if not path.endswith(".csv"):
+                # the session recording already holds every measured sweep unless data was loaded
+                if self.recordingWriter is not None and not self.dataLoaded:
+                    self.recordingWriter.Finalize(path)
+                else:
+                    SaveRecording(path, self.store.Sweeps())
+                return
+            
+            # like the recording the csv holds every sweep of the session, also those of earlier settings
+            if self.recordingWriter is not None and not self.dataLoaded:
+                self.recordingWriter.Sync()
+                recording = Recording(self.recordingWriter.path)
+                try:
+                    SaveCsv(path, recording)
+                finally:
+                    recording.Close()
+            elif len(self.store) > 0:
+                SaveCsv(path, self.store.Sweeps())
         except Exception as e:
             QMessageBox.warning(self, "Error while saving data", "Saving data failed due to: " + str(e))
         
     @Slot()
     def load_data(self):
-        """Loads data from csv
+        """Loads data from a binary recording or csv
         """
-        path, _ = QFileDialog.getOpenFileName(self, "Load data", __file__.replace("main.py", "SavedMeasurements"), "Files (*.csv)")
+        path, _ = QFileDialog.getOpenFileName(self, "Load data", __file__.replace("main.py", "SavedMeasurements"), "Recordings (*.eisr);;Files (*.csv)")
         if not path:
             return
         try:
-            data = pd.read_csv(path)
-            uniqueMeasurements = data["MeasurementIndex"].unique()
+            # the store replaces its content only once the file was read, so a failed load keeps the current data
+            if not path.endswith(".csv"):
+                # Sweeps stay in the memory map until a tab displays them
+                skipped = self.store.AttachRecording(Recording(path))
+            else:
+                skipped = self.store.Load(LoadCsv(path))
             
-            self.ClearAllData()
-            for index in uniqueMeasurements:
-                newData = LoadFromDataframe(data[:][data["MeasurementIndex"] == index])
-                self._broadcast_data(newData)
-            EISData.index = max(uniqueMeasurements) + 1
+            self.StartSessionRecording()
+            self.dataLoaded = True
+            if skipped > 0:
+                QMessageBox.information(self, "Data loaded", f"{skipped} earlier measurements with different settings were not loaded.")
+            if len(self.store) > 0:
+                EISData.index = int(self.store.measurementIndices.max()) + 1
         except Exception as e:
             QMessageBox.critical(self, "Error while loading data", "Loading data failed due to: " + str(e))
             return
@@ -148,9 +200,11 @@ class MainWindow(QWidget):
         """
         
         try:
+            self.ApplyRetention()
             self.SetAllButtonsEnabled(False)
-            self.measWorker = MeasurementWorker(self.impedanceAnalyser, False, 1, 0)
+            self.measWorker = MeasurementWorker(self.impedanceAnalyser, False, 1, 0, recordingWriter=self.recordingWriter)
             self.measWorker.resultReady.connect(self._broadcast_data)
+            self.measWorker.channelReady.connect(self.tabBode.channel_ready)
             self.measWorker.finished.connect(self.SetAllButtonsEnabled)
             self.measWorker.start()
         
@@ -191,15 +245,25 @@ class MainWindow(QWidget):
         
         # Starts measurement worker, block ui until worker finishes, each measurement data is broadcasted to GUI tabs
         try:
+            self.ApplyRetention()
             self.SetAllButtonsEnabled(False)
-            self.measWorker = MeasurementWorker(self.impedanceAnalyser, timeMode, measVariable, intervalMs)
+            self.measWorker = MeasurementWorker(self.impedanceAnalyser, timeMode, measVariable, intervalMs, self.continuousCheckBox.isChecked(), self.recordingWriter)
             self.measWorker.resultReady.connect(self._broadcast_data)
+            self.measWorker.channelReady.connect(self.tabBode.channel_ready)
             self.measWorker.finished.connect(self.SetAllButtonsEnabled)
             self.measWorker.start()
         
         except Exception as e:  
             QMessageBox.critical(self, "Measurement error", "Measurement error in time mode: " + str(e))
     
+    @Slot()
+    def StopMeasurement(self):
+        """Stops a running measurement after the current sweep
+        """
+        
+        if self.measWorker is not None:
+            self.measWorker.requestInterruption()
+    
     @Slot()
     def repetitionModeClicked(self):
         """Handler for repetition radio button
@@ -231,34 +295,96 @@ class MainWindow(QWidget):
         self.singleMeasurementButton.setEnabled(setEnabled)
         self.runLoopMeasurementButton.setEnabled(setEnabled)
         self.restartDeviceButton.setEnabled(setEnabled)
+        self.continuousCheckBox.setEnabled(setEnabled)
+        self.retentionSweepsLineEdit.setEnabled(setEnabled)
+        self.retentionTimeLineEdit.setEnabled(setEnabled)
+        self.retentionUnitComboBox.setEnabled(setEnabled)
+        self.stopMeasurementButton.setEnabled(not setEnabled)
         self.tabSettings.setEnabled(setEnabled)
 
     # ------------------------------------------------------------------ #
+    def ApplyRetention(self):
+        """Passes the number of sweeps and the time kept in memory to the store
+        """
+        sweepsText = self.retentionSweepsLineEdit.text().strip()
+        timeText = self.retentionTimeLineEdit.text().strip()
+        maxSweeps = int(sweepsText) if sweepsText else None
+        maxMinutes = self.retentionUnitComboBox.GetTimeInMs(float(timeText)) / 60000 if timeText else None
+        self.store.SetRetention(maxSweeps, maxMinutes)
+    
+    def StartSessionRecording(self):
+        """Closes the current session recording and starts a new one in SavedMeasurements/Sessions
+        """
+        self.StopSessionRecording()
+        sessionDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "SavedMeasurements", "Sessions")
+        try:
+            os.makedirs(sessionDir, exist_ok=True)
+            self.recordingWriter = RecordingWriter(os.path.join(sessionDir, datetime.datetime.now().strftime("session-%Y%m%d-%H%M%S-%f.eisr")))
+            logging.info("Recording session to %s", self.recordingWriter.path)
+        except OSError as e:
+            self.recordingWriter = None
+            logging.warning("Session recording could not be created: %s", e)
+    
+    def StopSessionRecording(self):
+        """Closes the session recording, an empty one is removed
+        """
+        if self.recordingWriter is None:
+            return
+        self.recordingWriter.Close()
+        if self.recordingWriter.count == 0:
+            os.remove(self.recordingWriter.path)
+            os.remove(self.recordingWriter.path + ".idx")
+        self.recordingWriter = None
+    
+    def closeEvent(self, event):
+        if self.measWorker is not None:
+            self.measWorker.requestInterruption()
+            self.measWorker.wait()
+        self.StopSessionRecording()
+        self.store.Close()
+        super().closeEvent(event)
+    
     def ClearAllData(self):
-        """Clears data from all tabs
+        """Clears data from all tabs and starts a new session recording
         """
-        self.savedData.clear()
-        self.tabBode.savedData.clear()
-        self.tabBode.data = None
-        self.tabTimeSeries.savedData.clear()
-        self.tabTimeSeries.data = None
-        self.tabDerived.savedData.clear()
+        self.StartSessionRecording()
+        self.dataLoaded = False
+        self.store.Clear()
         
     def _broadcast_data(self, data: EISData):
-        """Sends data from measurements to all GUI tabs
+        """Adds data from measurements to the store, which updates all GUI tabs
 
         Args:
             data (EISData): measurement data
         """
-        self.savedData.append(data)
-        self.tabBode.update_data(data)
-        self.tabTimeSeries.update_data(data)
-        self.tabDerived.update_data(data)
+        metrics = self.impedanceAnalyser.metrics
+        if metrics is not None:
+            updateStart = time.perf_counter()
+            if self.measWorker is not None and self.measWorker.emitTimes:
+                metrics.Observe("emitLatency", updateStart - self.measWorker.emitTimes.popleft())
+        
+        # The tabs show one configuration, changed settings start a new display (the session recording keeps all sweeps)
+        if not self.store.Matches(data):
+            self.store.Clear()
+            self.dataLoaded = False
+        self.store.Append(data)
+        
+        if metrics is not None:
+            metrics.Observe("tabUpdate", time.perf_counter() - updateStart)
 
 # ---------------------------------------------------------------------- #
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s: %(message)s")
     app = QApplication(sys.argv)
     win = MainWindow()
     win.resize(1200, 800)
     win.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    if qasync is None:
+        sys.exit(app.exec())
+    
+    loop = qasync.QEventLoop(app)
+    asyncio.set_event_loop(loop)
+    appClosing = asyncio.Event()
+    app.aboutToQuit.connect(appClosing.set)
+    with loop:
+        loop.run_until_complete(appClosing.wait())
\ No newline at end of file
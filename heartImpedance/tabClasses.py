@@ -1,13 +1,14 @@
 from __future__ import annotations
 import numpy as np
 import pyqtgraph as pg
-from datetime import datetime
-from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QComboBox, QLabel, QListWidget, QListWidgetItem, QGridLayout, QButtonGroup, QMessageBox, QRadioButton
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLineEdit, QComboBox, QLabel, QListWidget, QListWidgetItem, QGridLayout, QButtonGroup, QMessageBox, QRadioButton, QCheckBox, QTableWidget, QTableWidgetItem
 
-from PySide6.QtCore import Qt, Slot
+from PySide6.QtCore import Qt, Slot, QTimer
 from PySide6.QtGui import QFont
-from DataManager import EISData
+from DataManager import Admittances, SweepAxes
+from MeasurementStore import MeasurementStore, Grow
 from ImpedanceAnalyser import ImpedanceAnalyser
+from Metrics import Metrics
 from EnumClasses import InjectionType, CurrentRange, FrequencyScale, FeMode, FeChannel, TimeStamp
 
 class SettingsTab(QWidget):
@@ -203,12 +204,13 @@ class BodeDiagramTab(QWidget):
     Args:
         QWidget (_type_): _description_
     """
-    def __init__(self, parent=None):
+    def __init__(self, store:MeasurementStore, parent=None):
         super().__init__(parent)
-        self.data = None
-        self.savedData:list[EISData] = []
+        self.store = store
         self.mode = "Z"
         self.initUI()
+        self.store.sweepsAppended.connect(self.sweeps_appended)
+        self.store.cleared.connect(self.clear_data)
 
     def initUI(self):
 
@@ -316,15 +318,15 @@ class BodeDiagramTab(QWidget):
     def update_plot(self):
         """Updates plot with new data or if mode is changed
         """
-        if not self.savedData:
+        if len(self.store) == 0 or self.measurementComboBox.currentIndex() < 0:
             return
         
         # Takes measurement and electrode combinations currently chosen in comboboxes
-        self.data = self.savedData[self.measurementComboBox.currentIndex()]
+        impedances, _ = self.store.Row(self.measurementComboBox.currentIndex())
         indexEl = self.electrodeComboBox.currentIndex()
 
-        freq = self.data.frequencies
-        measurand = self.data.impedances[indexEl] if self.mode == "Z" else self.data.admittances[indexEl]
+        freq = self.store.frequencies
+        measurand = impedances[indexEl] if self.mode == "Z" else Admittances(impedances[indexEl])
 
         if len(freq) == 0 or len(measurand) == 0:
             return
@@ -346,22 +348,60 @@ class BodeDiagramTab(QWidget):
         self.plot_mag.plot(freq, mag, pen=pg.mkPen(color='b', width=2), symbol='o')
         self.plot_phase.plot(freq, phase, pen=pg.mkPen(color='r', width=2), symbol='o')
 
-    def update_data(self, data:EISData):
-        """Updates plot with new data and adds it to saveddata list
+    @Slot(int, object, object)
+    def channel_ready(self, channelIndex:int, impedances:np.ndarray, axes:SweepAxes):
+        """Plots the selected electrode combination of a running sweep as soon as the worker read it
+
+        Only drawn while the newest measurement is selected and the sweep has its frequencies and electrode
+        combinations, an older measurement chosen by the user is not overwritten.
 
         Args:
-            data (EISData): _description_
+            channelIndex (int): index of the electrode combination
+            impedances (np.ndarray): its impedances over the frequencies
+            axes (SweepAxes): frequencies and electrode combinations of the running sweep
         """
-        if not self.savedData:
+        # the axes of a new configuration are only known once its first sweep is stored
+        if len(self.store) == 0 or self.measurementComboBox.currentIndex() != len(self.store) - 1:
+            return
+        if channelIndex != self.electrodeComboBox.currentIndex() or not self.store.Matches(axes):
+            return
+        freq = self.store.frequencies
+
+        measurand = impedances if self.mode == "Z" else Admittances(impedances)
+        self.plot_mag.clear()
+        self.plot_phase.clear()
+        self.plot_mag.plot(freq, np.abs(measurand), pen=pg.mkPen(color='b', width=2), symbol='o')
+        self.plot_phase.plot(freq, np.angle(measurand, deg=True), pen=pg.mkPen(color='r', width=2), symbol='o')
+
+    @Slot(int, int)
+    def sweeps_appended(self, start:int, stop:int):
+        """Adds the new measurements of the store and plots the last one
+
+        Args:
+            start (int): index of the first new measurement
+            stop (int): index after the last new measurement
+        """
+        if start == 0:
+            self.electrodeComboBox.blockSignals(True)
             self.electrodeComboBox.clear()
-            self.electrodeComboBox.addItems([str(x) for x in data.electrodes])
-            
-        self.data = data
-        self.savedData.append(data)
-        self.measurementComboBox.addItem(f"{data.measurementIndex}: {data.startTimeShort} - {data.finishTimeShort}")
-        self.measurementComboBox.setCurrentIndex(len(self.savedData) - 1)
+            self.electrodeComboBox.addItems([str(x) for x in self.store.electrodes])
+            self.electrodeComboBox.blockSignals(False)
+        
+        self.measurementComboBox.blockSignals(True)
+        self.measurementComboBox.addItems(self.store.Descriptions(start, stop, short=True))
+        self.measurementComboBox.setCurrentIndex(stop - 1)
+        self.measurementComboBox.blockSignals(False)
         self.update_plot()
 
+    @Slot()
+    def clear_data(self):
+        """Removes all measurements
+        """
+        self.measurementComboBox.clear()
+        self.electrodeComboBox.clear()
+        self.plot_mag.clear()
+        self.plot_phase.clear()
+
 
 class TimeSeriesTab(QWidget):
     """Tab for displaying measurements across time
@@ -369,17 +409,23 @@ class TimeSeriesTab(QWidget):
     Args:
         QWidget (_type_): _description_
     """
-    def __init__(self, parent=None):
+    def __init__(self, store:MeasurementStore, parent=None):
         super().__init__(parent)
-        self.data = None
-        self.savedData:list[EISData] = []
+        self.store = store
         self.currentFrequencyIndex = None
         self.currentElCombIndex = None
         self.mode = "Z"
         self.currentTimes = None
         self.currentMags = None
         self.currentPhases = None
+        # time, magnitude and phase of the displayed series, grown as sweeps are appended
+        self.seriesTimes = np.empty(0)
+        self.seriesMags = np.empty(0)
+        self.seriesPhases = np.empty(0)
+        self.seriesCount = 0
         self.initUI()
+        self.store.sweepsAppended.connect(self.sweeps_appended)
+        self.store.cleared.connect(self.clear_data)
 
     def initUI(self):
         # self.setWindowTitle("Time Series Viewer")
@@ -483,6 +529,13 @@ class TimeSeriesTab(QWidget):
 
         # self.plot_mag.scene().sigMouseMoved.connect(self.mouse_moved)
 
+        # Curves are created once and updated with setData, only the visible part is drawn
+        self.curve_mag = self.plot_mag.plot(pen=pg.mkPen(color='b', width=2))
+        self.curve_phase = self.plot_phase.plot(pen=pg.mkPen(color='r', width=2))
+        for curve in [self.curve_mag, self.curve_phase]:
+            curve.setClipToView(True)
+            curve.setDownsampling(auto=True, method="peak")
+
         self.setLayout(layout)
         self.update_plot()
 
@@ -499,28 +552,47 @@ class TimeSeriesTab(QWidget):
         self.update_plot()
 
     def update_plot(self):
-        """Updates plot with new data or when the mode is changed
+        """Rebuilds the series when the frequency, electrode combination or mode is changed
         """
         try:
-            if not self.savedData:
-                return
-            
-            indexFreq = self.freq_combo.currentIndex()
-            indexEl = self.electrodeComboBox.currentIndex()
-            self.startTime = datetime.strptime(self.savedData[0].startTime, "%Y-%m-%d %H:%M:%S")
-            self.currentTimes = [(datetime.strptime(x.startTime, "%Y-%m-%d %H:%M:%S") - self.startTime).total_seconds() for x in self.savedData]
-            
-            self.currentMags = [x.magnitudesZ[indexEl][indexFreq] for x in self.savedData] if self.mode == "Z" else [x.magnitudesY[indexEl][indexFreq] for x in self.savedData]
-            self.currentPhases = [x.phasesZ[indexEl][indexFreq] for x in self.savedData] if self.mode == "Z" else [x.phasesY[indexEl][indexFreq] for x in self.savedData]
-
-            self.plot_mag.clear()
-            self.plot_phase.clear()
-            self.plot_mag.plot(self.currentTimes, self.currentMags, pen=pg.mkPen(color='b', width=2))
-            self.plot_phase.plot(self.currentTimes, self.currentPhases, pen=pg.mkPen(color='r', width=2))
+            self.seriesCount = 0
+            self.append_points(0, len(self.store))
 
         except Exception as e:
             QMessageBox.critical(self, "Plot Error", f"Failed to plot:\n{e}")
 
+    def append_points(self, start:int, stop:int):
+        """Appends the values of sweeps start to stop to the series and updates the curves
+
+        Args:
+            start (int): index of the first sweep
+            stop (int): index after the last sweep
+        """
+        indexFreq = self.freq_combo.currentIndex()
+        indexEl = self.electrodeComboBox.currentIndex()
+        if indexFreq < 0 or indexEl < 0:
+            return
+        
+        # Only the displayed value is read from every measurement, so recordings are not paged in completely
+        measurand = self.store.Values(indexEl, indexFreq, start, stop)
+        if self.mode == "Y":
+            measurand = Admittances(measurand)
+        
+        count = self.seriesCount + len(measurand)
+        self.seriesTimes = Grow(self.seriesTimes, count)
+        self.seriesMags = Grow(self.seriesMags, count)
+        self.seriesPhases = Grow(self.seriesPhases, count)
+        self.seriesTimes[self.seriesCount:count] = self.store.ElapsedSeconds(start, stop, indexEl, indexFreq)
+        self.seriesMags[self.seriesCount:count] = np.abs(measurand)
+        self.seriesPhases[self.seriesCount:count] = np.angle(measurand, deg=True)
+        self.seriesCount = count
+        
+        self.currentTimes = self.seriesTimes[:count]
+        self.currentMags = self.seriesMags[:count]
+        self.currentPhases = self.seriesPhases[:count]
+        self.curve_mag.setData(self.currentTimes, self.currentMags)
+        self.curve_phase.setData(self.currentTimes, self.currentPhases)
+
     def mouse_moved(self, pos):
         if not hasattr(self, 'current_time') or len(self.currentTimes) == 0:
             return
@@ -546,19 +618,46 @@ class TimeSeriesTab(QWidget):
             self.crosshair_h_phase.setPos(phase[index])
             self.label_phase.setText(f"<span style='color: red;'>Phase: {phase[index]:.2f}° @ t={time[index]:.4g}</span>")
 
-    def update_data(self, data:EISData):
-        """Updates tab with new measurement data
+    @Slot(int, int)
+    def sweeps_appended(self, start:int, stop:int):
+        """Updates the plot with the new measurements of the store
 
         Args:
-            data (EISData): _description_
+            start (int): index of the first new measurement
+            stop (int): index after the last new measurement
         """
-        if not self.savedData:
-            self.freq_combo.addItems([str(f) for f in data.frequencies])
-            self.electrodeComboBox.addItems([str(x) for x in data.electrodes])
+        if start == 0:
+            self.freq_combo.blockSignals(True)
+            self.electrodeComboBox.blockSignals(True)
+            self.freq_combo.clear()
+            self.electrodeComboBox.clear()
+            self.freq_combo.addItems([str(f) for f in self.store.frequencies])
+            self.electrodeComboBox.addItems([str(x) for x in self.store.electrodes])
+            self.freq_combo.blockSignals(False)
+            self.electrodeComboBox.blockSignals(False)
         
-        self.data = data
-        self.savedData.append(data)
-        self.update_plot()
+        # Only the new points are computed, unless the series is not up to date
+        if start == self.seriesCount:
+            try:
+                self.append_points(start, stop)
+            except Exception as e:
+                QMessageBox.critical(self, "Plot Error", f"Failed to plot:\n{e}")
+        else:
+            self.update_plot()
+
+    @Slot()
+    def clear_data(self):
+        """Removes all measurements
+        """
+        self.freq_combo.blockSignals(True)
+        self.electrodeComboBox.blockSignals(True)
+        self.freq_combo.clear()
+        self.electrodeComboBox.clear()
+        self.freq_combo.blockSignals(False)
+        self.electrodeComboBox.blockSignals(False)
+        self.seriesCount = 0
+        self.curve_mag.setData([], [])
+        self.curve_phase.setData([], [])
 
 
 
@@ -568,11 +667,18 @@ class DerivedValueTab(QWidget):
     Args:
         QWidget (_type_): _description_
     """
-    def __init__(self, parent=None):
+    def __init__(self, store:MeasurementStore, parent=None):
         super().__init__(parent)
-        self.savedData:list[EISData] = []
-        self.domainValues = None
+        self.store = store
+        # time and value of the time domain curve, grown as sweeps are appended
+        self.seriesTimes = np.empty(0)
+        self.seriesValues = np.empty(0)
+        self.seriesCount = 0
+        # function, electrode combination and frequency index the time domain curve was computed for
+        self.seriesSelection = None
         self.initUI()
+        self.store.sweepsAppended.connect(self.sweeps_appended)
+        self.store.cleared.connect(self.clear_data)
 
     def initUI(self):
         # self.setWindowTitle("Derived Value Viewer")
@@ -625,6 +731,9 @@ class DerivedValueTab(QWidget):
         self.plot_widget.showGrid(x=True, y=True)
         self.plot_widget.setLabel('left', 'Derived Value')            
         self.plot_widget.setLabel('bottom', 'Frequency', units='Hz')
+        self.curve = self.plot_widget.plot(pen=pg.mkPen(color='m', width=2))
+        self.curve.setClipToView(True)
+        self.curve.setDownsampling(auto=True, method="peak")
 
         layout.addLayout(form_layout)
 
@@ -642,13 +751,10 @@ class DerivedValueTab(QWidget):
         """Updates plot with new data or function
 
         Args:
-            updateExisting (bool, optional): _description_. Defaults to False.
-
-        Raises:
-            ValueError: _description_
+            updateExisting (bool, optional): only replot if a function was plotted before, errors are printed instead of shown. Defaults to False.
         """
         
-        if not self.savedData:
+        if len(self.store) == 0:
             return
 
         if not updateExisting:
@@ -657,26 +763,18 @@ class DerivedValueTab(QWidget):
         if not self.firstTimeClicked:
             return
         
-        expr = self.input_expr.text().strip()
-        if not expr:
+        if not self.input_expr.text().strip():
             QMessageBox.warning(self, "Input Required", "Please enter a function using Z or Y.")
             return
-        result = []
         try:
-            indexEl = self.electrodeComboBox.currentIndex()
+            self.seriesCount = 0
             if self.frequencyButton.isChecked():
-                currentData = self.savedData[self.domainComboBox.currentIndex()]
-                result = [eval(expr, {"np": np, "Z": currentData.impedances[indexEl][x], "Y": currentData.admittances[indexEl][x]}) for x in range(len(currentData.frequencies))]
+                self.seriesSelection = None
+                currentImpedances = self.store.Row(self.domainComboBox.currentIndex())[0][self.electrodeComboBox.currentIndex()]
+                self.curve.setData(self.store.frequencies, self.evaluate(currentImpedances))
             else:
-                currentImpedances = [x.impedances[indexEl][self.domainComboBox.currentIndex()] for x in self.savedData]
-                currentAdmittances = [x.admittances[indexEl][self.domainComboBox.currentIndex()] for x in self.savedData]
-                result = [eval(expr, {"np": np, "Z": currentImpedances[x], "Y": currentAdmittances[x]}) for x in range(len(currentImpedances))]
-
-            if len(result) != len(self.domainValues):
-                raise ValueError("Result length mismatch.")
-
-            self.plot_widget.clear()
-            self.plot_widget.plot(self.domainValues, result, pen=pg.mkPen(color='m', width=2))
+                self.seriesSelection = self.selection()
+                self.append_values(0, len(self.store))
             self.plot_widget.getViewBox().autoRange()  # Nach dem Plot automatisch skalieren
 
         except Exception as e:
@@ -684,21 +782,81 @@ class DerivedValueTab(QWidget):
                 QMessageBox.critical(self, "Plot Error", f"Failed to compute or plot expression:\n{e}")
             else:
                 print(f"Failed to compute or plot expression:\n{e}")
+
+    def selection(self) -> tuple[str, int, int]:
+        return self.input_expr.text().strip(), self.electrodeComboBox.currentIndex(), self.domainComboBox.currentIndex()
+
+    def evaluate(self, impedances:np.ndarray) -> np.ndarray:
+        """Evaluates the entered function for every impedance
+
+        Args:
+            impedances (np.ndarray): impedances the function is applied to one by one
+
+        Returns:
+            np.ndarray: function values
+        """
+        expr = self.input_expr.text().strip()
+        admittances = Admittances(impedances)
+        return np.array([eval(expr, {"np": np, "Z": impedances[x], "Y": admittances[x]}) for x in range(len(impedances))], dtype=np.float64)
+
+    def append_values(self, start:int, stop:int):
+        """Evaluates the function for sweeps start to stop and appends them to the time domain curve
+
+        Args:
+            start (int): index of the first sweep
+            stop (int): index after the last sweep
+        """
+        _, indexEl, indexFreq = self.seriesSelection
+
+        # Only the selected point of the new sweeps is read and evaluated
+        values = self.evaluate(self.store.Values(indexEl, indexFreq, start, stop))
+
+        count = self.seriesCount + len(values)
+        self.seriesTimes = Grow(self.seriesTimes, count)
+        self.seriesValues = Grow(self.seriesValues, count)
+        self.seriesTimes[self.seriesCount:count] = self.store.ElapsedSeconds(start, stop)
+        self.seriesValues[self.seriesCount:count] = values
+        self.seriesCount = count
+
+        self.curve.setData(self.seriesTimes[:count], self.seriesValues[:count])
     
-    def update_data(self, data:EISData):
-        """Updates data with new measurement data
+    @Slot(int, int)
+    def sweeps_appended(self, start:int, stop:int):
+        """Extends the domain by the new measurements of the store and replots an entered function
 
         Args:
-            data (EISData): _description_
+            start (int): index of the first new measurement
+            stop (int): index after the last new measurement
         """
         
-        if not self.savedData:
-            self.electrodeComboBox.addItems([str(x) for x in data.electrodes])
-        self.savedData.append(data)
-        self.domainRadioStateChanged()
+        if start == 0:
+            self.electrodeComboBox.clear()
+            self.electrodeComboBox.addItems([str(x) for x in self.store.electrodes])
+            self.domainRadioStateChanged()
+        elif self.frequencyButton.isChecked():
+            self.domainComboBox.addItems(self.store.Descriptions(start, stop))
+        
         if self.frequencyButton.isChecked():
-            self.domainComboBox.setCurrentIndex(len(self.savedData) - 1)
-        self.update_plot(True)
+            self.domainComboBox.setCurrentIndex(stop - 1)
+            self.update_plot(True)
+        # Only the new sweeps are evaluated, unless the curve is not up to date
+        elif self.firstTimeClicked and start > 0 and start == self.seriesCount and self.seriesSelection == self.selection():
+            try:
+                self.append_values(start, stop)
+            except Exception as e:
+                print(f"Failed to compute or plot expression:\n{e}")
+        else:
+            self.update_plot(True)
+
+    @Slot()
+    def clear_data(self):
+        """Removes all measurements
+        """
+        self.seriesCount = 0
+        self.seriesSelection = None
+        self.domainComboBox.clear()
+        self.electrodeComboBox.clear()
+        self.curve.setData([], [])
     
     def domainRadioStateChanged(self):
         """Switch between spectrum and continuous display
@@ -708,21 +866,85 @@ class DerivedValueTab(QWidget):
             self.plot_widget.setTitle("Derived Value vs Frequency")
             self.plot_widget.setLabel('bottom', 'Frequency', units='Hz')
             self.domainComboBox.clear()
-            if self.savedData:
-                self.domainValues = self.savedData[0].frequencies
-                measurements = [f"{x.measurementIndex}: {x.startTime} - {x.finishTime}" for x in self.savedData]
-                self.domainComboBox.addItems(measurements)
+            if len(self.store) > 0:
+                self.domainComboBox.addItems(self.store.Descriptions())
 
         else:
             self.plot_widget.setTitle("Derived Value vs Time")
             self.plot_widget.setLabel('bottom', 'Time', units='s')
             self.domainComboBox.clear()
-            if self.savedData:
-                startTime = datetime.strptime(self.savedData[0].startTime, "%Y-%m-%d %H:%M:%S")
-                self.domainValues = [(datetime.strptime(x.startTime, "%Y-%m-%d %H:%M:%S") - startTime).total_seconds() for x in self.savedData]
-                measurements = [str(x) for x in self.savedData[0].frequencies]
-                self.domainComboBox.addItems(measurements)
+            if len(self.store) > 0:
+                self.domainComboBox.addItems([str(x) for x in self.store.frequencies])
 
     def reset_zoom_on_doubleclick(self, event):
         if event.double():
             self.plot_widget.getViewBox().autoRange()
+
+
+class MetricsTab(QWidget):
+    """Tab showing the live acquisition metrics, recording is off until enabled here
+
+    Args:
+        QWidget (_type_): _description_
+    """
+    def __init__(self, impedanceAnalyser:ImpedanceAnalyser, parent=None):
+        super().__init__(parent)
+        self.impedanceAnalyser = impedanceAnalyser
+        self.timer = QTimer(self)
+        self.timer.setInterval(1000)
+        self.timer.timeout.connect(self.update_table)
+        self.initUI()
+
+    def initUI(self):
+        layout = QVBoxLayout()
+
+        control_layout = QHBoxLayout()
+        self.enableCheckBox = QCheckBox("Record metrics")
+        self.enableCheckBox.toggled.connect(self.set_enabled)
+        control_layout.addWidget(self.enableCheckBox)
+        self.resetButton = QPushButton("Reset")
+        self.resetButton.clicked.connect(self.reset_metrics)
+        control_layout.addWidget(self.resetButton)
+        control_layout.addStretch()
+        layout.addLayout(control_layout)
+
+        self.table = QTableWidget(0, 8)
+        self.table.setHorizontalHeaderLabels(["Name", "Count / Value", "Rate [1/s]", "Mean [ms]", "p50 [ms]", "p90 [ms]", "p99 [ms]", "Max [ms]"])
+        self.table.verticalHeader().setVisible(False)
+        layout.addWidget(self.table)
+
+        self.setLayout(layout)
+
+    def set_enabled(self, enabled:bool):
+        """Attaches a new Metrics object to the analyser or detaches it
+
+        Args:
+            enabled (bool): True to start recording
+        """
+        if enabled:
+            self.impedanceAnalyser.EnableMetrics(Metrics())
+            self.timer.start()
+        else:
+            self.timer.stop()
+            self.impedanceAnalyser.EnableMetrics(None)
+
+    def reset_metrics(self):
+        if self.impedanceAnalyser.metrics is not None:
+            self.impedanceAnalyser.metrics.Reset()
+            self.update_table()
+
+    def update_table(self):
+        """Shows the current snapshot, counters first and histograms afterwards
+        """
+        if self.impedanceAnalyser.metrics is None:
+            return
+
+        snapshot = self.impedanceAnalyser.metrics.Snapshot()
+        rows = [[name, str(value), f"{snapshot['rates'].get(name, 0):.1f}"] + [""] * 5 for name, value in sorted(snapshot["counters"].items())]
+        for name, summary in snapshot["histograms"].items():
+            rows.append([name, str(summary["count"]), ""] + [f"{1000 * summary[key]:.3f}" for key in ("mean", "p50", "p90", "p99", "max")])
+
+        self.table.setRowCount(len(rows))
+        for rowIndex, row in enumerate(rows):
+            for columnIndex, text in enumerate(row):
+                self.table.setItem(rowIndex, columnIndex, QTableWidgetItem(text))
@@ -0,0 +1,23 @@
+import os, sys, threading
+
+import pytest
+
+# the modules import each other by file name, like when main.py is started from the package directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from DeviceEmulator import DeviceEmulator
+
+
+@pytest.fixture
+def emulator() -> DeviceEmulator:
+    """Emulator serving TCP on a free local port (see emulator.port)
+    """
+
+    emulator = DeviceEmulator(seed=0)
+    ready = threading.Event()
+    threading.Thread(target=emulator.ServeTcp, kwargs={"ready": ready}, name="EmulatorTcp", daemon=True).start()
+    assert ready.wait(5)
+
+    yield emulator
+
+    emulator.DropConnection()
@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+
+from EnumClasses import CurrentRange, FeChannel, FeMode, FrequencyScale, InjectionType, TimeStamp
+from HelperFunctions import GenElectrodeConf
+from ImpedanceAnalyser import ImpedanceAnalyser
+from Transport import OpenTransport, TcpTransport, Transport, defaultPool
+
+
+def Setup(analyser:ImpedanceAnalyser, fnum:int, numChannels:int):
+    analyser.DoInitialSetup(1e3, 1e6, fnum, FrequencyScale.logarithmic, FeChannel.ExtensionPort, FeMode.mode4pt, CurrentRange.range10mA, 1, InjectionType.voltage, 0.1, TimeStamp.ms)
+    analyser.muxElConfig = [list(combination) for combination in GenElectrodeConf(list(range(1, 11)))][:numChannels]
+
+
+@pytest.fixture
+def analyser(emulator) -> ImpedanceAnalyser:
+    analyser = ImpedanceAnalyser(TcpTransport("127.0.0.1", emulator.port, timeout=5))
+    yield analyser
+    analyser.device.close()
+
+
+def test_transport_is_abstract():
+    class Incomplete(Transport):
+        def open(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_open_transport_tcp(emulator):
+    try:
+        transport = OpenTransport(f"tcp://127.0.0.1:{emulator.port}")
+        assert isinstance(transport, TcpTransport)
+        assert transport.is_open
+        assert OpenTransport(f"tcp://127.0.0.1:{emulator.port}") is transport
+
+        analyser = ImpedanceAnalyser(f"tcp://127.0.0.1:{emulator.port}")
+        assert analyser.device is transport
+        assert analyser.GetDeviceID()
+    finally:
+        defaultPool.CloseAll()
+
+    with pytest.raises(ValueError):
+        OpenTransport("tcp://127.0.0.1")
+
+
+def test_sweep(emulator, analyser):
+    Setup(analyser, 16, 4)
+
+    real, imag, warning, currentRange, timeStamp, startTime, finishTime = analyser.GetMeasurements()
+
+    assert real.shape == (4, 16)
+    assert np.allclose(analyser.GetFrequencyList(), emulator.frequencies)
+    for channel in range(4):
+        assert np.allclose(real[channel] + 1j * imag[channel], emulator.ModelImpedance(channel), rtol=1e-5)
+    assert not warning.any()
+    assert startTime <= finishTime
+
+
+def test_chunk_over_128_channels(emulator, analyser):
+    Setup(analyser, 4, 130)
+
+    real, imag, *_ = analyser.GetMeasurements()
+
+    assert real.shape == (130, 4)
+    # the device list is sent in chunks of 128, the emulator numbers the channels per chunk
+    assert len(emulator.channels) == 2
+    assert np.allclose(real[128:] + 1j * imag[128:], [emulator.ModelImpedance(0), emulator.ModelImpedance(1)], rtol=1e-5)
+    assert np.allclose(real[:128] + 1j * imag[:128], [emulator.ModelImpedance(channel) for channel in range(128)], rtol=1e-5)
+
+
+@pytest.mark.parametrize("powerCycle", [False, True])
+def test_dropped_connection(emulator, analyser, powerCycle):
+    Setup(analyser, 8, 6)
+    first = analyser.GetMeasurements()
+
+    emulator.DropConnection(powerCycle)
+    second = analyser.GetMeasurements()
+
+    # a power cycled device lost its setup, the analyser has to send it again after reconnecting
+    assert len(emulator.frequencies) == 8
+    assert np.allclose(first[0], second[0])
+    assert np.allclose(first[1], second[1])
+
+
+def test_continuous_stops_after_sweeps(emulator, analyser):
+    Setup(analyser, 4, 3)
+
+    sweeps = analyser.IterContinuousMeasurements()
+    for _ in range(3):
+        real, *_ = next(sweeps)
+    sweeps.close()
+
+    assert emulator.measureThread is None
+    assert np.allclose(real[0], emulator.ModelImpedance(0).real, rtol=1e-5)
+
+
+def test_continuous_error_is_not_hidden(emulator, analyser, monkeypatch):
+    Setup(analyser, 4, 3)
+    sweeps = analyser.IterContinuousMeasurements()
+    next(sweeps)
+
+    def BrokenRead(numPoints, out):
+        # the device stops answering, so the stop command is never acknowledged
+        emulator.Feed = lambda data: None
+        raise ValueError("decode failed")
+    monkeypatch.setattr(analyser, "ReadResults", BrokenRead)
+
+    with pytest.raises(ValueError, match="decode failed"):
+        next(sweeps)